@@ -0,0 +1,438 @@
+"""
+ MIF/Clean_HRM_share.py
+ Sweep HRM-Share user folders and reclaim space used by raw and deconvolved images according to retention rules.
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import omero
+import omero.scripts as scripts
+from omero.gateway import BlitzGateway
+from omero.rtypes import rstring, rlist, rlong
+from omero_hrm_common import LOG_LEVELS, log_handler, set_log_level
+
+
+RAW_RETENTION_PARAM_NAME = "Raw_retention_days"
+DECONVOLVED_RETENTION_PARAM_NAME = "Deconvolved_retention_days"
+DELETE_MISSING_RAW_PARAM_NAME = "Delete_raw_not_on_OMERO"
+DELETE_NOT_IMPORTED_PARAM_NAME = "Delete_not_imported_deconvolved"
+DRY_RUN_PARAM_NAME = "Dry_run"
+WORKERS_PARAM_NAME = "Workers"
+LOG_LEVEL_PARAM_NAME = "Log_level"
+
+# root path to HRM-Share folder
+HRM_ROOT = "/mnt/hrmshare"
+SECONDS_PER_DAY = 24 * 3600
+
+logger = logging.getLogger("omero-hrm.clean")
+
+
+def is_hidden(name):
+    """Filter any .DS_store, .git and Thumbs.db"""
+    return name.startswith(".") or name.endswith("Thumbs.db")
+
+
+def parse_job_basename(file_name):
+    """Remove everything after the HRM job label (`_<13 hex digits>_hrm`) of a result file name"""
+    return re.sub(r"(_[0-9a-f]{13}_hrm)\..*", r"\1", file_name)
+
+
+def get_size_and_mtime(path):
+    """
+    Compute the total size of a file or of a folder (recursively) and its most recent modification time
+    return (size in bytes, modification time)
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            sub_size, sub_mtime = get_size_and_mtime(entry.path)
+        else:
+            stat = entry.stat(follow_symlinks=False)
+            sub_size, sub_mtime = stat.st_size, stat.st_mtime
+        size += sub_size
+        mtime = max(mtime, sub_mtime)
+    return size, mtime
+
+
+def list_dataset_folders(omero_folder):
+    """
+    List all dataset folders of an HRM omero folder (omero/project/dataset)
+    return a list of (dataset_name, dataset_folder)
+    """
+    dataset_folders = []
+    if not os.path.isdir(omero_folder):
+        return dataset_folders
+
+    for project_name in os.listdir(omero_folder):
+        project_folder = os.path.join(omero_folder, project_name)
+        if is_hidden(project_name) or not os.path.isdir(project_folder):
+            continue
+        for dataset_name in os.listdir(project_folder):
+            dataset_folder = os.path.join(project_folder, dataset_name)
+            if is_hidden(dataset_name) or not os.path.isdir(dataset_folder):
+                continue
+            dataset_folders.append((dataset_name, dataset_folder))
+    return dataset_folders
+
+
+def scan_raw_filesets(owner_folder):
+    """
+    List all raw filesets (Raw/omero/project/dataset/Fileset_<id>) of a user folder, with their metadata sidecar
+    (Fileset_<id>.json) if any
+    return a list of dict with the fileset id, paths, size and modification time
+    """
+    filesets = []
+    for _, dataset_folder in list_dataset_folders(os.path.join(owner_folder, "Raw", "omero")):
+        for fileset_name in os.listdir(dataset_folder):
+            fileset_folder = os.path.join(dataset_folder, fileset_name)
+            if not fileset_name.startswith("Fileset_") or not os.path.isdir(fileset_folder):
+                continue
+            try:
+                fileset_id = int(fileset_name.split("_")[1])
+            except ValueError:
+                continue
+            size, mtime = get_size_and_mtime(fileset_folder)
+            paths = [fileset_folder]
+            sidecar_path = fileset_folder + ".json"
+            if os.path.isfile(sidecar_path):
+                paths.append(sidecar_path)
+                size += os.path.getsize(sidecar_path)
+            filesets.append({"id": fileset_id, "paths": paths, "size": size, "mtime": mtime})
+    return filesets
+
+
+def scan_deconvolved_results(owner_folder):
+    """
+    List all deconvolved results (Deconvolved/omero/project/dataset/<folder>/<job>.ids) of a user folder.
+    All files sharing the same HRM job basename (.ics, .ids, .log.txt, .parameters.txt, .hgsb) belong to one result.
+    return a list of dict with the dataset id, image name and path, paths of the result, size and modification time
+    """
+    results = []
+    for dataset_name, dataset_folder in list_dataset_folders(os.path.join(owner_folder, "Deconvolved", "omero")):
+        dataset_id = None
+        if not dataset_name == "None":
+            try:
+                dataset_id = int(dataset_name.split("_")[0])
+            except ValueError:
+                pass
+
+        for fileset_name in os.listdir(dataset_folder):
+            fileset_folder = os.path.join(dataset_folder, fileset_name)
+            if is_hidden(fileset_name) or not os.path.isdir(fileset_folder):
+                continue
+            file_names = os.listdir(fileset_folder)
+            for image_name in file_names:
+                if ".ids" not in image_name:
+                    continue
+                job_basename = parse_job_basename(image_name)
+                paths = [os.path.join(fileset_folder, name) for name in file_names
+                         if name.startswith(job_basename) or name == image_name]
+                size = 0
+                mtime = 0
+                for path in paths:
+                    file_size, file_mtime = get_size_and_mtime(path)
+                    size += file_size
+                    mtime = max(mtime, file_mtime)
+                results.append({"dataset_id": dataset_id, "name": image_name,
+                                "path": os.path.abspath(os.path.join(fileset_folder, image_name)), "paths": paths,
+                                "size": size, "mtime": mtime})
+    return results
+
+
+def get_existing_fileset_ids(conn, fileset_ids):
+    """
+    Query OMERO, across all groups, for the filesets that still exist
+    return the set of existing fileset ids
+    """
+    if len(fileset_ids) == 0:
+        return set()
+
+    params = omero.sys.ParametersI()
+    params.add("ids", rlist([rlong(fileset_id) for fileset_id in fileset_ids]))
+    query = "select f.id from Fileset f where f.id in (:ids)"
+    rows = conn.getQueryService().projection(query, params, {"omero.group": "-1"})
+    return set(row[0].val for row in rows)
+
+
+def get_imported_image_names(conn, results, owner):
+    """
+    Query OMERO, across all groups, for the deconvolved images that are already imported.
+    Images belonging to a dataset are matched by (dataset id, name). Orphaned ones (no dataset folder, or plate
+    folders) are matched, among the images of the user, on the path of the imported .ids file, or on their name for
+    the images converted to OME-TIFF before the import (their file was in the scratch folder).
+    return a set of (dataset id, name) tuples and a set of .ids paths
+    """
+    dataset_ids = set(result["dataset_id"] for result in results if result["dataset_id"] is not None)
+    orphaned_results = [result for result in results if result["dataset_id"] is None]
+    query_service = conn.getQueryService()
+    imported_in_dataset = set()
+    imported_paths = set()
+
+    if len(dataset_ids) > 0:
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(dataset_id) for dataset_id in dataset_ids]))
+        query = "select l.parent.id, i.name from DatasetImageLink l join l.child i where l.parent.id in (:ids)"
+        for row in query_service.projection(query, params, {"omero.group": "-1"}):
+            imported_in_dataset.add((row[0].val, row[1].val))
+
+    if len(orphaned_results) > 0:
+        orphaned_paths = set(result["path"] for result in orphaned_results)
+        params = omero.sys.ParametersI()
+        params.add("owner", rstring(owner))
+        # importers record the client path with or without its leading separator
+        params.add("paths", rlist([rstring(path) for path in orphaned_paths] +
+                                  [rstring(path.lstrip("/")) for path in orphaned_paths]))
+        params.add("names", rlist([rstring(result["name"]) for result in orphaned_results]))
+        query = "select i.name, fe.clientPath from Image i join i.details.owner o join i.fileset fs " \
+                "join fs.usedFiles fe where o.omeName = :owner and (fe.clientPath in (:paths) or i.name in (:names))"
+        converted_names = set()
+        for row in query_service.projection(query, params, {"omero.group": "-1"}):
+            name, client_path = row[0].val, "/" + row[1].val.lstrip("/")
+            if client_path in orphaned_paths:
+                imported_paths.add(client_path)
+            elif os.path.basename(client_path) == name + ".ome.tif":
+                converted_names.add(name)
+        imported_paths.update(result["path"] for result in orphaned_results if result["name"] in converted_names)
+
+    return imported_in_dataset, imported_paths
+
+
+def select_reclaimable(conn, owner_folder, retention):
+    """
+    Cross-check the raw and deconvolved images of one user folder with OMERO and select the ones
+    that can be deleted according to the retention rules
+    return the list of reclaimable entries (dict with 'kind', 'paths', 'size', 'reason')
+    """
+    now = time.time()
+    reclaimable = []
+
+    raw_filesets = scan_raw_filesets(owner_folder)
+    existing_fileset_ids = get_existing_fileset_ids(conn, [fileset["id"] for fileset in raw_filesets])
+    for fileset in raw_filesets:
+        age = (now - fileset["mtime"]) / SECONDS_PER_DAY
+        if fileset["id"] not in existing_fileset_ids and retention[DELETE_MISSING_RAW_PARAM_NAME]:
+            reason = "fileset not on OMERO anymore"
+        elif age > retention[RAW_RETENTION_PARAM_NAME]:
+            reason = f"older than {retention[RAW_RETENTION_PARAM_NAME]} days"
+        else:
+            continue
+        reclaimable.append({"kind": "raw", "paths": fileset["paths"], "size": fileset["size"], "reason": reason})
+
+    deconvolved_results = scan_deconvolved_results(owner_folder)
+    imported_in_dataset, imported_paths = get_imported_image_names(conn, deconvolved_results,
+                                                                   os.path.basename(owner_folder))
+    for result in deconvolved_results:
+        age = (now - result["mtime"]) / SECONDS_PER_DAY
+        if result["dataset_id"] is not None:
+            imported = (result["dataset_id"], result["name"]) in imported_in_dataset
+        else:
+            imported = result["path"] in imported_paths
+
+        if age <= retention[DECONVOLVED_RETENTION_PARAM_NAME]:
+            continue
+        if imported:
+            reason = "already imported on OMERO"
+        elif retention[DELETE_NOT_IMPORTED_PARAM_NAME]:
+            reason = f"not imported and older than {retention[DECONVOLVED_RETENTION_PARAM_NAME]} days"
+        else:
+            continue
+        reclaimable.append({"kind": "deconvolved", "paths": result["paths"], "size": result["size"],
+                            "reason": reason})
+
+    return reclaimable
+
+
+def delete_path(path):
+    """Delete a file or a folder (recursively) and its empty parent folders up to the dataset level
+    Returns
+    -------
+    bool
+        True in case of success, False otherwise.
+    """
+    try:
+        if os.path.isdir(path):
+            for entry in os.listdir(path):
+                delete_path(os.path.join(path, entry))
+            os.rmdir(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        logger.info("Delete [%s]", path)
+    except OSError as err:
+        logger.error("Fail deleting [%s] : %s", path, err)
+        return False
+    return True
+
+
+def delete_empty_parents(path, levels):
+    """Delete the parent folders of a deleted path as long as they are empty"""
+    parent_folder = os.path.dirname(path)
+    for _ in range(levels):
+        if not os.path.isdir(parent_folder) or len(os.listdir(parent_folder)) > 0:
+            return
+        logger.info("Delete parent directory [%s]", parent_folder)
+        os.rmdir(parent_folder)
+        parent_folder = os.path.dirname(parent_folder)
+
+
+def clean_hrm_share(conn, script_params):
+    """
+    Scan every user folder of HRM-Share, report reclaimable space per user and delete, in parallel,
+    raw and deconvolved images that are out of the retention rules.
+    Non-admin users can only sweep their own folder.
+    """
+    dry_run = script_params[DRY_RUN_PARAM_NAME]
+    workers = max(1, script_params[WORKERS_PARAM_NAME])
+    retention = {key: script_params[key] for key in [RAW_RETENTION_PARAM_NAME, DECONVOLVED_RETENTION_PARAM_NAME,
+                                                     DELETE_MISSING_RAW_PARAM_NAME, DELETE_NOT_IMPORTED_PARAM_NAME]}
+
+    if not os.path.isdir(HRM_ROOT):
+        message = "The root HRM folder doesn't exists. Please correct it."
+        logger.info("%s", message)
+        return message
+
+    note = ""
+    if conn.getUser().isAdmin():
+        owners = sorted(name for name in os.listdir(HRM_ROOT)
+                        if not is_hidden(name) and os.path.isdir(os.path.join(HRM_ROOT, name)))
+    else:
+        owners = [conn.getUser().getOmeName()]
+        # the filesets of the groups the user is not a member of (or of other members of private groups) are not
+        # visible to the user : they would be taken as deleted from OMERO
+        if retention[DELETE_MISSING_RAW_PARAM_NAME]:
+            retention[DELETE_MISSING_RAW_PARAM_NAME] = False
+            note = f"\n'{DELETE_MISSING_RAW_PARAM_NAME}' ignored : only admins can see every fileset on OMERO"
+            logger.warning("%s is ignored : only admins can see every fileset on OMERO", DELETE_MISSING_RAW_PARAM_NAME)
+
+    user_reports = []
+    total_bytes = 0
+    total_deleted = 0
+    total_entries = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for owner in owners:
+            owner_folder = os.path.join(HRM_ROOT, owner)
+            if not os.path.isdir(owner_folder):
+                logger.warning("No HRM folder for user %s", owner)
+                continue
+
+            reclaimable = select_reclaimable(conn, owner_folder, retention)
+            reclaimable_bytes = sum(entry["size"] for entry in reclaimable)
+            for entry in reclaimable:
+                logger.debug("%s : %s %s (%s B) -> %s",
+                             owner, entry['kind'], entry['paths'][0], entry['size'], entry['reason'])
+
+            n_deleted = 0
+            if not dry_run:
+                paths = [path for entry in reclaimable for path in entry["paths"]]
+                n_deleted = sum(1 for deleted in executor.map(delete_path, paths) if deleted)
+                # remove empty parents up to the omero folder : project/dataset for raw filesets,
+                # project/dataset/folder for deconvolved files
+                for entry in reclaimable:
+                    delete_empty_parents(entry["paths"][0], 2 if entry["kind"] == "raw" else 3)
+
+            user_reports.append(f"{owner}: {len(reclaimable)} item(s), {reclaimable_bytes / 1024 ** 3:.2f} GB")
+            total_bytes += reclaimable_bytes
+            total_entries += len(reclaimable)
+            total_deleted += n_deleted
+
+    for report in user_reports:
+        logger.info("%s", report)
+
+    action = "reclaimable (dry run)" if dry_run else f"reclaimed, {total_deleted} path(s) deleted"
+    message = f"{total_entries} item(s) / {total_bytes / 1024 ** 3:.2f} GB {action} over {len(user_reports)} user(s)"
+    logger.info("%s", message)
+    return message + note
+
+
+def run_script():
+    client = scripts.client(
+        'Clean HRM-Share folder',
+        """
+    This script scans the HRM folders (\\sv-nas1.rcp.epfl.ch\ptbiop-raw\HRM-Share) and reports, for each user, the space
+    used by raw images that were sent to HRM and by deconvolved images that are already imported on OMERO.
+    Unless 'Dry run' is selected, the images that are out of the retention rules are deleted.
+    Admins sweep every user folder, other users only their own folder.
+        """,
+        scripts.Int(
+            RAW_RETENTION_PARAM_NAME, optional=False, grouping="1",
+            description="Delete raw images sent to HRM more than this number of days ago", default=30),
+
+        scripts.Int(
+            DECONVOLVED_RETENTION_PARAM_NAME, optional=False, grouping="2",
+            description="Keep deconvolved images on HRM at least this number of days", default=7),
+
+        scripts.Bool(
+            DELETE_MISSING_RAW_PARAM_NAME, optional=True, grouping="3",
+            description="Delete raw images whose fileset does not exist on OMERO anymore (admins only)",
+            default=True),
+
+        scripts.Bool(
+            DELETE_NOT_IMPORTED_PARAM_NAME, optional=True, grouping="4",
+            description="Also delete deconvolved images older than the retention that are not imported on OMERO",
+            default=False),
+
+        scripts.Bool(
+            DRY_RUN_PARAM_NAME, optional=True, grouping="5",
+            description="Only report the reclaimable space, do not delete anything", default=True),
+
+        scripts.Int(
+            WORKERS_PARAM_NAME, optional=False, grouping="6",
+            description="Number of parallel deletions", default=4, min=1),
+
+        scripts.String(
+            LOG_LEVEL_PARAM_NAME, optional=False, grouping="7",
+            description="Verbosity of the script output (TRACE being the most verbose)",
+            values=[rstring(level) for level in LOG_LEVELS], default="INFO"),
+
+        authors=["Rémy Dornier"],
+        institutions=["EPFL - BIOP"],
+        contact="omero@groupes.epfl.ch"
+    )
+
+    try:
+        # process the list of args above.
+        script_params = {}
+        for key in client.getInputKeys():
+            # keep False booleans and 0 integers
+            if client.getInput(key) is not None:
+                script_params[key] = client.getInput(key, unwrap=True)
+
+        set_log_level(script_params.get(LOG_LEVEL_PARAM_NAME, "INFO"))
+
+        # wrap client to use the Blitz Gateway
+        conn = BlitzGateway(client_obj=client)
+        logger.info("script params")
+        for k, v in script_params.items():
+            logger.info("%s %s", k, v)
+        message = clean_hrm_share(conn, script_params)
+        client.setOutput("Message", rstring(message))
+
+    finally:
+        log_handler.close()
+        client.closeSession()
+
+
+if __name__ == "__main__":
+    run_script()
@@ -22,33 +22,122 @@ import os
 import re
 
 import omero
-from bs4 import BeautifulSoup
 import omero.scripts as scripts
 import omero.model as model
 from omero.gateway import BlitzGateway
 from omero.gateway import DatasetWrapper
 from omero.gateway import MapAnnotationWrapper
 from omero.gateway import TagAnnotationWrapper
-from omero.rtypes import rstring
-from omero.plugins.sessions import SessionsControl
-from omero.cli import CLI
-import tempfile
+from omero.rtypes import rstring, rdouble, rint, rlist, rlong, robject, rtime
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import date
-import yaml
 from importlib import import_module
-
-ImportControl = import_module("omero.plugins.import").ImportControl
+import hashlib
+import io
+import json
+import logging
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import zlib
+from omero_hrm_common import (LOG_LEVELS, METRICS_NS, OFF_PEAK_PARAM_NAME, SUCCESS, TRACE, TRANSIENT_ERRORS,
+                              SessionKeeper, call_with_retry, close_user_connections, concurrency, enqueue_request,
+                              export_metrics, get_group_connection, get_user_connection, log_handler, metrics,
+                              report_queued_results, schedule_round_robin, set_log_level, throttle)
+
+# BeautifulSoup, yaml, tempfile and the OMERO CLI are imported by the stages using them, so that launching the
+# script stays fast, especially when there is nothing to upload.
+# numpy and tifffile are optional and loaded by load_optional_modules()
+np = None
+tifffile = None
+optional_modules_loaded = False
 
 
 SERVER_PARAM_NAME = "OMERO_server"
 PORT_PARAM_NAME = "Port"
 DELETE_DECONVOLVED_PARAM_NAME = "Delete_deconvolved_images_on_HRM"
 DELETE_RAW_PARAM_NAME = "Delete_raw_images_on_HRM"
+ALL_USERS_PARAM_NAME = "Retrieve_for_all_HRM_users"
+WORKERS_PARAM_NAME = "Parallel_imports"
+MAX_IMPORTS_PER_USER_PARAM_NAME = "Max_parallel_imports_per_user"
+ADAPTIVE_WORKERS_PARAM_NAME = "Adapt_parallel_imports"
+MIN_WORKERS_PARAM_NAME = "Min_parallel_imports"
+PRECOMPUTE_STATS_PARAM_NAME = "Precompute_rendering_settings"
+THUMBNAILS_PARAM_NAME = "Generate_thumbnails"
+VERIFY_CHECKSUMS_PARAM_NAME = "Verify_checksums_before_deleting"
+METRICS_TEXTFILE_PARAM_NAME = "Metrics_textfile_directory"
+CONVERT_PARAM_NAME = "Convert_to_pyramidal_OME-TIFF"
+NATIVE_IMPORT_PARAM_NAME = "Native_Python_import"
+SCRATCH_FOLDER_PARAM_NAME = "Scratch_folder"
+MAX_SCRATCH_PARAM_NAME = "Max_scratch_space_GB"
+MAX_BANDWIDTH_PARAM_NAME = "Max_bandwidth_MB_per_s"
+MAX_USER_BANDWIDTH_PARAM_NAME = "Max_bandwidth_per_user_MB_per_s"
+MAX_FILE_OPS_PARAM_NAME = "Max_file_operations_per_s"
+MAX_USER_FILE_OPS_PARAM_NAME = "Max_file_operations_per_user_per_s"
+LOG_LEVEL_PARAM_NAME = "Log_level"
+PARAMETERS_TABLE_PARAM_NAME = "Summarize_parameters_in_table"
+PREVIEW_PARAM_NAME = "Preview_only"
+BUNDLE_PROVENANCE_PARAM_NAME = "Bundle_provenance_files"
+
+# maximum amount of pixel data loaded at once when streaming .ids files
+CHUNK_BYTES = 64 * 1024 * 1024
+# number of histogram bins used to estimate the rendering window percentiles
+HISTOGRAM_BINS = 4096
+RENDERING_PERCENTILES = (0.1, 99.9)
+# checksum algorithm used by default by OMERO.server and size of the buffers used to read files
+DEFAULT_HASHER = "SHA1-160"
+HASH_BUFFER_BYTES = 16 * 1024 * 1024
+hash_buffers = threading.local()
+# chunk size and number of chunks in flight of the native Python import, and poll interval of the import handle
+UPLOAD_CHUNK_BYTES = 16 * 1024 * 1024
+UPLOAD_WRITES_IN_FLIGHT = 4
+IMPORT_POLL_MS = 5000
+upload_buffers = threading.local()
+# number of images per ThumbnailStore call and size of the generated thumbnails
+THUMBNAIL_BATCH_SIZE = 50
+THUMBNAIL_SIZE = 96
+# namespace and name of the OMERO.table summarizing the deconvolution parameters of a dataset, and minimum size of
+# its string columns, so that appended rows rarely require rewriting the table
+PARAMETERS_TABLE_NS = "Huygens Remote Manager - Parameters table"
+PARAMETERS_TABLE_NAME = "HRM_parameters.h5"
+STRING_COLUMN_MIN_SIZE = 64
+# parameters of the imported images, waiting to be appended to the tables {(owner, group_id, dataset_id):rows},
+# and descriptions {column name:description} of the parameter columns
+parameter_rows_lock = threading.Lock()
+parameter_rows = {}
+parameter_descriptions = {}
+# stages of a previous run used to estimate the import time of a preview : the imports, and the per image stages
+# following them
+IMPORT_STAGES = ("to_omero", "import_with_python")
+POST_IMPORT_STAGES = ("save_statistics", "verify_checksums", "parse_summary", "add_key_values", "add_tags",
+                      "attach_log_file", "attach_provenance", "delete")
+# number of previous metrics files searched for imports
+PREVIEW_METRICS_SEARCH = 10
+# files written by HRM next to each result, packed in one compressed archive attached to the imported image
+PROVENANCE_SUFFIXES = (".log.txt", ".parameters.txt", ".hgsb")
+PROVENANCE_NS = "hrm.deconvolution.provenance"
+# plate folders written by the send script (Raw/omero/Screen_<id>_<name>/Plate_<id>_<name>) : images cannot be
+# imported into a plate, so deconvolved plate images are imported as orphaned images
+PLATE_FOLDER_PREFIX = "Plate_"
+# maximum number of OMERO objects kept by the run-scoped cache shared by the stages
+OBJECT_CACHE_SIZE = 1024
+# tile size of the converted OME-TIFF, also the size under which no more pyramid level is added
+TILE_SIZE = 512
+# scratch space currently used by converted OME-TIFF files, shared by the parallel imports
+scratch_lock = threading.Lock()
+scratch_reserved_bytes = 0
+
+logger = logging.getLogger("omero-hrm.retrieve")
 
 # ********************* All the following methods are taken from https://github.com/imcf/hrm-omero ****************
 
 
-def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _fetch_zip_only=False):
+def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _fetch_zip_only=False,
+             image_name=None, skip=()):
     """Upload an image into a specific dataset in OMERO.
     In case we know from the suffix that a given  format is not supported by OMERO, the
     upload will not be initiated at all (e.g. for SVI-HDF5, having the suffix '.h5').
@@ -78,6 +167,10 @@ def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _f
     _fetch_zip_only : bool, optional
         Replaces all parameters to the import call by `--advanced-help`, which is
         **intended for INTERNAL TESTING ONLY**. No actual import will be attempted!
+    image_name : str, optional
+        Name of the imported image on OMERO, the file name if omitted.
+    skip : list of str, optional
+        Import steps done by the script instead of the server (`minmax`, `thumbnails`)
     Returns
     -------
     hrm_omero.misc.OmeroId
@@ -98,7 +191,7 @@ def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _f
 
     if dataset_id.obj_type != "Dataset":
         msg = "Currently only the upload to 'Dataset' objects is supported!"
-        print(msg)
+        logger.error("%s", msg)
         raise ValueError(msg)
 
     # we have to create the annotations *before* we actually upload the image
@@ -132,18 +225,23 @@ def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _f
                    "--skip", "upgrade"
                    # disable upgrade checks (https://forum.image.sc/t/unable-to-use-cli-importer/26424)
                    ]
+    for step in skip:
+        import_args.extend(["--skip", step])
 
     if omero_logfile:
-        print("WARNING", f"Messages (stderr) from import will go to [{omero_logfile}].")
+        logger.warning("Messages (stderr) from import will go to [%s].", omero_logfile)
         import_args.extend(["--debug", "ALL"])
         import_args.extend(["--errs", omero_logfile])
 
     import_args.extend(["-d", dataset_id.obj_id])
+    if image_name:
+        import_args.extend(["--name", image_name])
 
     # capture stdout and request YAML format to parse the output later on:
+    import tempfile
     tempdir = tempfile.TemporaryDirectory(prefix="hrm-omero__")
     cap_stdout = f"{tempdir.name}/omero-import-stdout"
-    print("DEBUG", f"Capturing stdout of the 'omero' call into [{cap_stdout}]...")
+    logger.debug("Capturing stdout of the 'omero' call into [%s]...", cap_stdout)
     import_args.extend(["--file", cap_stdout])
     import_args.extend(["--output", "yaml"])
 
@@ -154,31 +252,34 @@ def to_omero(conn, cli, host, port, dataset_id, image_file, omero_logfile="", _f
         # calling 'import --advanced-help' will trigger the download of OMERO.java.zip
         # in case it is not yet present (the extract_image_id() call will then fail,
         # resulting in the whole function returning "False")
-        print("WRANING", "As '_fetch_zip_only' is set NO IMPORT WILL BE ATTEMPTED!")
+        logger.warning("As '_fetch_zip_only' is set NO IMPORT WILL BE ATTEMPTED!")
         import_args = ["import", "--advanced-help"]
-    print("DEBUG", f"import_args: {import_args}")
+    logger.debug("import_args: %s", import_args)
     try:
         cli.invoke(import_args, strict=True)
         cli.get_client().closeSession()  # force killing the session
         #cli.close() # see if it doesn't crash
         imported_id = extract_image_id(cap_stdout)
-        print("SUCCESS", f"Imported OMERO image ID: {imported_id}")
+        logger.log(SUCCESS, "Imported OMERO image ID: %s", imported_id)
+    except TRANSIENT_ERRORS:
+        raise
     except PermissionError as err:
-        print("ERROR", err)
+        logger.error("%s", err)
         omero_userdir = os.environ.get("OMERO_USERDIR", "<not-set>")
-        print("ERROR", f"Current OMERO_USERDIR value: {omero_userdir}")
-        print("ERROR",
-              (
-                  "Please make sure to read the documentation about the 'OMERO_USERDIR' "
-                  "environment variable and also check if the file to be imported has "
-                  "appropriate permissions!"
-              ),
-              )
+        logger.error("Current OMERO_USERDIR value: %s", omero_userdir)
+        logger.error(
+            "Please make sure to read the documentation about the 'OMERO_USERDIR' "
+            "environment variable and also check if the file to be imported has "
+            "appropriate permissions!"
+        )
         return None
     except Exception as err:  # pylint: disable-msg=broad-except
-        print("ERROR", f"ERROR: uploading '{image_file}' to {dataset_id} failed!")
-        print("ERROR", f"OMERO error message: >>>{err}<<<")
-        print("WARNING", f"import_args: {import_args}")
+        logger.error("ERROR: uploading '%s' to %s failed!", image_file, dataset_id)
+        logger.error("OMERO error message: >>>%s<<<", err)
+        logger.warning("import_args: %s", import_args)
+        # a lost session is raised as such, so that import_with_retry stops instead of retrying on it
+        if not conn.keepAlive():
+            raise omero.SessionTimeoutException(None, None, f"Session lost while uploading '{image_file}'")
         return None
     finally:
         tempdir.cleanup()
@@ -198,33 +299,101 @@ def attach_log_file(conn, target_id, image_file):
         The path to the image file.
     """
     # get omero object
-    omero_object = conn.getObject(target_id.obj_type, target_id.obj_id)
+    omero_object = object_cache.get(conn, target_id.obj_type, target_id.obj_id, target_id.group)
 
     # get the file to attach
     suffix = ".log.txt"
     if not image_file.endswith(suffix):
         candidate = parse_job_basename(image_file) + suffix
         if os.path.exists(candidate):
-            print("DEBUG", f"Found [{candidate}], will use it instead of [{image_file}].")
+            logger.debug("Found [%s], will use it instead of [%s].", candidate, image_file)
             file_to_upload = candidate
         else:
-            print("ERROR", f"The file {candidate} does not exists")
+            logger.error("The file %s does not exists", candidate)
             return
     else:
         file_to_upload = image_file
 
-    print("DEBUG", f"Trying attach [{file_to_upload}] file to {target_id.obj_type} {target_id.obj_id}...")
+    logger.debug("Trying attach [%s] file to %s %s...", file_to_upload, target_id.obj_type, target_id.obj_id)
 
     # create the original file and file annotation (uploads the file etc.)
     namespace = "hrm.deconvolution.log"
-    print("\nCreating an OriginalFile and FileAnnotation")
+    logger.info("Creating an OriginalFile and FileAnnotation")
     file_ann = conn.createFileAnnfromLocalFile(
         file_to_upload, mimetype="text/plain", ns=namespace, desc=None)
 
     # attach the file to the object
-    print("Attaching FileAnnotation to Dataset: ", "File ID:", file_ann.getId(),
-          ",", file_ann.getFile().getName(), "Size:", file_ann.getFile().getSize())
+    logger.info("Attaching FileAnnotation to Dataset:  File ID: %s , %s Size: %s",
+                file_ann.getId(), file_ann.getFile().getName(), file_ann.getFile().getSize())
     omero_object.linkAnnotation(file_ann)
+    # the cached wrapper holds the annotation links loaded before this one
+    object_cache.invalidate(target_id.obj_type, target_id.obj_id)
+
+
+def attach_provenance_archive(conn, target_id, image_file):
+    """Pack the provenance files of an HRM job (log, parameter summary and Huygens batch file) in one compressed
+    archive and attach it to an OMERO object.
+    The archive is uploaded with a single streamed RawFileStore write and linked together with its FileAnnotation,
+    instead of one upload and one link per file.
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        The OMERO connection object.
+    target_id : hrm_omero.misc.OmeroId
+        The ID of the OMERO object that should receive the annotation.
+    image_file : str
+        The path to the image file.
+    Returns
+    -------
+    bool
+        True in case of success, False if there is no provenance file.
+    """
+    basename = parse_job_basename(image_file)
+    files = [basename + suffix for suffix in PROVENANCE_SUFFIXES if os.path.exists(basename + suffix)]
+    if len(files) == 0:
+        logger.error("No provenance file found for [%s]", image_file)
+        return False
+
+    # the text files are small : the archive is compressed in memory
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for path in files:
+            archive.add(path, arcname=os.path.basename(path))
+    data = buffer.getvalue()
+    logger.debug("Packed %s into %s bytes", [os.path.basename(path) for path in files], len(data))
+
+    original_file = model.OriginalFileI()
+    original_file.setName(rstring(os.path.basename(basename) + ".provenance.tar.gz"))
+    original_file.setPath(rstring(os.path.dirname(image_file)))
+    original_file.setMimetype(rstring("application/gzip"))
+    original_file.setSize(rlong(len(data)))
+    original_file.setHash(rstring(hashlib.sha1(data).hexdigest()))
+    original_file.setHasher(model.ChecksumAlgorithmI())
+    original_file.getHasher().setValue(rstring(DEFAULT_HASHER))
+    original_file = conn.getUpdateService().saveAndReturnObject(original_file, conn.SERVICE_OPTS)
+
+    raw_file_store = conn.createRawFileStore()
+    try:
+        raw_file_store.setFileId(original_file.getId().getValue(), conn.SERVICE_OPTS)
+        for offset in range(0, len(data), UPLOAD_CHUNK_BYTES):
+            chunk = data[offset:offset + UPLOAD_CHUNK_BYTES]
+            raw_file_store.write(chunk, offset, len(chunk), conn.SERVICE_OPTS)
+        original_file = raw_file_store.save(conn.SERVICE_OPTS)
+    finally:
+        raw_file_store.close()
+
+    # create the annotation and its link at once
+    file_ann = model.FileAnnotationI()
+    file_ann.setFile(model.OriginalFileI(original_file.getId().getValue(), False))
+    file_ann.setNs(rstring(PROVENANCE_NS))
+    link = getattr(model, f"{target_id.obj_type}AnnotationLinkI")()
+    link.setParent(getattr(model, f"{target_id.obj_type}I")(int(target_id.obj_id), False))
+    link.setChild(file_ann)
+    conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+    object_cache.invalidate(target_id.obj_type, target_id.obj_id)
+    logger.info("Attached %s provenance file(s) (%s bytes compressed) to %s %s", len(files), len(data),
+                target_id.obj_type, target_id.obj_id)
+    return True
 
 
 def extract_image_id(fname):
@@ -239,22 +408,159 @@ def extract_image_id(fname):
         The OMERO ID of the newly imported image, e.g. `1568386` or `None` in case
         parsing the file failed for any reason.
     """
+    import yaml
+
     try:
         with open(fname, "r", encoding="utf-8") as stream:
             parsed = yaml.safe_load(stream)
         if len(parsed[0]["Image"]) != 1:
             msg = f"Unexpected YAML retrieved from OMERO, unable to parse:\n{parsed}"
-            print("ERROR", msg)
+            logger.error("%s", msg)
             raise SyntaxError(msg)
         image_id = parsed[0]["Image"][0]
     except Exception as err:  # pylint: disable-msg=broad-except
-        print("ERROR", f"Error parsing imported image ID from YAML output: {err}")
+        logger.error("Error parsing imported image ID from YAML output: %s", err)
         return None
 
-    print("SUCCESS", f"Successfully parsed Image ID from YAML: {image_id}")
+    logger.log(SUCCESS, "Successfully parsed Image ID from YAML: %s", image_id)
     return image_id
 
 
+def upload_file_chunks(uploader, path, owner=None):
+    """Write a file to the RawFileStore of an import process by chunks, keeping several writes in flight,
+    and compute its SHA1 on the way. Each chunk read is accounted to the throttle of the HRM-Share folder.
+    Parameters
+    ----------
+    uploader : omero.api.RawFileStorePrx
+        The uploader returned by `ImportProcess.getUploader()`
+    path : str
+        Path of the file to upload
+    owner : str, optional
+        User whose bandwidth limits apply to the reads
+    Returns
+    -------
+    str
+        The SHA1 of the file, as expected by `ImportProcess.verifyUpload()`
+    """
+    # Ice marshals the chunk before begin_write() returns, so the buffer is reused at once
+    if not hasattr(upload_buffers, "buffer"):
+        upload_buffers.buffer = bytearray(UPLOAD_CHUNK_BYTES)
+    view = memoryview(upload_buffers.buffer)
+    digest = hashlib.sha1()
+    pending = deque()
+    offset = 0
+    try:
+        throttle.consume(owner, n_ops=1)
+        with open(path, "rb", buffering=0) as stream:
+            n_read = stream.readinto(view)
+            while n_read:
+                throttle.consume(owner, n_read)
+                chunk = view[:n_read]
+                digest.update(chunk)
+                pending.append(uploader.begin_write(chunk, offset, n_read))
+                offset += n_read
+                if len(pending) >= UPLOAD_WRITES_IN_FLIGHT:
+                    uploader.end_write(pending.popleft())
+                n_read = stream.readinto(view)
+        if offset == 0:
+            # touch empty files
+            uploader.write(b"", 0, 0)
+    finally:
+        while pending:
+            uploader.end_write(pending.popleft())
+        uploader.close()
+    return digest.hexdigest()
+
+
+def import_with_python(conn, dataset_id, image_file, image_name=None, skip=()):
+    """Import an image into a dataset through the ManagedRepository import process, without the Java importer.
+    The files of the image are uploaded in parallel with chunked RawFileStore writes, then the server-side import
+    is awaited and the image ID is read from the import response.
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        The OMERO connection object.
+    dataset_id : hrm_omero.misc.OmeroId
+        The ID of the target dataset in OMERO.
+    image_file : str
+        The local image file including the full path.
+    image_name : str, optional
+        Name of the image in OMERO, the file name if not set.
+    skip : list of str, optional
+        Import steps done by the script instead of the server (`minmax`, `thumbnails`)
+    Returns
+    -------
+    hrm_omero.misc.OmeroId
+        The ID of the newly imported image, None otherwise.
+    """
+    import omero.cmd
+    from omero.callbacks import CmdCallbackI
+    from omero.grid import ImportSettings
+    from omero.model import ChecksumAlgorithmI, DatasetI, FilesetEntryI, FilesetI, NamedValue, UploadJobI
+    from omero.rtypes import rbool
+    from omero_version import omero_version
+
+    if dataset_id.obj_type != "Dataset":
+        msg = "Currently only the upload to 'Dataset' objects is supported!"
+        logger.error("%s", msg)
+        raise ValueError(msg)
+
+    files = get_import_files(image_file)
+    fileset = FilesetI()
+    for path in files:
+        entry = FilesetEntryI()
+        entry.setClientPath(rstring(os.path.abspath(path)))
+        fileset.addFilesetEntry(entry)
+    upload_job = UploadJobI()
+    upload_job.setVersionInfo([NamedValue("omero.version", omero_version), NamedValue("os.name", sys.platform)])
+    fileset.linkJob(upload_job)
+
+    settings = ImportSettings()
+    settings.doThumbnails = rbool("thumbnails" not in skip)
+    settings.noStatsInfo = rbool("minmax" in skip)
+    settings.userSpecifiedTarget = DatasetI(int(dataset_id.obj_id), False)
+    settings.userSpecifiedName = rstring(image_name) if image_name else None
+    settings.userSpecifiedDescription = None
+    settings.userSpecifiedAnnotationList = None
+    settings.userSpecifiedPixels = None
+    settings.checksumAlgorithm = ChecksumAlgorithmI()
+    settings.checksumAlgorithm.value = rstring("SHA1-160")
+
+    client = conn.c
+    owner = conn.getUser().getOmeName()
+    try:
+        # import in the group of the target dataset
+        process = client.getManagedRepository().importFileset(fileset, settings, {"omero.group": str(dataset_id.group)})
+        try:
+            with ThreadPoolExecutor(max_workers=len(files)) as executor:
+                hashes = list(executor.map(lambda index: upload_file_chunks(process.getUploader(index), files[index],
+                                                                            owner), range(len(files))))
+            callback = CmdCallbackI(client, process.verifyUpload(hashes))
+            try:
+                while not callback.block(IMPORT_POLL_MS):
+                    logger.debug("Waiting for the import of [%s]...", image_file)
+                response = callback.getResponse()
+            finally:
+                callback.close(True)
+        finally:
+            process.close()
+        if isinstance(response, omero.cmd.ERR) or len(response.pixels) == 0:
+            raise omero.ServerError(None, None, f"Import of '{image_file}' failed : {response}")
+        imported_id = response.pixels[0].getImage().getId().getValue()
+        logger.log(SUCCESS, "Imported OMERO image ID: %s", imported_id)
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception as err:  # pylint: disable-msg=broad-except
+        logger.error("ERROR: uploading '%s' to %s failed!", image_file, dataset_id)
+        logger.error("OMERO error message: >>>%s<<<", err)
+        # a lost session is raised as such, so that import_with_retry stops instead of retrying on it
+        if not conn.keepAlive():
+            raise omero.SessionTimeoutException(None, None, f"Session lost while uploading '{image_file}'")
+        return None
+
+    return OmeroId(f"G:{dataset_id.group}:Image:{imported_id}")
+
+
 def add_annotation_key_value(conn, omero_id_obj, annotation):
     """Add a key-value "map" annotation to an OMERO object.
     Parameters
@@ -274,15 +580,15 @@ def add_annotation_key_value(conn, omero_id_obj, annotation):
     RuntimeError
         Raised in case re-establishing the OMERO connection fails.
     """
-    print("TRACE", f"Adding a map annotation to {omero_id_obj}")
+    logger.log(TRACE, "Adding a map annotation to %s", omero_id_obj)
 
     if omero_id_obj is None:
-        print("ERROR", f"{omero_id_obj} is not a valid ID in OMERO!")
+        logger.error("%s is not a valid ID in OMERO!", omero_id_obj)
         return False
 
-    target_obj = conn.getObject(omero_id_obj.obj_type, omero_id_obj.obj_id)
+    target_obj = object_cache.get(conn, omero_id_obj.obj_type, omero_id_obj.obj_id, omero_id_obj.group)
     if target_obj is None:
-        print("ERROR", f"Unable to identify target object {omero_id_obj.obj_id} in OMERO!")
+        logger.error("Unable to identify target object %s in OMERO!", omero_id_obj.obj_id)
         return False
 
     for section in annotation:
@@ -292,13 +598,208 @@ def add_annotation_key_value(conn, omero_id_obj, annotation):
         map_ann.setNs(namespace)
         map_ann.save()
         target_obj.linkAnnotation(map_ann)
-        print("DEBUG", f"Added key-value annotation using namespace [{namespace}].")
+        logger.debug("Added key-value annotation using namespace [%s].", namespace)
+    object_cache.invalidate(omero_id_obj.obj_type, omero_id_obj.obj_id)
 
-    print("SUCCESS", f"Added annotation to {target_obj.getId()} : {annotation}")
+    logger.log(SUCCESS, "Added annotation to %s : %s", target_obj.getId(), annotation)
 
     return True
 
 
+def flatten_summary(summary):
+    """Flatten the sections of a parameter summary into one table row.
+    Column names are made of letters, digits and underscores, so that they can be used in table queries
+    (e.g. `Number_of_iterations > 40`).
+    Parameters
+    ----------
+    summary : dict(dict)
+        The parameter summary as returned by `parse_summary()`.
+    Returns
+    -------
+    tuple (dict, dict)
+        The row {column name:value} and the descriptions {column name:"section - parameter"} of its columns.
+    """
+    row = {}
+    descriptions = {}
+    for section, pairs in summary.items():
+        for key, value in pairs.items():
+            name = column_name(key)
+            if name in row:
+                name = column_name(f"{section} {key}")
+            row[name] = value
+            descriptions[name] = f"{section} - {key}"
+    return row, descriptions
+
+
+def column_name(text):
+    """Convert a parameter name into a valid column name, e.g. `X pixel size (µm)` into `X_pixel_size_um`"""
+    name = re.sub(r"[^0-9a-zA-Z]+", "_", text.replace("µ", "u").replace("μ", "u")).strip("_")
+    return name if name and not name[0].isdigit() else f"p_{name}"
+
+
+def is_number(value):
+    """Check if a parameter value can be stored in a numeric column"""
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def build_parameter_columns(rows, descriptions, headers=None):
+    """Build the OMERO.tables columns holding the given rows.
+    Parameters
+    ----------
+    rows : list of dict
+        Rows {column name:value}, each one with an `Image` (image ID) and an `Image_name` entry
+    descriptions : dict
+        Descriptions {column name:description} of the parameter columns
+    headers : list of ``omero.grid.Column``, optional
+        Columns of an existing table. Without headers, a numeric column is created for each parameter whose values
+        are all numbers and a string column otherwise.
+    Returns
+    -------
+    list of ``omero.grid.Column``
+        Columns filled with the rows, None if the rows do not fit in the given headers (new parameters, text in a
+        numeric column or string longer than the column size)
+    """
+    from omero.grid import DoubleColumn, ImageColumn, StringColumn
+
+    if headers is None:
+        headers = [ImageColumn("Image", "Deconvolved image", []), StringColumn("Image_name", "", 0, [])]
+        for name in sorted({name for row in rows for name in row} - {"Image", "Image_name"}):
+            values = [row[name] for row in rows if row.get(name, "") != ""]
+            if all(is_number(value) for value in values):
+                headers.append(DoubleColumn(name, descriptions.get(name, ""), []))
+            else:
+                headers.append(StringColumn(name, descriptions.get(name, ""), 0, []))
+        for header in headers:
+            if isinstance(header, StringColumn):
+                header.size = max([len(str(row.get(header.name, "")).encode("utf-8")) for row in rows] +
+                                  [STRING_COLUMN_MIN_SIZE])
+    elif any(name not in {header.name for header in headers} for row in rows for name in row):
+        return None
+
+    for header in headers:
+        values = [row.get(header.name, "") for row in rows]
+        if isinstance(header, ImageColumn):
+            header.values = [int(value) for value in values]
+        elif isinstance(header, DoubleColumn):
+            if not all(value == "" or is_number(value) for value in values):
+                return None
+            header.values = [float("nan") if value == "" else float(value) for value in values]
+        else:
+            header.values = [str(value) for value in values]
+            if any(len(value.encode("utf-8")) > header.size for value in header.values):
+                return None
+    return headers
+
+
+def save_parameters_table(conn, dataset_id, rows, descriptions):
+    """Append the parameters of the imported images, in one batch, to the OMERO.table attached to the dataset.
+    The table is created at the first import in the dataset, and rewritten with its previous rows when new
+    parameters (columns) appear.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection, in the group of the dataset.
+    dataset_id : str
+        ID of the dataset
+    rows : list of dict
+        Rows {column name:value} to append, as built by `flatten_summary()` with the image ID and name
+    descriptions : dict
+        Descriptions {column name:description} of the parameter columns
+    Returns
+    -------
+    int
+        Number of rows added to the table.
+    """
+    from omero.grid import DoubleColumn
+
+    ctx = conn.SERVICE_OPTS
+    resources = conn.getSharedResources()
+    dataset = object_cache.get(conn, "Dataset", dataset_id)
+    if dataset is None:
+        logger.error("Unable to identify dataset %s in OMERO!", dataset_id)
+        return 0
+
+    # append the rows to the existing table, if they fit in its columns
+    previous_file_ann = next(iter(dataset.listAnnotations(ns=PARAMETERS_TABLE_NS)), None)
+    if previous_file_ann is not None:
+        table = resources.openTable(model.OriginalFileI(previous_file_ann.getFile().getId(), False), ctx)
+        try:
+            headers = table.getHeaders()
+            columns = build_parameter_columns(rows, descriptions, headers)
+            if columns is not None:
+                table.addData(columns)
+                logger.debug("Appended %s rows to the parameters table of dataset %s", len(rows), dataset_id)
+                return len(rows)
+
+            # new parameters : read the previous rows to rewrite the table
+            n_previous_rows = table.getNumberOfRows()
+            data = table.read(list(range(len(headers))), 0, n_previous_rows)
+        finally:
+            table.close()
+        previous_rows = [{} for _ in range(n_previous_rows)]
+        for column in data.columns:
+            descriptions.setdefault(column.name, column.description)
+            for previous_row, value in zip(previous_rows, column.values):
+                if not (isinstance(column, DoubleColumn) and value != value):  # NaN for a missing value
+                    previous_row[column.name] = value
+        rows = previous_rows + rows
+        logger.info("New parameters in dataset %s : rewriting its parameters table (%s rows)", dataset_id,
+                    len(rows))
+
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, PARAMETERS_TABLE_NAME, ctx)
+    if table is None:
+        raise RuntimeError("OMERO.tables is not available on the server")
+    try:
+        columns = build_parameter_columns(rows, descriptions)
+        table.initialize(columns)
+        table.addData(columns)
+        original_file = table.getOriginalFile()
+    finally:
+        table.close()
+
+    file_ann = model.FileAnnotationI()
+    file_ann.setFile(model.OriginalFileI(original_file.getId().getValue(), False))
+    file_ann.setNs(rstring(PARAMETERS_TABLE_NS))
+    link = model.DatasetAnnotationLinkI()
+    link.setParent(model.DatasetI(int(dataset_id), False))
+    link.setChild(file_ann)
+    conn.getUpdateService().saveObject(link, ctx)
+    if previous_file_ann is not None:
+        conn.deleteObjects("FileAnnotation", [previous_file_ann.getId()], wait=True)
+    object_cache.invalidate("Dataset", dataset_id)
+    logger.debug("Wrote %s rows to the parameters table of dataset %s", len(rows), dataset_id)
+    return len(rows)
+
+
+def save_parameters_tables(group_connections):
+    """Append the collected parameters to the table of each dataset, one batch per dataset.
+    Parameters
+    ----------
+    group_connections : dict
+        Opened connections {(owner, group_id):connection}
+    Returns
+    -------
+    tuple (int, int)
+        Number of rows added and number of updated tables.
+    """
+    n_rows = 0
+    n_tables = 0
+    for (owner, group_id, dataset_id), rows in parameter_rows.items():
+        # a failed batch is not retried, as its rows may have been partially written
+        try:
+            n_rows += save_parameters_table(group_connections[(owner, group_id)], dataset_id, rows,
+                                            parameter_descriptions)
+            n_tables += 1
+        except Exception as err:  # pylint: disable-msg=broad-except
+            logger.error("Fail saving the parameters table of dataset %s : %s", dataset_id, err)
+    return n_rows, n_tables
+
+
 def add_tags(conn, target_img_id_obj, dataset_id_obj):
     """Add tags annotation to an OMERO object.
     Parameters
@@ -314,22 +815,23 @@ def add_tags(conn, target_img_id_obj, dataset_id_obj):
     bool
         True in case of success, False otherwise.
     """
-    print("TRACE", f"Adding a tags to {target_img_id_obj}")
+    logger.log(TRACE, "Adding a tags to %s", target_img_id_obj)
 
     if target_img_id_obj is None:
-        print("ERROR", f"{target_img_id_obj} is not a valid ID in OMERO!")
+        logger.error("%s is not a valid ID in OMERO!", target_img_id_obj)
         return False
 
-    target_img_obj = conn.getObject(target_img_id_obj.obj_type, target_img_id_obj.obj_id)
+    target_img_obj = object_cache.get(conn, target_img_id_obj.obj_type, target_img_id_obj.obj_id,
+                                      target_img_id_obj.group)
     if target_img_obj is None:
-        print("ERROR", f"Unable to identify target object {target_img_id_obj.obj_id} in OMERO!")
+        logger.error("Unable to identify target object %s in OMERO!", target_img_id_obj.obj_id)
         return False
 
     deconvolved_img_name = target_img_obj.getName()
-    dataset_obj = conn.getObject(dataset_id_obj.obj_type, dataset_id_obj.obj_id)
+    dataset_obj = object_cache.get(conn, dataset_id_obj.obj_type, dataset_id_obj.obj_id, dataset_id_obj.group)
     img_base_name = parse_image_basename(deconvolved_img_name)
     raw_img_obj = None
-    print("INFO", f"Image base name :  {img_base_name}")
+    logger.info("Image base name :  %s", img_base_name)
 
     # get the raw image
     for dataset_image_obj in dataset_obj.listChildren():
@@ -357,16 +859,16 @@ def add_tags(conn, target_img_id_obj, dataset_id_obj):
             if not raw_img_tag_obj.getTextValue().lower() == raw_tag_value.lower():
                 target_img_obj.linkAnnotation(raw_img_tag_obj)
                 raw_img_tag_value_list.append(raw_img_tag_obj.getTextValue())
-        print("INFO", f"Transfer the following tags from raw to deconvolved image : {raw_img_tag_value_list}")
+        logger.info("Transfer the following tags from raw to deconvolved image : %s", raw_img_tag_value_list)
 
         # create raw tag
         tag_list = [raw_tag_value, hrm_tag_value]
-        print("INFO", f"Adding the following tag to the raw image : {tag_list}")
+        logger.info("Adding the following tag to the raw image : %s", tag_list)
         check_existence_and_add_tag_objs(conn, tag_list, raw_img_obj, raw_img_tag_obj_list)
 
     # create deconvolved tag
     tag_list = [deconvolved_tag_value, hrm_tag_value]
-    print("INFO", f"Adding the following tag to the deconvolved image : {tag_list}")
+    logger.info("Adding the following tag to the deconvolved image : %s", tag_list)
     check_existence_and_add_tag_objs(conn, tag_list, target_img_obj)
 
     return True
@@ -397,11 +899,11 @@ def check_existence_and_add_tag_objs(conn, tag_value_list, target_obj, reference
         for group_tag_obj in group_tag_obj_list:
             if tag_value.lower() == group_tag_obj.getTextValue().lower():
                 new_tag_obj = group_tag_obj
-                print("INFO", f"Tag {tag_value.lower()} already exists in the DB")
+                logger.debug("Tag %s already exists in the DB", tag_value)
                 break
         # if the tag doesn't exist yet, create it
         if new_tag_obj is None:
-            print("INFO", f"Tag {tag_value.lower()} doesn't exist in the DB ; create it")
+            logger.debug("Tag %s doesn't exist in the DB ; create it", tag_value)
             new_tag_obj = TagAnnotationWrapper(conn)
             new_tag_obj.setValue(tag_value)
             new_tag_obj.save()
@@ -411,12 +913,14 @@ def check_existence_and_add_tag_objs(conn, tag_value_list, target_obj, reference
             # if the tag is already link to the target, don't link it twice
             if reference_tag_obj.getTextValue().lower() == new_tag_obj.getTextValue().lower():
                 to_link = False
-                print("INFO", f"Tag {tag_value.lower()} already linked to {type(target_obj)} : {target_obj.getId()}")
+                logger.debug("Tag %s already linked to %s : %s", tag_value, type(target_obj), target_obj.getId())
                 break
         # link the tag
         if to_link:
-            print("INFO", f"Link tag {tag_value.lower()} to {type(target_obj)} : {target_obj.getId()}")
+            logger.debug("Link tag %s to %s : %s", tag_value, type(target_obj), target_obj.getId())
             target_obj.linkAnnotation(new_tag_obj)
+    # the tags transferred by the caller are linked to the same wrapper
+    object_cache.invalidate(target_obj.OMERO_CLASS, target_obj.getId())
 
 
 def parse_summary(fname):
@@ -482,32 +986,33 @@ def parse_summary(fname):
     if not fname.endswith(suffix):
         candidate = parse_job_basename(fname) + ".parameters.txt"
         if os.path.exists(candidate):
-            print("DEBUG", f"Found [{candidate}], will use it instead of [{fname}].")
+            logger.debug("Found [%s], will use it instead of [%s].", candidate, fname)
             fname = candidate
-    print("DEBUG", f"Trying to parse job parameter summary file [{fname}]...")
+    logger.debug("Trying to parse job parameter summary file [%s]...", fname)
+    from bs4 import BeautifulSoup
 
     try:
         with open(fname, "r", encoding="utf-8") as soupfile:
             soup = BeautifulSoup(soupfile, features="html.parser")
-            print("TRACE", f"BeautifulSoup successfully parsed [{fname}].")
+            logger.log(TRACE, "BeautifulSoup successfully parsed [%s].", fname)
     except IOError as err:
-        print("ERROR", f"Unable to open parameter summary file [{fname}]: {err}")
+        logger.error("Unable to open parameter summary file [%s]: %s", fname, err)
         return None
     except Exception as err:  # pragma: no cover  # pylint: disable-msg=broad-except
-        print("ERROR", f"Parsing summary file [{fname}] failed: {err}")
+        logger.error("Parsing summary file [%s] failed: %s", fname, err)
         return None
 
     sections = {}  # job parameter summaries have multiple sections split by headers
     rows = []
     for table in soup.findAll("table"):
-        print("TRACE", "Parsing table header...")
+        logger.log(TRACE, "Parsing table header...")
         try:
             rows = table.findAll("tr")
             header = rows[0].findAll("td", class_="header")[0].text
         except Exception:  # pylint: disable-msg=broad-except
-            print("DEBUG", "Skipping table entry that doesn't have a header.")
+            logger.debug("Skipping table entry that doesn't have a header.")
             continue
-        print("TRACE", f"Parsed table header: {header}")
+        logger.log(TRACE, "Parsed table header: %s", header)
         if header in sections:
             raise KeyError(f"Error parsing parameters, duplicate header: {header}")
 
@@ -517,7 +1022,7 @@ def parse_summary(fname):
             cols = row.findAll("td")
             # parse the parameter "name":
             param_key = cols[0].text
-            print("TRACE", f"Parsed (raw) key name: {param_key}")
+            logger.log(TRACE, "Parsed (raw) key name: %s", param_key)
             # replace HTML-encoded chars:
             param_key = param_key.replace("&mu;m", "µm")
 
@@ -538,7 +1043,7 @@ def parse_summary(fname):
             pairs[param_key] = param_value
         sections[header] = pairs
 
-    print("SUCCESS", f"Processed {len(rows)} table rows.")
+    logger.log(SUCCESS, "Processed %s table rows.", len(rows))
     return sections
 
 
@@ -564,9 +1069,9 @@ def parse_job_basename(file_name):
         `_abcdef0123456_hrm` or `_f435a27b9c85e_hrm`) is removed. In case the input
         string does *not* contain a matching section it is returned
     """
-    print("TRACE", f"parse_job_basename - full name : {file_name}")
+    logger.log(TRACE, "parse_job_basename - full name : %s", file_name)
     basename = re.sub(r"(_[0-9a-f]{13}_hrm)\..*", r"\1", file_name)
-    print("TRACE", f"parse_job_basename - HRM base name : {basename}")
+    logger.log(TRACE, "parse_job_basename - HRM base name : %s", basename)
 
     return basename
 
@@ -585,11 +1090,11 @@ def parse_image_basename(file_name):
         `_abcdef0123456_hrm` or `_f435a27b9c85e_hrm`) is removed, including the job name itself. It
         only remains the raw image name without the original extension.
     """
-    print("TRACE", f"parse_image_basename - full name : {file_name}")
+    logger.log(TRACE, "parse_image_basename - full name : %s", file_name)
     hrm_name = re.search(r"(_[0-9a-f]{13}_hrm)\..*", file_name)
-    print("TRACE", f"parse_image_basename - HRM job name : {hrm_name.group(0)}")
+    logger.log(TRACE, "parse_image_basename - HRM job name : %s", hrm_name.group(0))
     basename = file_name.replace(hrm_name.group(0), "")
-    print("TRACE", f"parse_image_basename - Raw image basename : {basename}")
+    logger.log(TRACE, "parse_image_basename - Raw image basename : %s", basename)
 
     return basename
 
@@ -635,12 +1140,12 @@ class OmeroId:
         ValueError
             Raised in case a malformed `id_str` was given.
         """
-        print("TRACE", f"Parsing ID string: [{id_str}]")
+        logger.log(TRACE, "Parsing ID string: [%s]", id_str)
         if id_str == "ROOT":
             self.group = -1
             self.obj_type = "BaseTree"
             self.obj_id = -1
-            print("DEBUG", f"Converted special ID 'ROOT' to [{str(self)}].")
+            logger.debug("Converted special ID 'ROOT' to [%s].", self)
             return
 
         try:
@@ -664,7 +1169,7 @@ class OmeroId:
             msg = f"Malformed id_str '{id_str}', expecting `G:[gid]:[type]:[oid]`."
             raise ValueError(msg, err)
 
-        print("DEBUG", f"Validated ID string: group={group_id}, {obj_type}={obj_id}")
+        logger.debug("Validated ID string: group=%s, %s=%s", group_id, obj_type, obj_id)
         self.group = group_id
         self.obj_type = obj_type
         self.obj_id = obj_id
@@ -716,7 +1221,52 @@ def create_dataset(conn, dataset_name, description=None):
     return dataset.getId()
 
 
-def list_images_to_upload(conn, owner, root):
+@contextmanager
+def group_context(conn, group_id):
+    """Temporarily switch the group context of a connection.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    group_id : int or str
+        ID of the group, `-1` for all the groups of the user
+    """
+    previous_group_id = conn.SERVICE_OPTS.getOmeroGroup()
+    conn.SERVICE_OPTS.setOmeroGroup(group_id)
+    try:
+        yield conn
+    finally:
+        if previous_group_id is None:
+            conn.SERVICE_OPTS.pop("omero.group", None)
+        else:
+            conn.SERVICE_OPTS.setOmeroGroup(previous_group_id)
+
+
+def get_dataset_groups(conn, dataset_ids):
+    """Resolve the group of the given datasets in a single query, across all groups.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    dataset_ids : iterable of int or str
+        IDs of the datasets
+    Returns
+    -------
+    dict
+        dictionary {dataset_id:(group_id, group_name)}, without the datasets that cannot be found
+    """
+    dataset_ids = {int(dataset_id) for dataset_id in dataset_ids}
+    if len(dataset_ids) == 0:
+        return {}
+    params = omero.sys.ParametersI()
+    params.addIds(list(dataset_ids))
+    rows = conn.getQueryService().projection(
+        "select d.id, g.id, g.name from Dataset d join d.details.group g where d.id in (:ids)",
+        params, {"omero.group": "-1"})
+    return {row[0].val: (row[1].val, row[2].val) for row in rows}
+
+
+def list_images_to_upload(conn, owner, root, create_orphaned_dataset=True):
     """List images to upload on OMERO from Deconvolution/omero HRM folder.
     Parameters
     ----------
@@ -726,6 +1276,8 @@ def list_images_to_upload(conn, owner, root):
         Name of the current logged in user
     root : str
         absolute path of HRM-Share folder (from the root mounted on the server)
+    create_orphaned_dataset : bool, optional
+        Create the `HRM-<date>` dataset receiving orphaned images. Otherwise, their dataset ID is -1.
     Returns
     -------
     image_path_dataset_id_map : dict
@@ -737,12 +1289,14 @@ def list_images_to_upload(conn, owner, root):
     """
     image_path_dataset_id_map = {}
     n_initial_images = 0
+    # a single dataset for all orphaned images, created with the first one
+    orphaned_dataset_id = None
 
     if os.path.isdir(root):
         owner_folder = os.path.join(root, owner)
         if not os.path.isdir(owner_folder):
-            print("You don't have an active account on HRM. Please go on https://hrm-biop.epfl.ch/ and sign in to HRM")
-            print("If you do not have any HRM account, please go on https://hrm-biop.epfl.ch/ and ask for an HRM account")
+            logger.info("You don't have an active account on HRM. Please go on https://hrm-biop.epfl.ch/ and sign in to HRM")
+            logger.info("If you do not have any HRM account, please go on https://hrm-biop.epfl.ch/ and ask for an HRM account")
             return None, owner_folder, -1
 
         deconvolved_folder = os.path.join(owner_folder, "Deconvolved")
@@ -777,33 +1331,41 @@ def list_images_to_upload(conn, owner, root):
                     return None, dataset_folder, -1
 
                 # images within a dsataset
-                if not dataset_name == "None":
+                if not (dataset_name == "None" or dataset_name.startswith(PLATE_FOLDER_PREFIX)):
                     d_name_split = dataset_name.split("_")
                     dataset_id = d_name_split[0]
-
-                    dataset = conn.getObject('Dataset', dataset_id)
+                    project_id = project_name.split("_")[0]
+
+                    # the dataset may belong to any group of the user
+                    with group_context(conn, '-1'):
+                        dataset = conn.getObject('Dataset', dataset_id) if dataset_id.isdigit() else None
+                        # the folder of a dataset is in the folder of its project : any other folder with an ID
+                        # (e.g. a plate sent before screen and plate folders were prefixed) is not a dataset
+                        if dataset is not None and project_name != "None" and \
+                                project_id not in [str(project.getId()) for project in dataset.listParents()]:
+                            logger.warning("[%s] is not the folder of dataset %s (not in project %s) ; "
+                                           "its images are not imported", dataset_folder, dataset_id, project_id)
+                            dataset = None
+                        if dataset is not None:
+                            # kept for the stages of the imports, in the group of the dataset
+                            object_cache.put(dataset)
+                        dataset_image_names = set() if dataset is None \
+                            else {ex_image.getName() for ex_image in dataset.listChildren()}
                     if dataset is not None:
                         for fileset_name in os.listdir(dataset_folder):
                             fileset_folder = os.path.join(dataset_folder, fileset_name)
                             for image_name in os.listdir(fileset_folder):
                                 # filter only ids images
                                 if ".ids" in image_name:  # .ids
-                                    already_existing_image = False
                                     n_initial_images += 1
-                                    dataset_images = dataset.listChildren()
 
                                     # filter image that does not already exist in omero
-                                    for ex_image in dataset_images:
-                                        if ex_image.getName() == image_name:
-                                            already_existing_image = True
-                                            break
+                                    already_existing_image = image_name in dataset_image_names
 
                                     if not already_existing_image:
                                         image_path_dataset_id_map[os.path.join(fileset_folder, image_name)] = dataset_id
-                # orphaned images
+                # orphaned images and plate images
                 else:
-                    dataset_created = False
-                    orphaned_dataset_id = -1
                     for fileset_name in os.listdir(dataset_folder):
                         fileset_folder = os.path.join(dataset_folder, fileset_name)
                         for image_name in os.listdir(fileset_folder):
@@ -811,9 +1373,9 @@ def list_images_to_upload(conn, owner, root):
                             if ".ids" in image_name:  # .ids
                                 n_initial_images += 1
                                 # create a new for orphaned images
-                                if not dataset_created:
-                                    orphaned_dataset_id = create_dataset(conn, f"HRM-{date.today()}")
-                                    dataset_created = True
+                                if orphaned_dataset_id is None:
+                                    orphaned_dataset_id = create_dataset(conn, f"HRM-{date.today()}") \
+                                        if create_orphaned_dataset else -1
                                 image_path_dataset_id_map[os.path.join(fileset_folder, image_name)] = orphaned_dataset_id
 
         return image_path_dataset_id_map, None, n_initial_images
@@ -821,11 +1383,13 @@ def list_images_to_upload(conn, owner, root):
         return None, root, -1
 
 
-def delete_uploaded_files(image_path):
+def delete_uploaded_files(image_path, owner=None):
     """Delete image in the deconvolved folder
     ----------
     image_path : str
         Path to image to delete.
+    owner : str, optional
+        Name of the image owner, whose file operations limit applies
     Returns
     -------
     bool
@@ -844,23 +1408,28 @@ def delete_uploaded_files(image_path):
         # check if current path is a file
         file = os.path.join(parent_folder, path)
         if os.path.isfile(file) and ((image_name_without_ext in file) or (".DS_Store" in file) or ("Thumbs.db" in file)):
-            print("INFO", f"Delete file [{file}]")
+            logger.info("Delete file [%s]", file)
+            throttle.consume(owner, n_ops=1)
             os.remove(file)
 
     if len(os.listdir(parent_folder)) == 0:
         parent_parent_folder = os.path.abspath(os.path.join(parent_folder, os.pardir))
-        print("INFO", f"Delete parent directory [{parent_folder}]")
+        logger.info("Delete parent directory [%s]", parent_folder)
+        throttle.consume(owner, n_ops=1)
         os.rmdir(parent_folder)
         if len(os.listdir(parent_parent_folder)) == 0:
-            print("INFO", f"Delete parent directory [{parent_parent_folder}]")
+            logger.info("Delete parent directory [%s]", parent_parent_folder)
+            throttle.consume(owner, n_ops=1)
             os.rmdir(parent_parent_folder)
 
 
-def delete_raw_files(image_path):
+def delete_raw_files(image_path, owner=None):
     """Delete image
     ----------
     image_path : str
         Path to image to delete.
+    owner : str, optional
+        Name of the image owner, whose file operations limit applies
     Returns
     -------
     bool
@@ -882,18 +1451,1042 @@ def delete_raw_files(image_path):
             # check if current path is a file
             file = os.path.join(parent_folder, path)
             if os.path.isfile(file) and (raw_image_name_without_ext in file):
-                print("INFO", f"Delete file [{file}]")
+                logger.info("Delete file [%s]", file)
+                throttle.consume(owner, n_ops=1)
                 os.remove(file)
 
         if len(os.listdir(parent_folder)) == 0:
             parent_parent_folder = os.path.abspath(os.path.join(parent_folder, os.pardir))
-            print("INFO", f"Delete parent directory [{parent_folder}]")
+            logger.info("Delete parent directory [%s]", parent_folder)
+            throttle.consume(owner, n_ops=1)
             os.rmdir(parent_folder)
+            # the metadata sidecar written next to the fileset folder by the send script
+            sidecar_path = parent_folder + ".json"
+            if os.path.isfile(sidecar_path):
+                logger.info("Delete file [%s]", sidecar_path)
+                throttle.consume(owner, n_ops=1)
+                os.remove(sidecar_path)
             if len(os.listdir(parent_parent_folder)) == 0:
-                print("INFO", f"Delete parent directory [{parent_parent_folder}]")
+                logger.info("Delete parent directory [%s]", parent_parent_folder)
+                throttle.consume(owner, n_ops=1)
                 os.rmdir(parent_parent_folder)
     else:
-        print("WARN", f"The path{parent_folder} does not exist ; raw images are not deleted")
+        logger.warning("The path%s does not exist ; raw images are not deleted", parent_folder)
+
+
+def load_optional_modules():
+    """Import numpy and tifffile the first time the statistics or the conversion stage runs.
+    Missing modules are left to None.
+    """
+    global np, tifffile, optional_modules_loaded
+    if optional_modules_loaded:
+        return
+    try:
+        import numpy
+        np = numpy
+    except ImportError:  # statistics are then left to OMERO
+        pass
+    try:
+        import tifffile as tifffile_module
+        tifffile = tifffile_module
+    except ImportError:  # .ids files are then imported as is
+        pass
+    optional_modules_loaded = True
+
+
+def read_ics_header(ics_path):
+    """Read the header of an ICS v1 file describing the pixels of the corresponding .ids file.
+    Parameters
+    ----------
+    ics_path : str
+        Path of the .ics file
+    Returns
+    -------
+    dict
+        `order` (dimension names, fastest varying first, without `bits`), `sizes` (matching `order`),
+        `scales` (pixel size per dimension name, if known), `dtype` (numpy data type) and `compression`. None if the header cannot be read.
+    """
+    layout = {}
+    representation = {}
+    try:
+        with open(ics_path, "r", encoding="latin-1") as ics_file:
+            for line in ics_file:
+                fields = line.strip().split("\t")
+                if len(fields) < 3:
+                    continue
+                if fields[0] in ["layout", "parameter"]:
+                    layout[fields[1]] = fields[2:]
+                elif fields[0] == "representation":
+                    representation[fields[1]] = " ".join(fields[2:])
+    except IOError as err:
+        logger.error("Unable to open ICS header [%s]: %s", ics_path, err)
+        return None
+
+    try:
+        order = layout["order"]
+        sizes = [int(size) for size in layout["sizes"]]
+        bits = sizes[order.index("bits")]
+    except (KeyError, ValueError) as err:
+        logger.error("Malformed ICS header [%s]: %s", ics_path, err)
+        return None
+
+    # "1 2 3 4" is little endian, "4 3 2 1" big endian
+    byte_order = "<" if representation.get("byte_order", "1").split()[0] == "1" else ">"
+    if representation.get("format", "integer") == "real":
+        kind = "f"
+    elif representation.get("sign", "unsigned") == "signed":
+        kind = "i"
+    else:
+        kind = "u"
+
+    try:
+        scales = [float(scale) for scale in layout.get("scale", [])]
+    except ValueError:
+        scales = []
+
+    return {
+        "order": [dim for dim in order if dim != "bits"],
+        "sizes": [size for dim, size in zip(order, sizes) if dim != "bits"],
+        "scales": {dim: scale for dim, scale in zip(order, scales) if dim != "bits"},
+        "dtype": np.dtype(f"{byte_order}{kind}{bits // 8}"),
+        "compression": representation.get("compression", "uncompressed"),
+    }
+
+
+def memmap_ids(ids_path, header):
+    """Memory-map an .ids file as a (t, c, z, y, x) array, without loading any pixel.
+    Parameters
+    ----------
+    ids_path : str
+        Path of the .ids file
+    header : dict
+        The header returned by `read_ics_header`
+    Returns
+    -------
+    numpy.ndarray
+        A read-only view of the pixels, dimensions ordered as t, c, z, y, x
+    """
+    # ICS lists the fastest varying dimension first, numpy expects it last
+    dims = list(reversed(header["order"]))
+    pixels = np.memmap(ids_path, dtype=header["dtype"], mode="r", shape=tuple(reversed(header["sizes"])))
+    for dim in ["x", "y", "z", "ch", "t"]:
+        if dim not in dims:
+            pixels = pixels[np.newaxis]
+            dims.insert(0, dim)
+    return np.transpose(pixels, [dims.index(dim) for dim in ["t", "ch", "z", "y", "x"]])
+
+
+def iter_ids_channel_chunks(ids_path, header):
+    """Memory-map an .ids file and yield its pixels, channel by channel, in chunks of at most `CHUNK_BYTES`.
+    Parameters
+    ----------
+    ids_path : str
+        Path of the .ids file
+    header : dict
+        The header returned by `read_ics_header`
+    Yields
+    ------
+    tuple (int, numpy.ndarray)
+        Channel index and a chunk of rows of one plane of that channel
+    """
+    pixels = memmap_ids(ids_path, header)
+    for channel in range(pixels.shape[1]):
+        channel_pixels = pixels[:, channel]
+        plane_shape = channel_pixels.shape[-2:]
+        rows_per_chunk = max(1, CHUNK_BYTES // max(1, plane_shape[-1] * header["dtype"].itemsize))
+        for plane_index in np.ndindex(channel_pixels.shape[:-2]):
+            plane = channel_pixels[plane_index]
+            for row in range(0, plane_shape[0], rows_per_chunk):
+                yield channel, np.asarray(plane[row:row + rows_per_chunk])
+
+
+def can_compute_channel_statistics(image_path):
+    """Check that the statistics of an image can be computed by `compute_channel_statistics`, before the server is
+    asked not to compute them at import.
+    Parameters
+    ----------
+    image_path : str
+        Path of the .ids image
+    Returns
+    -------
+    bool
+        True if numpy is available and the .ids file can be memory-mapped, False otherwise.
+    """
+    load_optional_modules()
+    if np is None:
+        logger.warning("numpy is not available ; rendering settings are left to OMERO")
+        return False
+    header = read_ics_header(re.sub(r"\.ids$", ".ics", image_path))
+    if header is None or header["compression"] != "uncompressed":
+        logger.warning("Cannot memory-map [%s] ; rendering settings are left to OMERO", image_path)
+        return False
+    return True
+
+
+def compute_channel_statistics(image_path):
+    """Compute per-channel min, max and rendering window (percentiles) of a deconvolved image.
+    The .ids file is memory-mapped and streamed in bounded chunks: a first pass computes min/max,
+    a second pass fills a histogram from which the percentiles are estimated.
+    Parameters
+    ----------
+    image_path : str
+        Path of the .ids image
+    Returns
+    -------
+    list of dict
+        One dict per channel with `min`, `max`, `start` and `end` values, None if the statistics cannot be computed.
+    """
+    load_optional_modules()
+    if np is None:
+        logger.warning("numpy is not available ; rendering settings are left to OMERO")
+        return None
+
+    ics_path = re.sub(r"\.ids$", ".ics", image_path)
+    header = read_ics_header(ics_path)
+    if header is None or header["compression"] != "uncompressed":
+        logger.warning("Cannot memory-map [%s] ; rendering settings are left to OMERO", image_path)
+        return None
+
+    minima = {}
+    maxima = {}
+    for channel, chunk in iter_ids_channel_chunks(image_path, header):
+        minima[channel] = min(minima.get(channel, chunk.min()), chunk.min())
+        maxima[channel] = max(maxima.get(channel, chunk.max()), chunk.max())
+
+    histograms = {}
+    for channel, chunk in iter_ids_channel_chunks(image_path, header):
+        histogram, _ = np.histogram(chunk, bins=HISTOGRAM_BINS, range=(minima[channel], maxima[channel]))
+        histograms[channel] = histograms.get(channel, 0) + histogram
+
+    statistics = []
+    for channel in sorted(minima):
+        channel_min = float(minima[channel])
+        channel_max = float(maxima[channel])
+        cumulative = np.cumsum(histograms[channel]) / max(1, histograms[channel].sum())
+        bin_width = (channel_max - channel_min) / HISTOGRAM_BINS
+        start, end = [channel_min + bin_width * int(np.searchsorted(cumulative, percentile / 100))
+                      for percentile in RENDERING_PERCENTILES]
+        statistics.append({"min": channel_min, "max": channel_max, "start": start, "end": max(end, start)})
+
+    logger.debug("Channel statistics of [%s] : %s", image_path, statistics)
+    return statistics
+
+
+def save_channel_statistics(conn, image_id_obj, statistics):
+    """Save pre-computed StatsInfo and rendering settings of a newly imported image.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    image_id_obj : OmeroId
+        The ID of the imported image
+    statistics : list of dict
+        The statistics returned by `compute_channel_statistics`
+    Returns
+    -------
+    bool
+        True in case of success, False otherwise.
+    """
+    params = omero.sys.ParametersI()
+    params.addId(image_id_obj.obj_id)
+    pixels = conn.getQueryService().findByQuery(
+        "select p from Pixels p join fetch p.channels c left outer join fetch c.statsInfo where p.image.id = :id",
+        params, conn.SERVICE_OPTS)
+    if pixels is None or pixels.sizeOfChannels() != len(statistics):
+        logger.warning("Channels of image %s do not match the .ids file ; statistics not saved", image_id_obj.obj_id)
+        return False
+
+    channels = pixels.copyChannels()
+    for channel, channel_statistics in zip(channels, statistics):
+        stats_info = channel.getStatsInfo()
+        if stats_info is None:
+            stats_info = model.StatsInfoI()
+            channel.setStatsInfo(stats_info)
+        stats_info.setGlobalMin(rdouble(channel_statistics["min"]))
+        stats_info.setGlobalMax(rdouble(channel_statistics["max"]))
+    conn.getUpdateService().saveArray(channels, conn.SERVICE_OPTS)
+
+    image = object_cache.get(conn, "Image", image_id_obj.obj_id, image_id_obj.group)
+    image.set_active_channels(list(range(1, len(statistics) + 1)),
+                              windows=[[channel_statistics["start"], channel_statistics["end"]]
+                                       for channel_statistics in statistics])
+    # the settings of the owner are the ones shown by the viewers (to the other users as well, until they save
+    # their own) ; they replace the ones made by the import, whose thumbnail is regenerated by OMERO on next request
+    image.saveDefaults()
+    # the wrapper holds the rendering engine used to save the settings
+    object_cache.invalidate("Image", image_id_obj.obj_id)
+    logger.log(SUCCESS, "Saved statistics and rendering settings of image %s", image_id_obj.obj_id)
+    return True
+
+
+def iter_tiles(pixels):
+    """Yield the tiles of all planes of a (t, c, z, y, x) array, in the order expected by `tifffile`.
+    Edge tiles are padded with zeros to `TILE_SIZE`.
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        The (memory-mapped) pixels
+    Yields
+    ------
+    numpy.ndarray
+        A `TILE_SIZE` x `TILE_SIZE` tile
+    """
+    size_y, size_x = pixels.shape[-2:]
+    for plane_index in np.ndindex(pixels.shape[:-2]):
+        plane = pixels[plane_index]
+        for y in range(0, size_y, TILE_SIZE):
+            for x in range(0, size_x, TILE_SIZE):
+                block = plane[y:y + TILE_SIZE, x:x + TILE_SIZE]
+                tile = np.zeros((TILE_SIZE, TILE_SIZE), dtype=pixels.dtype)
+                tile[:block.shape[0], :block.shape[1]] = block
+                yield tile
+
+
+def reserve_scratch_space(n_bytes, scratch_folder, max_scratch_bytes):
+    """Reserve space on the scratch folder for a converted image.
+    Parameters
+    ----------
+    n_bytes : int
+        Space to reserve
+    scratch_folder : str
+        Folder where the converted images are written
+    max_scratch_bytes : int
+        Maximum space used by all converted images at once
+    Returns
+    -------
+    bool
+        True if the space is reserved, False if it would exceed the limit or the free disk space.
+    """
+    global scratch_reserved_bytes
+    with scratch_lock:
+        # the images being converted have not written all their reserved space yet
+        free_bytes = shutil.disk_usage(scratch_folder).free - scratch_reserved_bytes
+        if scratch_reserved_bytes + n_bytes > max_scratch_bytes:
+            logger.info("Max scratch space reached : %.1f GB reserved, %.1f GB more needed, %.1f GB allowed",
+                        scratch_reserved_bytes / 1024 ** 3, n_bytes / 1024 ** 3, max_scratch_bytes / 1024 ** 3)
+            return False
+        if n_bytes > free_bytes:
+            logger.info("Scratch disk full : %.1f GB free once the reservations are written, %.1f GB needed",
+                        free_bytes / 1024 ** 3, n_bytes / 1024 ** 3)
+            return False
+        scratch_reserved_bytes += n_bytes
+        return True
+
+
+def release_scratch_space(n_bytes):
+    """Release space reserved by `reserve_scratch_space`"""
+    global scratch_reserved_bytes
+    with scratch_lock:
+        scratch_reserved_bytes -= n_bytes
+
+
+def convert_to_ome_tiff(image_path, scratch_folder, workers):
+    """Convert an HRM .ics/.ids result into a tiled, compressed and multi-resolution OME-TIFF.
+    The .ids file is memory-mapped and streamed tile by tile, tiles being compressed in parallel,
+    so that only a few tiles are in memory at once.
+    Parameters
+    ----------
+    image_path : str
+        Path of the .ids image
+    scratch_folder : str
+        Folder where the OME-TIFF is written
+    workers : int
+        Number of threads compressing tiles
+    Returns
+    -------
+    str
+        Path of the OME-TIFF file, None if the image cannot be converted.
+    """
+    ics_path = re.sub(r"\.ids$", ".ics", image_path)
+    header = read_ics_header(ics_path)
+    if header is None or header["compression"] != "uncompressed":
+        logger.warning("Cannot memory-map [%s] ; it is imported as is", image_path)
+        return None
+
+    pixels = memmap_ids(image_path, header)
+    # keep the .ids name so that the image can be recognized as already uploaded
+    ome_tiff_path = os.path.join(scratch_folder, os.path.basename(image_path) + ".ome.tif")
+    metadata = {"axes": "TCZYX"}
+    for dim, ome_key in [("x", "PhysicalSizeX"), ("y", "PhysicalSizeY"), ("z", "PhysicalSizeZ")]:
+        if header["scales"].get(dim):
+            metadata[ome_key] = header["scales"][dim]
+            metadata[ome_key + "Unit"] = "µm"
+
+    levels = [pixels]
+    while max(levels[-1].shape[-2:]) > TILE_SIZE:
+        levels.append(levels[-1][..., ::2, ::2])
+
+    start = time.time()
+    options = {"tile": (TILE_SIZE, TILE_SIZE), "compression": "zlib", "photometric": "minisblack",
+               "maxworkers": workers}
+    with tifffile.TiffWriter(ome_tiff_path, bigtiff=True, ome=True) as tif:
+        tif.write(iter_tiles(pixels), shape=pixels.shape, dtype=pixels.dtype, subifds=len(levels) - 1,
+                  metadata=metadata, **options)
+        for level in levels[1:]:
+            tif.write(iter_tiles(level), shape=level.shape, dtype=level.dtype, subfiletype=1, **options)
+    duration = max(time.time() - start, 1e-6)
+
+    logger.info("Converted [%s] to pyramidal OME-TIFF (%s level(s)) : %.1f MB in %.1f s (%.1f MB/s)",
+                image_path, len(levels), pixels.nbytes / 1024 ** 2, duration, pixels.nbytes / 1024 ** 2 / duration)
+    return ome_tiff_path
+
+
+class ObjectCache:
+    """Run-scoped LRU cache of the OMERO objects fetched by the stages, keyed by (type, id, group), so that the
+    dataset and the imported image are loaded once per image instead of once per stage.
+    Cached objects are bound again to the connection asking for them, as the stages of a run use several
+    sessions. Stages writing an object must invalidate it.
+    Attributes
+    ----------
+    hits : int
+        Number of objects found in the cache
+    misses : int
+        Number of objects fetched from OMERO
+    """
+
+    def __init__(self, max_size=OBJECT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conn, obj_type, obj_id, group_id=None):
+        """Return the object from the cache or fetch it with `conn.getObject` (None if it does not exist).
+        `group_id` defaults to the group context of the connection."""
+        if group_id is None:
+            group_id = conn.SERVICE_OPTS.getOmeroGroup()
+        key = (obj_type, int(obj_id), str(group_id))
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is not None:
+                self._objects.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if obj is None:
+            obj = conn.getObject(obj_type, obj_id)
+            if obj is None:
+                return None
+            self.put(obj, group_id)
+        # re-bind the wrapper, without any round trip, when it was loaded by another session
+        if getattr(obj, "_conn", conn) is not conn:
+            obj = type(obj)(conn, obj._obj)
+        return obj
+
+    def put(self, obj, group_id=None):
+        """Add an object fetched elsewhere ; `group_id` defaults to the group of the object."""
+        if group_id is None:
+            group_id = obj.getDetails().getGroup().getId()
+        key = (obj.OMERO_CLASS, int(obj.getId()), str(group_id))
+        with self._lock:
+            self._objects[key] = obj
+            self._objects.move_to_end(key)
+            while len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+
+    def invalidate(self, obj_type, obj_id):
+        """Remove an object, in all groups, after it has been modified."""
+        with self._lock:
+            for key in [key for key in self._objects if key[:2] == (obj_type, int(obj_id))]:
+                del self._objects[key]
+
+    def report(self):
+        """Format the hit and miss counters."""
+        return f"object cache : {self.hits} hits / {self.misses} misses"
+
+
+object_cache = ObjectCache()
+
+
+def list_hrm_users(root):
+    """List all user folders of the HRM-Share folder
+    Parameters
+    ----------
+    root : str
+        absolute path of HRM-Share folder (from the root mounted on the server)
+    Returns
+    -------
+    list of str
+        Sorted names of the user folders
+    """
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if not (name.startswith(".") or name.endswith("Thumbs.db")) and os.path.isdir(os.path.join(root, name)))
+
+
+def get_import_files(image_file):
+    """List the local files sent to OMERO when importing an image (the .ics companion of an .ids file).
+    Parameters
+    ----------
+    image_file : str
+        Path of the imported file
+    Returns
+    -------
+    list of str
+        Paths of the files that compose the imported fileset
+    """
+    files = [image_file]
+    ics_path = re.sub(r"\.ids$", ".ics", image_file)
+    if ics_path != image_file and os.path.exists(ics_path):
+        files.append(ics_path)
+    return files
+
+
+def compute_file_hash(path, hasher=DEFAULT_HASHER):
+    """Compute the checksum of a file as computed by OMERO, streaming it through a large reusable buffer.
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    hasher : str
+        OMERO checksum algorithm (`SHA1-160`, `MD5-128`, `Adler-32`, `CRC-32` or `File-Size-64`)
+    Returns
+    -------
+    str
+        The checksum as stored by OMERO, None if the algorithm is not supported.
+    """
+    if hasher == "File-Size-64":
+        return str(os.path.getsize(path))
+    if hasher in ["SHA1-160", "MD5-128"]:
+        digest = hashlib.sha1() if hasher == "SHA1-160" else hashlib.md5()
+        update = digest.update
+    elif hasher in ["Adler-32", "CRC-32"]:
+        digest = None
+        checksum = [1 if hasher == "Adler-32" else 0]
+        running = zlib.adler32 if hasher == "Adler-32" else zlib.crc32
+
+        def update(data):
+            checksum[0] = running(data, checksum[0])
+    else:
+        logger.warning("Unsupported checksum algorithm %s", hasher)
+        return None
+
+    # one buffer per thread, reused across files
+    if not hasattr(hash_buffers, "buffer"):
+        hash_buffers.buffer = bytearray(HASH_BUFFER_BYTES)
+    view = memoryview(hash_buffers.buffer)
+    with open(path, "rb", buffering=0) as stream:
+        n_read = stream.readinto(view)
+        while n_read:
+            update(view[:n_read])
+            n_read = stream.readinto(view)
+
+    return digest.hexdigest() if digest is not None else f"{checksum[0]:08x}"
+
+
+def verify_checksums(conn, image_id_obj, local_hashes):
+    """Compare the local checksums of the imported files with the ones of the image fileset on OMERO.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    image_id_obj : OmeroId
+        The ID of the imported image
+    local_hashes : dict
+        dictionary {file path:checksum computed with `DEFAULT_HASHER`}
+    Returns
+    -------
+    bool
+        True if every local file matches a file of the fileset, False otherwise.
+    """
+    params = omero.sys.ParametersI()
+    params.addId(image_id_obj.obj_id)
+    original_files = conn.getQueryService().findAllByQuery(
+        "select f from OriginalFile f left outer join fetch f.hasher where f.id in "
+        "(select fe.originalFile.id from FilesetEntry fe, Image i where fe.fileset.id = i.fileset.id and i.id = :id)",
+        params, conn.SERVICE_OPTS)
+    server_files = {f.getName().getValue(): f for f in original_files}
+
+    for path, local_hash in local_hashes.items():
+        original_file = server_files.get(os.path.basename(path))
+        if original_file is None or original_file.getHash() is None:
+            logger.error("No checksum on OMERO for [%s] of image %s", path, image_id_obj.obj_id)
+            return False
+        hasher = DEFAULT_HASHER if original_file.getHasher() is None else original_file.getHasher().getValue().getValue()
+        if hasher != DEFAULT_HASHER:
+            if not os.path.exists(path):
+                logger.error("Cannot verify [%s] with %s : the file does not exist anymore", path, hasher)
+                return False
+            local_hash = compute_file_hash(path, hasher)
+        if local_hash != original_file.getHash().getValue():
+            logger.error("Checksum mismatch for [%s] of image %s", path, image_id_obj.obj_id)
+            return False
+
+    logger.log(SUCCESS, "Checksums of %s file(s) verified for image %s", len(local_hashes), image_id_obj.obj_id)
+    return True
+
+
+def find_imported_image(conn, dataset_id, image_file, since):
+    """Find an image of the dataset imported from the given file since the given time.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    dataset_id : OmeroId
+        The ID of the target dataset
+    image_file : str
+        Path of the imported file
+    since : float
+        Time (s since the epoch) before which images are ignored
+    Returns
+    -------
+    OmeroId
+        The ID of the image, None if there is none.
+    """
+    # importers record the client path with or without its leading separator
+    paths = [os.path.abspath(path) for path in get_import_files(image_file)]
+    params = omero.sys.ParametersI()
+    params.addId(int(dataset_id.obj_id))
+    params.add("paths", rlist([rstring(path) for path in paths + [path.lstrip("/") for path in paths]]))
+    params.add("since", rtime(int(since * 1000)))
+    rows = conn.getQueryService().projection(
+        "select distinct i.id from Image i join i.datasetLinks dl join i.fileset fs join fs.usedFiles fe "
+        "where dl.parent.id = :id and fe.clientPath in (:paths) and i.details.creationEvent.time >= :since",
+        params, {"omero.group": str(dataset_id.group)})
+    if len(rows) == 0:
+        return None
+    return OmeroId(f"G:{dataset_id.group}:Image:{rows[0][0].getValue()}")
+
+
+def import_with_retry(conn, import_function, dataset_id, image_file, *args, **kwargs):
+    """Import an image, retrying on transient failures without importing it twice.
+    An import is not idempotent : if the response is lost after the server created the image, importing the file
+    again creates a second image. Before each retry, the target dataset is searched for an image imported from the
+    same file since the first attempt, and that image is kept instead.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    import_function : function
+        `to_omero` or `import_with_python`, called with `args` and `kwargs`
+    dataset_id : OmeroId
+        The ID of the target dataset
+    image_file : str
+        Path of the imported file
+    Returns
+    -------
+    OmeroId
+        The ID of the imported image, None if the import failed.
+    """
+    attempts = []
+
+    def import_once():
+        if len(attempts) > 0:
+            # a minute of margin for the clock difference with the server
+            image_id_obj = find_imported_image(conn, dataset_id, image_file, attempts[0] - 60)
+            if image_id_obj is not None:
+                logger.warning("[%s] was imported as image %s by the failed attempt ; not importing it again",
+                               image_file, image_id_obj.obj_id)
+                return image_id_obj
+        attempts.append(time.time())
+        return import_function(*args, **kwargs)
+
+    import_once.__name__ = import_function.__name__
+    return call_with_retry(conn, import_once)
+
+
+def prepare_ome_tiff(image_path, script_params):
+    """Convert an image to a pyramidal OME-TIFF in the scratch folder, if possible.
+    Parameters
+    ----------
+    image_path : str
+        Path of the .ids image
+    script_params : dict
+        User defined parameters
+    Returns
+    -------
+    tuple (str, int)
+        Path of the file to import (`image_path` if the image is not converted) and scratch space reserved for it.
+    """
+    load_optional_modules()
+    if np is None or tifffile is None:
+        logger.warning("numpy and tifffile are required to convert images ; .ids files are imported as is")
+        return image_path, 0
+
+    scratch_folder = script_params[SCRATCH_FOLDER_PARAM_NAME]
+    max_scratch_bytes = script_params[MAX_SCRATCH_PARAM_NAME] * 1024 ** 3
+    # pyramid levels add about a third to the raw size, compression usually compensates it
+    estimated_bytes = os.path.getsize(image_path) * 4 // 3
+    if not reserve_scratch_space(estimated_bytes, scratch_folder, max_scratch_bytes):
+        logger.warning("Not enough scratch space to convert [%s] ; it is imported as is", image_path)
+        return image_path, 0
+
+    # the parallel imports convert their images at once : they share the cores compressing the tiles
+    workers = max(1, (os.cpu_count() or 1) // max(1, script_params[WORKERS_PARAM_NAME]))
+    try:
+        ome_tiff_path = convert_to_ome_tiff(image_path, scratch_folder, workers)
+    except Exception as err:  # pylint: disable-msg=broad-except
+        logger.warning("Fail converting [%s] to OME-TIFF ; it is imported as is : %s", image_path, err)
+        ome_tiff_path = None
+
+    if ome_tiff_path is None:
+        release_scratch_space(estimated_bytes)
+        return image_path, 0
+    return ome_tiff_path, estimated_bytes
+
+
+def build_import_cli():
+    """Build the OMERO CLI used to import images.
+    omero.cli and its plugins are slow to load, so they are only imported once there is an image to upload.
+    Returns
+    -------
+    omero.cli.CLI
+        CLI with the `import` and `sessions` commands registered
+    """
+    from omero.cli import CLI
+    from omero.plugins.sessions import SessionsControl
+    ImportControl = import_module("omero.plugins.import").ImportControl
+
+    cli = CLI()
+    cli.register('import', ImportControl, '_')
+    cli.register('sessions', SessionsControl, '_')
+    return cli
+
+
+def upload_image(conn, script_params, group_id, image_path, dataset_id):
+    """Upload one deconvolved image, add its annotations and clean HRM folder.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection of the image owner.
+    script_params : dict
+        User defined parameters
+    group_id : int
+        ID of the target group
+    image_path : str
+        Path of the .ids image to upload
+    dataset_id : str
+        ID of the target dataset
+    Returns
+    -------
+    tuple of int
+        (image uploaded, KVP added, tags transferred, files added), each being 1 or 0,
+        followed by the OmeroId of the imported image (None if the import failed)
+    """
+    # OMERO host and port
+    host = script_params[SERVER_PARAM_NAME]
+    port = script_params[PORT_PARAM_NAME]
+
+    # open the connection ; the native Python import does not need the CLI
+    native_import = script_params.get(NATIVE_IMPORT_PARAM_NAME, False)
+    # the CLI only gets the session key and imports in the group of the session, which is not the group of the
+    # dataset when the script session is shared across groups ; the native import sets the group of each call
+    if not native_import and conn.getEventContext().groupId != int(group_id):
+        logger.info("The session is not in the group %s of dataset %s : [%s] is imported with the Python API",
+                    group_id, dataset_id, image_path)
+        native_import = True
+    cli = None if native_import else build_import_cli()
+    owner = conn.getUser().getOmeName()
+
+    image_id_obj = None
+    n_images_uploaded = 0
+    n_kvps_uploaded = 0
+    n_tags_uploaded = 0
+    n_files_uploaded = 0
+    try:
+        # built the object ID
+        dataset_id_obj = OmeroId(f"G:{group_id}:Dataset:{dataset_id}")
+
+        # compute the channel statistics and the checksums while the image is uploaded
+        delete_files = script_params[DELETE_DECONVOLVED_PARAM_NAME] or script_params[DELETE_RAW_PARAM_NAME]
+        verified = True
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            # the server skips its own min/max pass over the pixels when the statistics are computed here
+            skip = []
+            if script_params[PRECOMPUTE_STATS_PARAM_NAME] and can_compute_channel_statistics(image_path):
+                statistics_future = executor.submit(metrics.timed("statistics", compute_channel_statistics),
+                                                    image_path)
+                skip.append("minmax")
+            else:
+                statistics_future = None
+            # thumbnails are then generated once all images are imported, in batches
+            if script_params[THUMBNAILS_PARAM_NAME]:
+                skip.append("thumbnails")
+
+            # upload image on omero, converted to a pyramidal OME-TIFF if requested
+            image_file = image_path
+            reserved_bytes = 0
+            if script_params[CONVERT_PARAM_NAME]:
+                with metrics.stage("convert", os.path.getsize(image_path)):
+                    image_file, reserved_bytes = prepare_ome_tiff(image_path, script_params)
+            hash_futures = {}
+            if delete_files and script_params[VERIFY_CHECKSUMS_PARAM_NAME]:
+                hash_futures = {path: executor.submit(metrics.timed("checksum", compute_file_hash), path)
+                                for path in get_import_files(image_file)}
+            try:
+                import_files = get_import_files(image_file)
+                import_bytes = sum(os.path.getsize(path) for path in import_files)
+                # the native import reads the files chunk by chunk, each chunk being throttled ; the Java importer
+                # reads them itself, so its reads can only be throttled per file, before the import
+                if not native_import:
+                    with metrics.stage("throttle"):
+                        throttle.consume(owner, import_bytes, len(import_files))
+                image_name = None if image_file == image_path else os.path.basename(image_path)
+                if native_import:
+                    with metrics.stage("import_with_python", import_bytes):
+                        image_id_obj = import_with_retry(conn, import_with_python, dataset_id_obj, image_file,
+                                                         conn, dataset_id_obj, image_file, image_name=image_name,
+                                                         skip=skip)
+                else:
+                    with metrics.stage("to_omero", import_bytes):
+                        image_id_obj = import_with_retry(conn, to_omero, dataset_id_obj, image_file, conn, cli, host,
+                                                         port, dataset_id_obj, image_file, image_name=image_name,
+                                                         skip=skip)
+                # verify that the bytes on the server match the local files before deleting them
+                if image_id_obj is not None and len(hash_futures) > 0:
+                    try:
+                        local_hashes = {path: future.result() for path, future in hash_futures.items()}
+                        with metrics.stage("verify_checksums"):
+                            verified = call_with_retry(conn, verify_checksums, conn, image_id_obj, local_hashes)
+                    except Exception as err:  # pylint: disable-msg=broad-except
+                        logger.error("Fail verifying checksums of image %s : %s", image_id_obj.obj_id, err)
+                        verified = False
+                    # the checksums cover the converted OME-TIFF, not the .ics/.ids files that would be deleted
+                    if verified and image_file != image_path:
+                        logger.warning("[%s] was imported as a converted OME-TIFF : its checksums do not verify "
+                                       "the .ics/.ids files, which are kept", image_path)
+                        verified = False
+            except Exception as err:  # pylint: disable-msg=broad-except
+                # retries exhausted or session lost : the image is reported as not uploaded, and its files are kept
+                logger.error("Fail importing [%s] to %s : %s", image_path, dataset_id_obj, err)
+                image_id_obj = None
+            finally:
+                wait(hash_futures.values())
+                if image_file != image_path and os.path.exists(image_file):
+                    os.remove(image_file)
+                release_scratch_space(reserved_bytes)
+            n_images_uploaded = (1 if image_id_obj is not None else 0)
+            has_failed = False
+
+            # save statistics and rendering settings so that the image is viewable immediately
+            if image_id_obj is not None and statistics_future is not None:
+                saved = False
+                try:
+                    statistics = statistics_future.result()
+                    if statistics is not None:
+                        with metrics.stage("save_statistics"):
+                            saved = call_with_retry(conn, save_channel_statistics, conn, image_id_obj, statistics)
+                except Exception as err:  # pylint: disable-msg=broad-except
+                    logger.warning("Fail saving rendering settings of image %s : %s", image_id_obj.obj_id, err)
+                if not saved:
+                    logger.warning("Image %s has no pixel statistics : its rendering window is the range of its "
+                                   "pixel type", image_id_obj.obj_id)
+
+        # nothing to annotate nor delete
+        if image_id_obj is None:
+            return n_images_uploaded, n_kvps_uploaded, n_tags_uploaded, n_files_uploaded, image_id_obj
+
+        # add deconvolution parameters as key-value pairs ; annotation writes are not retried, as a write whose
+        # response was lost would be linked twice
+        try:
+            with metrics.stage("parse_summary"):
+                summary = parse_summary(image_path)
+            with metrics.stage("add_key_values"):
+                n_kvps_uploaded = (1 if add_annotation_key_value(conn, image_id_obj, summary) else 0)
+            # keep the parameters to append them to the table of the dataset once all images are imported
+            if script_params.get(PARAMETERS_TABLE_PARAM_NAME) and image_id_obj is not None and summary:
+                row, descriptions = flatten_summary(summary)
+                row["Image"] = image_id_obj.obj_id
+                row["Image_name"] = os.path.basename(image_path)
+                with parameter_rows_lock:
+                    parameter_rows.setdefault((owner, group_id, dataset_id), []).append(row)
+                    parameter_descriptions.update(descriptions)
+        except Exception as err:  # pragma: no cover # pylint: disable-msg=broad-except
+            logger.error("Fail creating a parameter summary from [%s] : %s", image_path, err)
+            has_failed = True
+
+        # transfer tag from raw to deconvolved image
+        try:
+            with metrics.stage("add_tags"):
+                n_tags_uploaded = (1 if add_tags(conn, image_id_obj, dataset_id_obj) else 0)
+        except Exception as err:
+            logger.error("Fail adding tags from raw image to image [%s] : %s", image_id_obj, err)
+            has_failed = True
+
+        # attach the log file to the image, or all the provenance files packed in one archive
+        try:
+            if script_params.get(BUNDLE_PROVENANCE_PARAM_NAME):
+                with metrics.stage("attach_provenance"):
+                    n_files_uploaded = (1 if attach_provenance_archive(conn, image_id_obj, image_path) else 0)
+            else:
+                with metrics.stage("attach_log_file"):
+                    n_files_uploaded = (1 if attach_log_file(conn, image_id_obj, image_path) else 0)
+        except Exception as err:
+            logger.error("Fail attaching log file from [%s] to image %s : %s", image_path, image_id_obj.obj_id, err)
+            has_failed = True
+
+        if image_id_obj is not None and not has_failed and not verified:
+            logger.warning("Files of [%s] are not deleted from HRM folder", image_path)
+        elif image_id_obj is not None and not has_failed:
+            with metrics.stage("delete"):
+                if script_params[DELETE_DECONVOLVED_PARAM_NAME]:
+                    delete_uploaded_files(image_path, owner)
+                if script_params[DELETE_RAW_PARAM_NAME]:
+                    delete_raw_files(image_path, owner)
+    finally:
+        if cli is not None:
+            cli.close()
+
+    return n_images_uploaded, n_kvps_uploaded, n_tags_uploaded, n_files_uploaded, image_id_obj
+
+
+def generate_thumbnails(user_image_ids, user_connections, workers):
+    """Generate the thumbnails of newly imported images in batches, using the set-based ThumbnailStore calls.
+    Parameters
+    ----------
+    user_image_ids : dict
+        dictionary {(owner, group_id):list of image IDs}
+    user_connections : dict
+        Opened connections {(owner, group_id):connection}
+    workers : int
+        Maximum number of batches processed at once
+    Returns
+    -------
+    tuple (int, float)
+        Number of generated thumbnails and duration in seconds.
+    """
+    start = time.time()
+    batches = []
+    for (owner, group_id), image_ids in user_image_ids.items():
+        user_conn = user_connections[(owner, group_id)]
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids)
+        pixels_ids = [row[0].val for row in user_conn.getQueryService().projection(
+            "select p.id from Pixels p where p.image.id in (:ids)", params, {"omero.group": str(group_id)})]
+        for batch_start in range(0, len(pixels_ids), THUMBNAIL_BATCH_SIZE):
+            batches.append((user_conn, group_id, pixels_ids[batch_start:batch_start + THUMBNAIL_BATCH_SIZE]))
+
+    def run_batch(batch):
+        user_conn, group_id, pixels_ids = batch
+        thumbnail_store = user_conn.createThumbnailStore()
+        try:
+            thumbnails = thumbnail_store.getThumbnailByLongestSideSet(rint(THUMBNAIL_SIZE), pixels_ids,
+                                                                      {"omero.group": str(group_id)})
+            return len(thumbnails)
+        except Exception as err:  # pylint: disable-msg=broad-except
+            logger.warning("Fail generating thumbnails of pixels %s : %s", pixels_ids, err)
+            return 0
+        finally:
+            thumbnail_store.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        n_thumbnails = sum(executor.map(run_batch, batches))
+
+    duration = time.time() - start
+    logger.info("Generated %s thumbnail(s) in %s batch(es) in %.1f s", n_thumbnails, len(batches), duration)
+    return n_thumbnails, duration
+
+
+def find_import_throughput(conn):
+    """Find the import throughput measured by the last retrieve runs, from their metrics attached on OMERO.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    Returns
+    -------
+    tuple (float, float)
+        Import throughput (bytes per second and per import) and duration (seconds) of the stages following each
+        import, None if no previous run imported images.
+    """
+    params = omero.sys.ParametersI()
+    params.addString("ns", METRICS_NS)
+    params.addString("name", "retrieve_metrics_%")
+    params.page(0, PREVIEW_METRICS_SEARCH)
+    rows = conn.getQueryService().projection(
+        "select a.id from FileAnnotation a join a.file f where a.ns = :ns and f.name like :name order by a.id desc",
+        params, conn.SERVICE_OPTS)
+    for row in rows:
+        file_ann = conn.getObject("FileAnnotation", row[0].val)
+        if file_ann is None:
+            continue
+        try:
+            stages = json.loads(b"".join(file_ann.getFileInChunks()).decode("utf-8"))["stages"]
+        except (ValueError, KeyError) as err:
+            logger.debug("Skipping unreadable metrics file %s : %s", row[0].val, err)
+            continue
+        imports = [stages[name] for name in IMPORT_STAGES if name in stages]
+        import_bytes = sum(stage["bytes"] for stage in imports)
+        import_seconds = sum(stage["seconds"] for stage in imports)
+        if import_bytes == 0 or import_seconds == 0:
+            continue
+        import_count = sum(stage["count"] for stage in imports)
+        post_import_seconds = sum(stages[name]["seconds"] for name in POST_IMPORT_STAGES if name in stages)
+        logger.debug("Import throughput taken from metrics file %s", row[0].val)
+        return import_bytes / import_seconds, post_import_seconds / import_count
+    return None
+
+
+def preview_upload(conn, script_params, owners, root):
+    """Report what a run would upload, without changing anything on OMERO : no dataset is created and no import
+    session is opened. The HRM-Share folder is scanned once.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    script_params : dict
+        User defined parameters
+    owners : list of str
+        Users whose HRM folder is scanned
+    root : str
+        absolute path of HRM-Share folder (from the root mounted on the server)
+    Returns
+    -------
+    message : str
+        Pending images, bytes, images already on OMERO and estimated import time.
+    """
+    n_initial_images = 0
+    n_pending_images = 0
+    n_orphaned_images = 0
+    n_bytes = 0
+    n_active_owners = 0
+    failed_path = None
+    for owner in owners:
+        with metrics.stage("scan"):
+            image_path_dataset_id_map, owner_failed_path, n_owner_images = list_images_to_upload(
+                conn, owner, root, create_orphaned_dataset=False)
+        if image_path_dataset_id_map is None:
+            failed_path = owner_failed_path
+            logger.warning("The path %s is not valid. Cannot upload any images of %s.", owner_failed_path, owner)
+            continue
+        owner_bytes = sum(os.path.getsize(path) for image_path in image_path_dataset_id_map
+                          for path in get_import_files(image_path))
+        owner_orphaned_images = sum(1 for dataset_id in image_path_dataset_id_map.values() if dataset_id == -1)
+        logger.info("%s : %s / %s images to upload (%.1f MB), %s orphaned", owner, len(image_path_dataset_id_map),
+                    n_owner_images, owner_bytes / 1024 ** 2, owner_orphaned_images)
+        n_initial_images += n_owner_images
+        n_pending_images += len(image_path_dataset_id_map)
+        n_orphaned_images += owner_orphaned_images
+        n_bytes += owner_bytes
+        n_active_owners += (1 if len(image_path_dataset_id_map) > 0 else 0)
+
+    if n_initial_images == 0:
+        if failed_path is None:
+            return "Preview : there is no image to upload"
+        return f"Preview : the path {failed_path} is not valid. Cannot upload any images."
+
+    message = f"Preview : {n_pending_images} / {n_initial_images} images to upload ({n_bytes / 1024 ** 2:.1f} MB)" \
+              f" and {n_initial_images - n_pending_images} / {n_initial_images} images already existing"
+    if n_orphaned_images > 0:
+        message += f" -- {n_orphaned_images} orphaned images would go to a new HRM-{date.today()} dataset"
+    if len(owners) > 1:
+        message += f" -- from {n_active_owners} user(s)"
+    if n_pending_images == 0:
+        return message
+
+    with metrics.stage("find_throughput"):
+        throughput = find_import_throughput(conn)
+    if throughput is None:
+        return message + " -- no previous run to estimate the import time"
+    bytes_per_s, post_import_seconds = throughput
+    parallel_imports = min(script_params[WORKERS_PARAM_NAME], n_pending_images,
+                           n_active_owners * script_params[MAX_IMPORTS_PER_USER_PARAM_NAME])
+    duration = (n_bytes / bytes_per_s + n_pending_images * post_import_seconds) / parallel_imports
+    message += f" -- estimated time : {duration / 60:.1f} min with {parallel_imports} parallel import(s) at " \
+               f"{bytes_per_s / 1024 ** 2:.1f} MB/s per import"
+    return message
 
 
 def upload_images_from_hrm(conn, script_params):
@@ -910,76 +2503,114 @@ def upload_images_from_hrm(conn, script_params):
         Informative message for the user.
     """
 
-    # OMERO host
-    host = script_params[SERVER_PARAM_NAME]
-    # OMERO port
-    port = script_params[PORT_PARAM_NAME]
-    # remove existing images
-    delete_uploaded_images = script_params[DELETE_DECONVOLVED_PARAM_NAME]
-    # remove existing images
-    delete_raw_images = script_params[DELETE_RAW_PARAM_NAME]
+    # number of parallel imports, overall and per user
+    workers = script_params[WORKERS_PARAM_NAME]
+    max_imports_per_user = script_params[MAX_IMPORTS_PER_USER_PARAM_NAME]
+    # number of imports at once, adapted between the minimum and the number of parallel imports if requested
+    min_workers = script_params.get(MIN_WORKERS_PARAM_NAME, 1) if script_params.get(ADAPTIVE_WORKERS_PARAM_NAME) \
+        else workers
+    concurrency.configure(min_workers, workers)
+    # objects shared by the stages of this run only
+    global object_cache
+    object_cache = ObjectCache()
+    # bandwidth and file operations limits on the HRM-Share folder
+    throttle.configure(bytes_per_s=(script_params.get(MAX_BANDWIDTH_PARAM_NAME) or 0) * 1024 ** 2,
+                       ops_per_s=script_params.get(MAX_FILE_OPS_PARAM_NAME) or 0,
+                       user_bytes_per_s=(script_params.get(MAX_USER_BANDWIDTH_PARAM_NAME) or 0) * 1024 ** 2,
+                       user_ops_per_s=script_params.get(MAX_USER_FILE_OPS_PARAM_NAME) or 0)
 
     # root path to HRM-Share folder
     root = "/mnt/hrmshare"
-    # current logged in user
-    owner = conn.getUser().getOmeName()
-    # current group ID
-    group_id = conn.getGroupFromContext().getId()
-    # list of images to upload
-    image_path_dataset_id_map, failed_path, n_initial_images = list_images_to_upload(conn, owner, root)
-
-    if image_path_dataset_id_map is not None:
-        # open the connection
-        cli = CLI()
-        cli.register('import', ImportControl, '_')
-        cli.register('sessions', SessionsControl, '_')
-
-        total_images = len(image_path_dataset_id_map)
-        total_images_uploaded = 0
-        total_kvps_uploaded = 0
-        total_tags_uploaded = 0
-        total_files_uploaded = 0
-        try:
-            for image in image_path_dataset_id_map.items():
-                # built the object ID
-                dataset_id = image[1]
-                image_path = image[0]
-                dataset_id_obj = OmeroId(f"G:{group_id}:Dataset:{dataset_id}")
-
-                # upload image on omero
-                image_id_obj = to_omero(conn, cli, host, port, dataset_id_obj, image_path)
-                total_images_uploaded += (1 if image_id_obj is not None else 0)
-                has_failed = False
-
-                # add deconvolution parameters as key-value pairs
-                try:
-                    summary = parse_summary(image_path)
-                    total_kvps_uploaded += (1 if add_annotation_key_value(conn, image_id_obj, summary) else 0)
-                except Exception as err:  # pragma: no cover # pylint: disable-msg=broad-except
-                    print("ERROR", f"Fail creating a parameter summary from [{image_path}] : {err}")
-                    has_failed = True
+    # current logged in user or all HRM users in admin mode
+    if script_params[ALL_USERS_PARAM_NAME]:
+        if not conn.getUser().isAdmin():
+            return "Only admins can retrieve images for all HRM users"
+        owners = list_hrm_users(root)
+    else:
+        owners = [conn.getUser().getOmeName()]
 
-                # transfer tag from raw to deconvolved image
-                try:
-                    total_tags_uploaded += (1 if add_tags(conn, image_id_obj, dataset_id_obj) else 0)
-                except Exception as err:
-                    print("ERROR", f"Fail adding tags from raw image to image [{image_id_obj}] : {err}")
-                    has_failed = True
+    if script_params.get(PREVIEW_PARAM_NAME):
+        return preview_upload(conn, script_params, owners, root)
 
-                # attach the log file to the image
-                try:
-                    total_files_uploaded += (1 if attach_log_file(conn, image_id_obj, image_path) else 0)
-                except Exception as err:
-                    print("ERROR", f"Fail attaching log file from [{image_path}] to image {image_id_obj.obj_id} : {err}")
-                    has_failed = True
-
-                if image_id_obj is not None and not has_failed:
-                    if delete_uploaded_images:
-                        delete_uploaded_files(image_path)
-                    if delete_raw_images:
-                        delete_raw_files(image_path)
-        finally:
-            cli.close()
+    user_connections = {}
+    group_connections = {}
+    parameter_rows.clear()
+    parameter_descriptions.clear()
+    user_tasks = {}
+    n_initial_images = 0
+    failed_path = None
+    # the sudo sessions must not idle while a CLI import only uses their session key
+    session_keeper = SessionKeeper(user_connections, group_connections)
+    session_keeper.start()
+    try:
+        for owner in owners:
+            user_conn = get_user_connection(conn, owner, user_connections)
+            if user_conn is None:
+                continue
+
+            # list of images to upload
+            with metrics.stage("scan"):
+                image_path_dataset_id_map, owner_failed_path, n_owner_images = list_images_to_upload(user_conn, owner,
+                                                                                                     root)
+            if image_path_dataset_id_map is None:
+                failed_path = owner_failed_path
+                logger.warning("The path %s is not valid. Cannot upload any images of %s.", owner_failed_path, owner)
+                continue
+
+            # partition the images by the group of their dataset, resolved at once
+            n_initial_images += n_owner_images
+            dataset_groups = get_dataset_groups(user_conn, image_path_dataset_id_map.values())
+            tasks = []
+            for image_path, dataset_id in image_path_dataset_id_map.items():
+                if int(dataset_id) not in dataset_groups:
+                    logger.warning("Dataset %s of [%s] not found in any group of %s", dataset_id, image_path, owner)
+                    continue
+                group_id, group_name = dataset_groups[int(dataset_id)]
+                if get_group_connection(conn, owner, group_id, group_name, group_connections) is None:
+                    continue
+                tasks.append((group_id, image_path, dataset_id))
+            # keep the images of a group together
+            user_tasks[owner] = sorted(tasks, key=lambda task: task[0])
+
+        def run_task(owner, task):
+            group_id, image_path, dataset_id = task
+            return (owner, group_id) + upload_image(group_connections[(owner, group_id)], script_params, group_id,
+                                                    image_path, dataset_id)
+
+        # nothing to upload : leave before building any import CLI or thread pool
+        results = []
+        if any(len(tasks) > 0 for tasks in user_tasks.values()):
+            results = schedule_round_robin(user_tasks, workers, max_imports_per_user, run_task, concurrency)
+
+        # generate thumbnails once all images are imported
+        thumbnails_message = ""
+        if script_params[THUMBNAILS_PARAM_NAME]:
+            user_image_ids = {}
+            for owner, group_id, _, _, _, _, image_id_obj in results:
+                if image_id_obj is not None:
+                    user_image_ids.setdefault((owner, group_id), []).append(int(image_id_obj.obj_id))
+            if len(user_image_ids) > 0:
+                with metrics.stage("thumbnails"):
+                    n_thumbnails, duration = generate_thumbnails(user_image_ids, group_connections, workers)
+                thumbnails_message = f" -- {n_thumbnails} thumbnails generated in {duration:.1f} s"
+
+        # append the parameters of the imported images to the tables of their datasets
+        tables_message = ""
+        if len(parameter_rows) > 0:
+            with metrics.stage("parameters_table"):
+                n_rows, n_tables = save_parameters_tables(group_connections)
+            tables_message = f" -- {n_rows} rows added to {n_tables} parameters table(s)"
+    finally:
+        session_keeper.stop()
+        close_user_connections(conn, group_connections)
+        close_user_connections(conn, user_connections)
+
+    if len(user_tasks) > 0:
+        total_images = sum(len(tasks) for tasks in user_tasks.values())
+        total_images_uploaded = sum(result[2] for result in results)
+        total_kvps_uploaded = sum(result[3] for result in results)
+        total_tags_uploaded = sum(result[4] for result in results)
+        total_files_uploaded = sum(result[5] for result in results)
 
         n_existing_images = n_initial_images - total_images
         message = f"{total_images_uploaded} / {n_initial_images} images uploaded and" \
@@ -987,13 +2618,23 @@ def upload_images_from_hrm(conn, script_params):
                   f"{total_kvps_uploaded} / {n_initial_images} images have KVP added -- " \
                   f"{total_tags_uploaded} / {n_initial_images} images have tags transferred -- " \
                   f"{total_files_uploaded} / {n_initial_images} images have files added"
+        if len(owners) > 1:
+            message += f" -- from {len(user_tasks)} user(s)"
+        message += thumbnails_message + tables_message
 
     else:
-        if n_initial_images == 0:
+        if n_initial_images == 0 and failed_path is None:
             message = f"There is no image to upload"
         else:
             message = f"The path {failed_path} is not valid. Cannot upload any images."
 
+    if throttle.is_limited():
+        message += " -- " + throttle.report()
+        logger.info("%s", throttle.report())
+    if concurrency.is_adaptive():
+        message += " -- " + concurrency.report()
+        logger.info("%s", concurrency.report())
+    logger.info("%s", object_cache.report())
     return message
 
 
@@ -1014,6 +2655,16 @@ def run_script():
             PORT_PARAM_NAME, optional=False, grouping="2",
             description="OMERO port", default=4064),
 
+        scripts.Bool(
+            PREVIEW_PARAM_NAME, optional=True, grouping="2.1",
+            description="Only report the images to upload, their size and the estimated import time, "
+                        "without changing anything on OMERO", default=False),
+
+        scripts.Bool(
+            OFF_PEAK_PARAM_NAME, optional=True, grouping="2.2",
+            description="Queue the request and run it during the next off-peak window, instead of now",
+            default=False),
+
         scripts.Bool(
             DELETE_DECONVOLVED_PARAM_NAME, optional=True, grouping="3",
             description="Remove uploaded images from HRM folder", default=False),
@@ -1022,6 +2673,93 @@ def run_script():
             DELETE_RAW_PARAM_NAME, optional=True, grouping="4",
             description="Remove corresponding raw images from HRM folder", default=False),
 
+        scripts.Bool(
+            VERIFY_CHECKSUMS_PARAM_NAME, optional=True, grouping="4.1",
+            description="Only delete files whose checksum matches the imported files on OMERO", default=True),
+
+        scripts.Bool(
+            ALL_USERS_PARAM_NAME, optional=True, grouping="5",
+            description="Admin only: retrieve images of all HRM users, each one in its own session", default=False),
+
+        scripts.Int(
+            WORKERS_PARAM_NAME, optional=False, grouping="6",
+            description="Number of images imported in parallel", default=1, min=1),
+
+        scripts.Bool(
+            ADAPTIVE_WORKERS_PARAM_NAME, optional=True, grouping="6.1",
+            description="Adapt the number of parallel imports to the server load, up to Parallel imports",
+            default=False),
+
+        scripts.Int(
+            MIN_WORKERS_PARAM_NAME, optional=True, grouping="6.2",
+            description="Minimum number of parallel imports when they are adapted", default=1, min=1),
+
+        scripts.Int(
+            MAX_IMPORTS_PER_USER_PARAM_NAME, optional=False, grouping="7",
+            description="Maximum number of images of the same user imported in parallel", default=1, min=1),
+
+        scripts.Int(
+            MAX_BANDWIDTH_PARAM_NAME, optional=True, grouping="7.1",
+            description="Maximum import and deletion bandwidth on the HRM-Share folder (MB/s), all users together", min=1),
+
+        scripts.Int(
+            MAX_USER_BANDWIDTH_PARAM_NAME, optional=True, grouping="7.2",
+            description="Maximum import and deletion bandwidth on the HRM-Share folder (MB/s) of each user", min=1),
+
+        scripts.Int(
+            MAX_FILE_OPS_PARAM_NAME, optional=True, grouping="7.3",
+            description="Maximum number of file operations per second on the HRM-Share folder, all users together",
+            min=1),
+
+        scripts.Int(
+            MAX_USER_FILE_OPS_PARAM_NAME, optional=True, grouping="7.4",
+            description="Maximum number of file operations per second on the HRM-Share folder of each user", min=1),
+
+        scripts.Bool(
+            PRECOMPUTE_STATS_PARAM_NAME, optional=True, grouping="8",
+            description="Compute pixel statistics and rendering settings while importing, "
+                        "so that images are viewable immediately", default=True),
+
+        scripts.Bool(
+            THUMBNAILS_PARAM_NAME, optional=True, grouping="8.1",
+            description="Generate the thumbnails of the imported images once all imports are done", default=True),
+
+        scripts.Bool(
+            NATIVE_IMPORT_PARAM_NAME, optional=True, grouping="8.2",
+            description="Import images with the OMERO Python API instead of the Java importer (no JVM, "
+                        "no OMERO.java.zip)", default=False),
+
+        scripts.Bool(
+            PARAMETERS_TABLE_PARAM_NAME, optional=True, grouping="8.3",
+            description="Also add the deconvolution parameters to an OMERO.table attached to the dataset, "
+                        "one row per image", default=False),
+
+        scripts.Bool(
+            BUNDLE_PROVENANCE_PARAM_NAME, optional=True, grouping="8.4",
+            description="Attach the log, parameter summary and Huygens batch files of each image as one compressed "
+                        "archive instead of the log file only", default=False),
+
+        scripts.Bool(
+            CONVERT_PARAM_NAME, optional=True, grouping="9",
+            description="Convert .ids images to tiled pyramidal OME-TIFF before importing them", default=False),
+
+        scripts.String(
+            SCRATCH_FOLDER_PARAM_NAME, optional=False, grouping="9.1",
+            description="Local folder where converted images are temporarily written", default="/tmp"),
+
+        scripts.Int(
+            MAX_SCRATCH_PARAM_NAME, optional=False, grouping="9.2",
+            description="Maximum space (GB) used by converted images at once", default=50, min=1),
+
+        scripts.String(
+            METRICS_TEXTFILE_PARAM_NAME, optional=True, grouping="10",
+            description="Directory where the timings are written as a Prometheus textfile"),
+
+        scripts.String(
+            LOG_LEVEL_PARAM_NAME, optional=False, grouping="11",
+            description="Verbosity of the script output (TRACE being the most verbose)",
+            values=[rstring(level) for level in LOG_LEVELS], default="INFO"),
+
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch"
@@ -1034,15 +2772,31 @@ def run_script():
             if client.getInput(key):
                 script_params[key] = client.getInput(key, unwrap=True)
 
+        set_log_level(script_params.get(LOG_LEVEL_PARAM_NAME, "INFO"))
+
         # wrap client to use the Blitz Gateway
         conn = BlitzGateway(client_obj=client)
-        print("script params")
+        logger.info("script params")
         for k, v in script_params.items():
-            print(k, v)
+            logger.info("%s %s", k, v)
+        # off-peak requests are only queued : nothing is uploaded now
+        if script_params.get(OFF_PEAK_PARAM_NAME) and not script_params.get(PREVIEW_PARAM_NAME):
+            client.setOutput("Message", rstring(enqueue_request(conn, "retrieve", script_params)))
+            return
         message = upload_images_from_hrm(conn, script_params)
-        client.setOutput("Message", rstring(message))
+        # the off-peak requests of the user finished since their last run
+        message += report_queued_results(conn.getUser().getOmeName())
+        # a preview leaves no metrics file, which would not be a throughput reference anyway
+        if script_params.get(PREVIEW_PARAM_NAME):
+            client.setOutput("Message", rstring(message))
+        else:
+            metrics_file_ann = export_metrics(conn, "retrieve", script_params.get(METRICS_TEXTFILE_PARAM_NAME))
+            client.setOutput("Message", rstring(message + "\n" + metrics.to_table()))
+            if metrics_file_ann is not None:
+                client.setOutput("File_Annotation", robject(metrics_file_ann._obj))
 
     finally:
+        log_handler.close()
         client.closeSession()
 
 
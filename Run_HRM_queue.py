@@ -0,0 +1,274 @@
+"""
+ MIF/Run_HRM_queue.py
+ Run the off-peak requests queued by Send_images_to_HRM and Retrieve_images_from_HRM ("Run off peak") during the
+ configured time windows, with global limits, and record their results for the users.
+ Meant to be started regularly (e.g. every 15 min by cron) on the OMERO server, with admin credentials in the
+ OMERO_USER and OMERO_PASSWORD environment variables. This is not an OMERO script : do not upload it to OMERO.
+
+ usage : python Run_HRM_queue.py [--server omero-server.epfl.ch] [--port 4064] [--window 20:00-07:00 ...]
+                                 [--max-requests 2] [--max-workers 4] [--max-bandwidth MB_PER_S]
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import argparse
+import fcntl
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.abspath(__file__))
+# same folder as the QUEUE_FOLDER of omero_hrm_common
+QUEUE_FOLDER = os.environ.get("OMERO_HRM_QUEUE", "/opt/omero/hrm-queue")
+# script file and function running a request of each script
+SCRIPTS = {
+    "send": ("Send_images_to_HRM.py", "download_images_for_hrm"),
+    "retrieve": ("Retrieve_images_from_HRM.py", "upload_images_from_hrm"),
+}
+# time (s) between two checks of the queue and of the windows while requests are running
+POLL_INTERVAL = 60
+# finished requests, reported or not, are deleted after this time (s)
+RESULTS_MAX_AGE = 30 * 24 * 3600
+
+
+def parse_window(window):
+    """
+    Parse a HH:MM-HH:MM window (possibly over midnight)
+    return (start, end) in minutes since midnight
+    """
+    start, end = window.split("-")
+    return tuple(int(hours) * 60 + int(minutes) for hours, minutes in (start.split(":"), end.split(":")))
+
+
+def in_window(windows, now):
+    """
+    return True if now (datetime) falls in one of the (start, end) windows
+    """
+    minute = now.hour * 60 + now.minute
+    for start, end in windows:
+        if start <= end and start <= minute < end:
+            return True
+        if start > end and (minute >= start or minute < end):
+            return True
+    return False
+
+
+def list_requests(state):
+    """
+    return the file names of the requests in the given state, oldest first
+    """
+    folder = os.path.join(QUEUE_FOLDER, state)
+    return sorted(name for name in os.listdir(folder) if name.endswith(".json"))
+
+
+def write_request(path, request):
+    """
+    Write the request as JSON, then rename it so that the scripts never read a partial file
+    """
+    with open(path + ".tmp", "w", encoding="utf-8") as request_file:
+        json.dump(request, request_file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def fail_request(name, err):
+    """
+    Move a request whose run crashed from the running folder to the done folder, as failed, so that it is reported
+    to its user instead of being run again forever
+    """
+    running_path = os.path.join(QUEUE_FOLDER, "running", name)
+    try:
+        with open(running_path, "r", encoding="utf-8") as request_file:
+            request = json.load(request_file)
+    except (OSError, ValueError):
+        request = {"id": os.path.splitext(name)[0], "user": None}
+    request.update(status="failed", message=f"crashed : {type(err).__name__} : {err}", finished=time.time())
+    request.setdefault("started", request["finished"])
+    write_request(os.path.join(QUEUE_FOLDER, "done", name), request)
+    if os.path.exists(running_path):
+        os.remove(running_path)
+    return request
+
+
+def prune_results():
+    """
+    Delete the finished requests (reported to their user or not) older than RESULTS_MAX_AGE
+    return the number of deleted requests
+    """
+    n_deleted = 0
+    for state in ("done", "reported"):
+        folder = os.path.join(QUEUE_FOLDER, state)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if time.time() - os.path.getmtime(path) > RESULTS_MAX_AGE:
+                os.remove(path)
+                n_deleted += 1
+    return n_deleted
+
+
+def load_script(file_name):
+    """
+    Load one of the OMERO scripts as a module (the scripts only run when executed as __main__), with a fresh copy
+    of the helpers they share, whose state (metrics, throttle, log handler) must not leak from a previous request
+    run by the same worker process
+    """
+    if REPOSITORY_FOLDER not in sys.path:
+        sys.path.insert(0, REPOSITORY_FOLDER)
+    sys.modules.pop("omero_hrm_common", None)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(file_name)[0].lower(),
+                                                  os.path.join(REPOSITORY_FOLDER, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_request(name, server, port, max_workers, max_bandwidth):
+    """
+    Run one request as its user, in its own process so that the module state of the scripts (metrics, throttle,
+    caches) is never shared between requests, and move it to the done folder with its result
+    return the request
+    """
+    from omero.gateway import BlitzGateway
+
+    running_path = os.path.join(QUEUE_FOLDER, "running", name)
+    with open(running_path, "r", encoding="utf-8") as request_file:
+        request = json.load(request_file)
+    file_name, function_name = SCRIPTS[request["script"]]
+    module = load_script(file_name)
+    # the fresh copy loaded with the script
+    from omero_hrm_common import SUDO_SESSION_TTL, SessionKeeper
+    module.set_log_level(request["params"].get(module.LOG_LEVEL_PARAM_NAME, "INFO"))
+
+    # global limits, applied on top of the parameters of the user
+    params = dict(request["params"])
+    if max_workers:
+        params[module.WORKERS_PARAM_NAME] = min(params.get(module.WORKERS_PARAM_NAME, 1), max_workers)
+    if max_bandwidth:
+        params[module.MAX_BANDWIDTH_PARAM_NAME] = min(params.get(module.MAX_BANDWIDTH_PARAM_NAME) or max_bandwidth,
+                                                      max_bandwidth)
+
+    request["started"] = time.time()
+    conn = BlitzGateway(os.environ["OMERO_USER"], os.environ["OMERO_PASSWORD"], host=server, port=port, secure=True)
+    user_conn = None
+    # bulk transfers run for hours : the sudo session lives longer than the 60 s default and both sessions are kept
+    # from idling
+    connections = {}
+    session_keeper = SessionKeeper(connections)
+    session_keeper.start()
+    try:
+        if not conn.connect():
+            raise RuntimeError(f"Cannot connect to {server}:{port}")
+        user_conn = conn.suConn(request["user"], ttl=SUDO_SESSION_TTL)
+        if user_conn is None:
+            raise RuntimeError(f"Cannot open a session for user {request['user']}")
+        connections.update(admin=conn, user=user_conn)
+        message = getattr(module, function_name)(user_conn, params)
+        request.update(status="done", message=message + "\n" + module.metrics.to_table())
+    except Exception as err:  # pylint: disable-msg=broad-except
+        request.update(status="failed", message=f"{type(err).__name__} : {err}")
+    finally:
+        session_keeper.stop()
+    # as for an interactive run, so that the previews keep an up-to-date throughput ; a finished transfer is not
+    # reported as failed because of its metrics
+    try:
+        if request["status"] == "done":
+            module.export_metrics(user_conn, request["script"], params.get(module.METRICS_TEXTFILE_PARAM_NAME))
+    except Exception as err:  # pylint: disable-msg=broad-except
+        request["message"] += f"\nMetrics not exported : {type(err).__name__} : {err}"
+    finally:
+        if user_conn is not None:
+            user_conn.close()
+        conn.close()
+        module.log_handler.close()
+    request["finished"] = time.time()
+
+    write_request(os.path.join(QUEUE_FOLDER, "done", name), request)
+    os.remove(running_path)
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the off-peak requests of the HRM-OMERO scripts")
+    parser.add_argument("--server", default="omero-server.epfl.ch", help="OMERO server address")
+    parser.add_argument("--port", type=int, default=4064, help="OMERO port")
+    parser.add_argument("--window", action="append", help="Off-peak window HH:MM-HH:MM (repeatable), "
+                                                          "20:00-07:00 by default")
+    parser.add_argument("--max-requests", type=int, default=2, help="Number of requests running at once")
+    parser.add_argument("--max-workers", type=int, help="Maximum parallel transfers of each request")
+    parser.add_argument("--max-bandwidth", type=int, help="Maximum bandwidth (MB/s) on the HRM-Share folder, "
+                                                          "shared by the requests running at once")
+    args = parser.parse_args()
+
+    windows = [parse_window(window) for window in (args.window or ["20:00-07:00"])]
+    max_bandwidth = max(1, args.max_bandwidth // args.max_requests) if args.max_bandwidth else None
+    for state in ("pending", "running", "done"):
+        os.makedirs(os.path.join(QUEUE_FOLDER, state), exist_ok=True)
+
+    # a single scheduler drains the queue at once
+    lock_file = open(os.path.join(QUEUE_FOLDER, "scheduler.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Another scheduler is draining the queue")
+        return
+
+    # requests left running by an interrupted scheduler are run again
+    for name in list_requests("running"):
+        os.replace(os.path.join(QUEUE_FOLDER, "running", name), os.path.join(QUEUE_FOLDER, "pending", name))
+    n_pruned = prune_results()
+    if n_pruned > 0:
+        print(f"{datetime.now():%Y-%m-%d %H:%M:%S} deleted {n_pruned} finished request(s) older than "
+              f"{RESULTS_MAX_AGE // (24 * 3600)} days")
+
+    n_done = 0
+    n_failed = 0
+    with ProcessPoolExecutor(max_workers=args.max_requests) as executor:
+        futures = {}
+        while True:
+            # no new request outside the windows ; the running ones are completed
+            pending = list_requests("pending")
+            while len(pending) > 0 and len(futures) < args.max_requests and in_window(windows, datetime.now()):
+                name = pending.pop(0)
+                os.replace(os.path.join(QUEUE_FOLDER, "pending", name), os.path.join(QUEUE_FOLDER, "running", name))
+                futures[executor.submit(run_request, name, args.server, args.port, args.max_workers,
+                                        max_bandwidth)] = name
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} started {name}")
+            if len(futures) == 0:
+                break
+
+            # wake up regularly to pick the requests queued in the meantime
+            done, _ = wait(futures, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    request = future.result()
+                except Exception as err:  # pylint: disable-msg=broad-except
+                    # a request crashing deterministically would crash every scheduler : it is reported as failed
+                    request = fail_request(name, err)
+                n_done += (1 if request["status"] == "done" else 0)
+                n_failed += (1 if request["status"] != "done" else 0)
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {request['status']} {name} "
+                      f"({request['finished'] - request['started']:.0f} s) : {request['message']}")
+
+    print(f"{n_done} request(s) done, {n_failed} failed, {len(list_requests('pending'))} pending")
+
+
+if __name__ == "__main__":
+    main()
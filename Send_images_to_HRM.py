@@ -1,6 +1,6 @@
 """
  MIF/Send_images_to_HRM.py
- Send all images in the specified containers (project, dataset, images) and save them in HRM-Share user folder
+ Send all images in the specified containers (project, dataset, images, screen, plate) and save them in HRM-Share user folder
 -----------------------------------------------------------------------------
   Copyright (C) 2023
   This program is free software; you can redistribute it and/or modify
@@ -18,18 +18,76 @@
 Created by Rémy Dornier
 """
 import omero
-from omero.gateway import BlitzGateway
+from omero.gateway import BlitzGateway, ImageWrapper
 import omero.scripts as scripts
 import os
 import sys
-from omero.rtypes import rstring
-from omero.plugins.download import DownloadControl
+import json
+import logging
+import shutil
+import socket
+import time
+from datetime import datetime
+from omero.rtypes import rstring, rlist, rlong, rtime, unwrap, robject
+from omero.model.enums import UnitsLength, UnitsTime
+from omero_hrm_common import (LOG_LEVELS, OFF_PEAK_PARAM_NAME, SUCCESS, SessionKeeper, call_with_retry,
+                              close_user_connections, concurrency, enqueue_request, export_metrics,
+                              get_group_connection, log_handler, metrics, report_queued_results,
+                              schedule_round_robin, set_log_level, throttle)
 
 
 DATA_TYPE_PARAM_NAME = "Data_Type"
 OVERWRITE_PARAM_NAME = "Overwrite_images_on_HRM"
 ID_PARAM_NAME = "IDs"
+WORKERS_PARAM_NAME = "Parallel_downloads"
+MAX_DOWNLOADS_PER_USER_PARAM_NAME = "Max_parallel_downloads_per_user"
+ADAPTIVE_WORKERS_PARAM_NAME = "Adapt_parallel_downloads"
+MIN_WORKERS_PARAM_NAME = "Min_parallel_downloads"
+TAGS_FILTER_PARAM_NAME = "Filter_tags"
+NAME_FILTER_PARAM_NAME = "Filter_name_pattern"
+ACQUIRED_AFTER_FILTER_PARAM_NAME = "Filter_acquired_after"
+ACQUIRED_BEFORE_FILTER_PARAM_NAME = "Filter_acquired_before"
+MAX_SIZE_FILTER_PARAM_NAME = "Filter_max_size_MB"
+MAX_CHANNELS_FILTER_PARAM_NAME = "Filter_max_channels"
+METADATA_PARAM_NAME = "Export_metadata_sidecar"
+MAX_BANDWIDTH_PARAM_NAME = "Max_bandwidth_MB_per_s"
+MAX_USER_BANDWIDTH_PARAM_NAME = "Max_bandwidth_per_user_MB_per_s"
+MAX_FILE_OPS_PARAM_NAME = "Max_file_operations_per_s"
+MAX_USER_FILE_OPS_PARAM_NAME = "Max_file_operations_per_user_per_s"
+METRICS_TEXTFILE_PARAM_NAME = "Metrics_textfile_directory"
+LOG_LEVEL_PARAM_NAME = "Log_level"
+
+logger = logging.getLogger("omero-hrm.send")
 downloaded_fileset = []
+# filters on the images to send {parameter name: value}, applied by the queries listing the images, and number of
+# selected images that do not match them (None if no filter is set)
+image_filters = {}
+n_filtered_out_images = None
+# IDs of the filesets already on HRM, kept as they are when the images are not overwritten
+existing_fileset_ids = set()
+# write a JSON metadata sidecar next to each fileset, with metadata prefetched by batch {image id: metadata}
+export_metadata_sidecar = False
+image_metadata = {}
+METADATA_BATCH_SIZE = 500
+# OMERO enumeration values and their HRM counterparts in the sidecar ; values without counterpart are left out (None)
+HRM_OBJECTIVE_TYPES = {"Oil": "oil", "Water": "water", "WaterDipping": "water", "Glycerol": "glycerol"}
+HRM_MICROSCOPE_TYPES = {"WideField": "widefield", "LaserScanningConfocalMicroscopy": "confocal",
+                        "SpinningDiskConfocal": "spinning disk", "MultiPhotonMicroscopy": "multiphoton"}
+# screens and plates are sent to Raw/omero/Screen_<id>_<name>/Plate_<id>_<name>, so that their folders are never
+# mistaken for project and dataset folders (<id>_<name>) when the results are retrieved
+SCREEN_FOLDER_PREFIX = "Screen_"
+PLATE_FOLDER_PREFIX = "Plate_"
+# filesets are downloaded in a hidden staging folder next to their final folder, then renamed once complete.
+# Staging folders are named after the host and process writing them (<name>@<host>@<pid>, "@" being neither in
+# host names nor in fileset names), so that the ones left by dead processes of this host are reclaimed at once ;
+# the other ones (whose PID may also have been reused after a reboot) are reclaimed after STAGING_MAX_AGE seconds
+# without modification
+STAGING_PREFIX = ".staging_"
+STAGING_OWNER_SEPARATOR = "@"
+STAGING_OWNER = f"{socket.gethostname()}{STAGING_OWNER_SEPARATOR}{os.getpid()}"
+STAGING_MAX_AGE = 6 * 3600
+# files are read from OMERO by chunks, each chunk being accounted to the throttle of the HRM-Share folder
+DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
 
 
 class StdOutHandle:
@@ -43,6 +101,44 @@ class StdOutHandle:
         return sys.stdout.write(b.decode('ascii', 'replace'))
 
 
+def download_original_file(conn, original_file, target_path, hrm_user):
+    """
+    Read an original file from OMERO by chunks and write it to target_path, waiting before each chunk as long as the
+    bandwidth limits of the HRM user (whose folder is written) require
+    """
+    raw_file_store = conn.createRawFileStore()
+    try:
+        raw_file_store.setFileId(original_file.getId(), conn.SERVICE_OPTS)
+        size = original_file.getSize()
+        offset = 0
+        with open(target_path, "wb") as stream:
+            while offset < size:
+                n_bytes = min(DOWNLOAD_CHUNK_BYTES, size - offset)
+                throttle.consume(hrm_user, n_bytes)
+                stream.write(raw_file_store.read(offset, n_bytes))
+                offset += n_bytes
+    finally:
+        raw_file_store.close()
+
+
+def download_fileset(conn, fset, path, hrm_user):
+    """
+    Download all files of a fileset, with the folder layout of the managed repository (as omero download does),
+    removing the partially downloaded files on failure so that it can be retried
+    """
+    try:
+        template_prefix = fset.getTemplatePrefix()
+        for original_file in fset.listFiles():
+            target_folder = os.path.join(path, original_file.getPath().replace(template_prefix, ""))
+            os.makedirs(target_folder, exist_ok=True)
+            throttle.consume(hrm_user, n_ops=1)
+            download_original_file(conn, original_file, os.path.join(target_folder, original_file.getName()), hrm_user)
+    except Exception:
+        if os.path.isdir(path):
+            delete_previous_fileset(path)
+        raise
+
+
 def download_image(conn, target_obj, path, download_existing_images):
     """
     Download an image to the given path
@@ -56,34 +152,291 @@ def download_image(conn, target_obj, path, download_existing_images):
     fset_id = fset.getId()
 
     if not fset:
-        print("ERROR", f"ERROR: no original file(s) for [%s] found!" % target_obj.getId())
+        logger.error("ERROR: no original file(s) for [%s] found!", target_obj.getId())
         return False
 
     if fset_id in downloaded_fileset:
-        print("WARNING", f"Image part of the same fileset %s! Skipping..." % fset_id)
+        logger.warning("Image part of the same fileset %s! Skipping...", fset_id)
         return True
 
     # mimic the Java gateway download by adding a fileset folder
-    path = os.path.join(path, "Fileset_%s" % fset.getId())
+    dataset_path = path
+    path = os.path.join(dataset_path, "Fileset_%s" % fset.getId())
 
-    if download_existing_images and os.path.exists(path) and len(os.listdir(path)) > 0:
-        delete_previous_fileset(path)
+    if not download_existing_images and os.path.exists(path) and len(os.listdir(path)) > 0:
+        logger.warning("Fileset %s already exists in '%s'! Skipping...", fset_id, path)
+        downloaded_fileset.append(fset.getId())
+        existing_fileset_ids.add(fset_id)
+        return True
 
-    dc = DownloadControl()
+    # HRM only sees the fileset once it is complete
+    staging_path = os.path.join(dataset_path,
+                                f"{STAGING_PREFIX}Fileset_{fset_id}{STAGING_OWNER_SEPARATOR}{STAGING_OWNER}")
     downloaded = False
     try:
-        dc.download_fileset(conn, fset, path)
+        start = time.perf_counter()
+        # the limits apply to the HRM user whose folder is written, i.e. the user of the connection
+        hrm_user = conn.getUser().getOmeName()
+        call_with_retry(conn, download_fileset, conn, fset, staging_path, hrm_user)
+        metrics.record("download", time.perf_counter() - start, get_folder_size(staging_path))
+        # the sidecar is in place before HRM can see the fileset
+        if export_metadata_sidecar:
+            with metrics.stage("sidecar"):
+                write_metadata_sidecar(conn, target_obj, fset_id, path)
+        with metrics.stage("publish"):
+            fsync_folder(staging_path)
+            throttle.consume(hrm_user, n_ops=1)
+            publish_fileset(staging_path, path)
         downloaded = True
-        print("SUCCESS", f"downloading fileset %s to '%s' done !" % (fset_id, path))
+        logger.log(SUCCESS, "downloading fileset %s to '%s' done !", fset_id, path)
     except omero.ValidationException or omero.ResourceError as err:
-        print("ERROR", f"ERROR: downloading fileset %s to '%s' failed: \n %s" % (fset_id, path, err.message))
+        logger.error("ERROR: downloading fileset %s to '%s' failed: \n %s", fset_id, path, err.message)
     except Exception as err:
-        print("ERROR", f"ERROR: downloading fileset %s to '%s' failed: \n %s" % (fset_id, path, err))
+        logger.error("ERROR: downloading fileset %s to '%s' failed: \n %s", fset_id, path, err)
+    finally:
+        if os.path.isdir(staging_path):
+            shutil.rmtree(staging_path, ignore_errors=True)
+        # no sidecar without its fileset
+        if not downloaded and not os.path.isdir(path) and os.path.isfile(path + ".json"):
+            os.remove(path + ".json")
 
     downloaded_fileset.append(fset.getId())
     return downloaded
 
 
+def fsync_folder_entry(folder_path):
+    """
+    Flush the entries (not the content) of a folder to disk
+    """
+    fd = os.open(folder_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_folder(folder_path):
+    """
+    Flush the files of a folder (recursively) and the folder itself to disk
+    """
+    for folder, _, files in os.walk(folder_path):
+        for file in files:
+            fd = os.open(os.path.join(folder, file), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    fsync_folder_entry(folder_path)
+
+
+def publish_fileset(staging_path, path):
+    """
+    Rename a complete staging folder to its final fileset folder, on the same filesystem.
+    A previous version of the fileset is first moved aside (hidden), then deleted once the new one is in place.
+    """
+    previous_path = None
+    if os.path.exists(path):
+        previous_path = staging_path + ".previous"
+        os.rename(path, previous_path)
+    os.rename(staging_path, path)
+    # make the rename itself durable
+    fsync_folder_entry(os.path.dirname(path))
+    if previous_path is not None:
+        with metrics.stage("delete_previous"):
+            shutil.rmtree(previous_path, ignore_errors=True)
+
+
+def is_stale_staging_folder(staging_path):
+    """
+    return True if the process writing the staging folder is dead (same host),
+    or if the folder has not been modified for STAGING_MAX_AGE seconds (any host)
+    """
+    name = os.path.basename(staging_path)
+    if name.endswith(".previous"):
+        name = name[:-len(".previous")]
+    fields = name.split(STAGING_OWNER_SEPARATOR)
+    if len(fields) == 3 and fields[1] == socket.gethostname() and fields[2].isdigit():
+        try:
+            os.kill(int(fields[2]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # process of another user
+            pass
+        # a live PID may belong to another process after a reboot or a PID wraparound : checked on the age as well
+
+    last_modified = os.path.getmtime(staging_path)
+    for folder, _, files in os.walk(staging_path):
+        for file in files:
+            last_modified = max(last_modified, os.path.getmtime(os.path.join(folder, file)))
+    return time.time() - last_modified > STAGING_MAX_AGE
+
+
+def reclaim_stale_staging_folders(owner_root):
+    """
+    Delete the staging folders (and metadata sidecars) left by interrupted sends in Raw/omero/<project>/<dataset>/
+    return the number of reclaimed folders
+    """
+    omero_folder = os.path.join(owner_root, "Raw", "omero")
+    if not os.path.isdir(omero_folder):
+        return 0
+
+    n_reclaimed = 0
+    for project in os.scandir(omero_folder):
+        if not project.is_dir():
+            continue
+        for dataset in os.scandir(project.path):
+            if not dataset.is_dir():
+                continue
+            for entry in os.scandir(dataset.path):
+                if entry.name.startswith(STAGING_PREFIX) and is_stale_staging_folder(entry.path):
+                    logger.info("Reclaim stale staging folder [%s]", entry.path)
+                    if entry.is_dir():
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                    n_reclaimed += 1
+    return n_reclaimed
+
+
+def prefetch_image_metadata(conn, image_ids):
+    """
+    Load, in batched queries, the pixels, channels, logical channels and objective of the given images
+    and store their metadata in image_metadata
+    """
+    image_ids = [image_id for image_id in image_ids if image_id not in image_metadata]
+    if not export_metadata_sidecar or len(image_ids) == 0:
+        return
+
+    query = "select i from Image i join fetch i.pixels px join fetch px.pixelsType " \
+            "left outer join fetch px.channels c left outer join fetch c.logicalChannel lc " \
+            "left outer join fetch lc.mode left outer join fetch lc.illumination " \
+            "left outer join fetch i.objectiveSettings os left outer join fetch os.objective o " \
+            "left outer join fetch o.immersion where i.id in (:ids)"
+    for start in range(0, len(image_ids), METADATA_BATCH_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids[start:start + METADATA_BATCH_SIZE])
+        with metrics.stage("metadata_query"):
+            images = conn.getQueryService().findAllByQuery(query, params, {"omero.group": "-1"})
+        for image in images:
+            image_metadata[image.getId().getValue()] = build_image_metadata(image)
+
+
+def convert_unit(value, unit):
+    """
+    Convert an OMERO length or time in the given unit
+    return the converted value, None if the value is not set
+    """
+    if value is None:
+        return None
+    if isinstance(unit, type(UnitsLength.MICROMETER)):
+        return omero.model.LengthI(value, unit).getValue()
+    return omero.model.TimeI(value, unit).getValue()
+
+
+def build_image_metadata(image):
+    """
+    Build the metadata of an image (omero.model.ImageI with loaded pixels, channels and objective)
+    as a dict with raw OMERO values and the corresponding HRM template parameters
+    """
+    pixels = image.getPrimaryPixels()
+    channels = []
+    for channel in pixels.copyChannels():
+        logical_channel = channel.getLogicalChannel()
+        mode = logical_channel.getMode()
+        illumination = logical_channel.getIllumination()
+        channels.append({
+            "name": unwrap(logical_channel.getName()),
+            "excitation_wavelength_nm": convert_unit(logical_channel.getExcitationWave(), UnitsLength.NANOMETER),
+            "emission_wavelength_nm": convert_unit(logical_channel.getEmissionWave(), UnitsLength.NANOMETER),
+            "pinhole_size_um": convert_unit(logical_channel.getPinHoleSize(), UnitsLength.MICROMETER),
+            "acquisition_mode": None if mode is None else unwrap(mode.getValue()),
+            "illumination": None if illumination is None else unwrap(illumination.getValue()),
+        })
+
+    objective = {}
+    refractive_index = None
+    objective_settings = image.getObjectiveSettings()
+    if objective_settings is not None:
+        refractive_index = unwrap(objective_settings.getRefractiveIndex())
+        if objective_settings.getObjective() is not None:
+            omero_objective = objective_settings.getObjective()
+            immersion = omero_objective.getImmersion()
+            objective = {
+                "model": unwrap(omero_objective.getModel()),
+                "nominal_magnification": unwrap(omero_objective.getNominalMagnification()),
+                "lens_na": unwrap(omero_objective.getLensNA()),
+                "immersion": None if immersion is None else unwrap(immersion.getValue()),
+            }
+
+    metadata = {
+        "image_id": image.getId().getValue(),
+        "image_name": unwrap(image.getName()),
+        "size": {"x": unwrap(pixels.getSizeX()), "y": unwrap(pixels.getSizeY()), "z": unwrap(pixels.getSizeZ()),
+                 "c": unwrap(pixels.getSizeC()), "t": unwrap(pixels.getSizeT())},
+        "pixel_type": unwrap(pixels.getPixelsType().getValue()),
+        "pixel_size_um": {"x": convert_unit(pixels.getPhysicalSizeX(), UnitsLength.MICROMETER),
+                          "y": convert_unit(pixels.getPhysicalSizeY(), UnitsLength.MICROMETER),
+                          "z": convert_unit(pixels.getPhysicalSizeZ(), UnitsLength.MICROMETER)},
+        "time_interval_s": convert_unit(pixels.getTimeIncrement(), UnitsTime.SECOND),
+        "objective": objective,
+        "objective_refractive_index": refractive_index,
+        "channels": channels,
+    }
+
+    # same parameters, named as in HRM templates (nm for sizes)
+    pixel_size = metadata["pixel_size_um"]
+    metadata["hrm"] = {
+        "NumberOfChannels": metadata["size"]["c"],
+        "CCDCaptorSizeX": None if pixel_size["x"] is None else pixel_size["x"] * 1000,
+        "ZStepSize": None if pixel_size["z"] is None else pixel_size["z"] * 1000,
+        "TimeInterval": metadata["time_interval_s"],
+        "NumericalAperture": objective.get("lens_na"),
+        "ObjectiveType": HRM_OBJECTIVE_TYPES.get(objective.get("immersion")),
+        "ExcitationWavelength": [channel["excitation_wavelength_nm"] for channel in channels],
+        "EmissionWavelength": [channel["emission_wavelength_nm"] for channel in channels],
+        "PinholeSize": [None if channel["pinhole_size_um"] is None else channel["pinhole_size_um"] * 1000
+                        for channel in channels],
+        "MicroscopeType": [HRM_MICROSCOPE_TYPES.get(channel["acquisition_mode"]) for channel in channels],
+    }
+    return metadata
+
+
+def write_metadata_sidecar(conn, target_obj, fset_id, fileset_path):
+    """
+    Write the image metadata as a JSON sidecar (Fileset_ID.json) next to the fileset folder
+    """
+    if target_obj.getId() not in image_metadata:
+        prefetch_image_metadata(conn, [target_obj.getId()])
+    metadata = image_metadata.get(target_obj.getId())
+    if metadata is None:
+        logger.warning("No metadata found for image %s", target_obj.getId())
+        return
+
+    sidecar_path = fileset_path + ".json"
+    # written aside (hidden) then renamed, like the fileset
+    staging_sidecar_path = os.path.join(os.path.dirname(fileset_path),
+                                        f"{STAGING_PREFIX}{os.path.basename(sidecar_path)}"
+                                        f"{STAGING_OWNER_SEPARATOR}{STAGING_OWNER}")
+    try:
+        with open(staging_sidecar_path, "w", encoding="utf-8") as sidecar:
+            json.dump(dict(metadata, fileset_id=fset_id), sidecar, indent=2)
+        os.replace(staging_sidecar_path, sidecar_path)
+        logger.info("Metadata written to '%s'", sidecar_path)
+    except (OSError, TypeError) as err:
+        logger.error("ERROR: writing metadata to '%s' failed: %s", sidecar_path, err)
+
+
+def get_folder_size(folder_path):
+    """
+    return the total size, in bytes, of the files within a folder (recursively)
+    """
+    size = 0
+    for folder, _, files in os.walk(folder_path):
+        size += sum(os.path.getsize(os.path.join(folder, file)) for file in files)
+    return size
+
+
 def delete_previous_fileset(fileset_path):
     """Delete image in the raw folder
     ----------
@@ -94,11 +447,11 @@ def delete_previous_fileset(fileset_path):
         # check if current path is a file
         file = os.path.join(fileset_path, path)
         if os.path.isfile(file):
-            print("INFO", f"Delete file [%s]" % file)
+            logger.info("Delete file [%s]", file)
             os.remove(file)
         else:
             delete_previous_fileset(file)
-            print("INFO", f"Delete folder [%s]" % file)
+            logger.info("Delete folder [%s]", file)
             os.rmdir(file)
 
 
@@ -134,11 +487,22 @@ def process_image(conn, image, root, download_existing_images):
     Download the image
     return 1 if owner has been added, 0 otherwise
     """
+    if any(image_filters.values()):
+        params = omero.sys.ParametersI()
+        params.addId(image.getId())
+        with metrics.stage("list_query"):
+            if len(list_filtered_images(conn, "i.id = :id", params)) == 0:
+                logger.info("Image %s does not match the filters! Skipping...", image.getId())
+                return 0
 
     dataset = image.getParent()
     if dataset is None:
         dataset_name = "None"
         project_name = "None"
+        # images of a plate go to the screen/plate folder
+        filesets = list_hcs_filesets(conn, 'Image', image.getId())
+        if len(filesets) > 0:
+            _, project_name, dataset_name, _ = list(filesets.values())[0]
     else:
         dataset_name = "{}_{}".format(dataset.getId(), dataset.getName())
         project = dataset.getParent()
@@ -147,7 +511,8 @@ def process_image(conn, image, root, download_existing_images):
         else:
             project_name = "{}_{}".format(project.getId(), project.getName())
 
-    path = build_path(root, project_name, dataset_name)
+    with metrics.stage("build_path"):
+        path = build_path(root, project_name, dataset_name)
 
     if path is None:
         return 0
@@ -163,16 +528,27 @@ def process_dataset(conn, dataset, project_name, root, download_existing_images)
     n_image = 0
     tot_image = 0
     dataset_name = "{}_{}".format(dataset.getId(), dataset.getName())
-    path = build_path(root, project_name, dataset_name)
+    with metrics.stage("build_path"):
+        path = build_path(root, project_name, dataset_name)
 
     if path is None:
         return 0
 
-    for image in dataset.listChildren():
+    # only the images matching the filters are listed, prefetched and expected for the dataset to be complete
+    with metrics.stage("list_query"):
+        if any(image_filters.values()):
+            params = omero.sys.ParametersI()
+            params.addId(dataset.getId())
+            images = list_filtered_images(
+                conn, "i.id in (select dl.child.id from DatasetImageLink dl where dl.parent.id = :id)", params)
+        else:
+            images = list(dataset.listChildren())
+    prefetch_image_metadata(conn, [image.getId() for image in images])
+    for image in images:
         n_image += (1 if download_image(conn, image, path, download_existing_images) else 0)
         tot_image += 1
 
-    return n_image, (1 if n_image == dataset.countChildren() else 0), tot_image
+    return n_image, (1 if n_image == len(images) else 0), tot_image
 
 
 def process_project(conn, project, root, download_existing_images):
@@ -196,6 +572,257 @@ def process_project(conn, project, root, download_existing_images):
     return n_image, n_dataset, (1 if n_dataset == project.countChildren() else 0), tot_image, tot_dataset
 
 
+def list_hcs_filesets(conn, object_type, object_id):
+    """
+    Load, in a single query, the wells, well samples and filesets of the given screen, plate or plate image,
+    for the images matching the filters. Images sharing the same fileset are only listed once.
+    return a dict {fileset id: (image id, screen name, plate name, plate id)}
+    """
+    column = {'Screen': 's', 'Plate': 'p', 'Image': 'i'}[object_type]
+    params = omero.sys.ParametersI()
+    params.addId(object_id)
+    query = "select f.id, i.id, s.id, s.name, p.id, p.name from WellSample ws " \
+            "join ws.well w join w.plate p join ws.image i join i.fileset f " \
+            "left outer join p.screenLinks sl left outer join sl.parent s " \
+            "where " + " and ".join(add_filter_conditions([f"{column}.id = :id"], params)) + " order by i.id"
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+
+    filesets = {}
+    for row in rows:
+        fileset_id, image_id, screen_id, screen_name, plate_id, plate_name = \
+            [None if value is None else value.val for value in row]
+        if fileset_id in filesets:
+            continue
+        screen_name = "None" if screen_id is None else "{}{}_{}".format(SCREEN_FOLDER_PREFIX, screen_id, screen_name)
+        plate_name = "{}{}_{}".format(PLATE_FOLDER_PREFIX, plate_id, plate_name)
+        filesets[fileset_id] = (image_id, screen_name, plate_name, plate_id)
+    return filesets
+
+
+def process_hcs(conn, object_type, omero_object, root, download_existing_images):
+    """
+    Download all images of the given screen or plate, once per fileset, in
+    Raw/omero/Screen_<id>_<name>/Plate_<id>_<name>/Fileset_ID
+    return the number of downloaded filesets & complete plates, and the total number of filesets & plates
+    """
+    with metrics.stage("list_query"):
+        filesets = list_hcs_filesets(conn, object_type, omero_object.getId())
+    prefetch_image_metadata(conn, [image_id for image_id, _, _, _ in filesets.values()])
+    plate_downloaded = {}
+    n_fileset = 0
+    for image_id, screen_name, plate_name, plate_id in filesets.values():
+        with metrics.stage("build_path"):
+            path = build_path(root, screen_name, plate_name)
+        image = conn.getObject("Image", image_id)
+        downloaded = path is not None and image is not None and \
+            download_image(conn, image, path, download_existing_images)
+        n_fileset += (1 if downloaded else 0)
+        plate_downloaded[plate_id] = plate_downloaded.get(plate_id, True) and downloaded
+
+    n_plate = sum(1 for downloaded in plate_downloaded.values() if downloaded)
+    return n_fileset, n_plate, len(filesets), len(plate_downloaded)
+
+
+def list_owner_filesets(conn, object_type, object_id_list):
+    """
+    Resolve, in a single query, all the images owned by the given experimenter(s) or belonging to the given group(s),
+    and matching the filters. Experimenters and groups can be given by ID or by name.
+    return a dict {owner name: {fileset id: (image id, group id, group name, project name, dataset name)}}
+    and the number of images
+    """
+    ids = [int(object_id) for object_id in object_id_list if str(object_id).isdigit()]
+    names = [str(object_id) for object_id in object_id_list if not str(object_id).isdigit()]
+
+    if object_type == 'Experimenter':
+        condition = "o.id in (:ids) or o.omeName in (:names)"
+    else:
+        condition = "g.id in (:ids) or g.name in (:names)"
+
+    params = omero.sys.ParametersI()
+    # HQL does not accept empty lists
+    params.add("ids", rlist([rlong(object_id) for object_id in ids] or [rlong(-1)]))
+    params.add("names", rlist([rstring(name) for name in names] or [rstring("")]))
+    query = "select i.id, o.omeName, g.id, g.name, f.id, d.id, d.name, p.id, p.name from Image i " \
+            "join i.details.owner o join i.details.group g left outer join i.fileset f " \
+            "left outer join i.datasetLinks dl left outer join dl.parent d " \
+            "left outer join d.projectLinks pl left outer join pl.parent p " \
+            "where " + " and ".join(add_filter_conditions([f"({condition})"], params)) + " order by i.id"
+    rows = conn.getQueryService().projection(query, params, {"omero.group": "-1"})
+
+    owner_filesets = {}
+    image_ids = set()
+    for row in rows:
+        image_id, owner, group_id, group_name, fileset_id, dataset_id, dataset_name, project_id, project_name = \
+            [None if value is None else value.val for value in row]
+        image_ids.add(image_id)
+        if fileset_id is None:
+            logger.error("ERROR: no original file(s) for [%s] found!", image_id)
+            continue
+        filesets = owner_filesets.setdefault(owner, {})
+        # an image in several datasets, or several images of the same fileset, are downloaded once
+        if fileset_id in filesets:
+            continue
+        dataset_name = "None" if dataset_id is None else "{}_{}".format(dataset_id, dataset_name)
+        project_name = "None" if project_id is None else "{}_{}".format(project_id, project_name)
+        filesets[fileset_id] = (image_id, group_id, group_name, project_name, dataset_name)
+
+    return owner_filesets, len(image_ids)
+
+
+def parse_date(date_str):
+    """
+    Parse a YYYY-MM-DD date
+    return the date in milliseconds since epoch
+    """
+    return int(datetime.strptime(date_str.strip(), "%Y-%m-%d").timestamp() * 1000)
+
+
+def add_filter_conditions(conditions, params):
+    """
+    Add the conditions of the image filters (tags, name pattern with * and ? wildcards, acquisition date range,
+    max fileset size, max number of channels) on the image `i` of a query, and their parameters
+    return the conditions
+    """
+    if image_filters.get(TAGS_FILTER_PARAM_NAME):
+        conditions.append("i.id in (select al.parent.id from ImageAnnotationLink al, TagAnnotation t "
+                          "where al.child.id = t.id and lower(t.textValue) in (:tags))")
+        params.add("tags", rlist([rstring(tag.strip().lower()) for tag in image_filters[TAGS_FILTER_PARAM_NAME]]))
+    if image_filters.get(NAME_FILTER_PARAM_NAME):
+        conditions.append("i.name like :name")
+        params.add("name", rstring(image_filters[NAME_FILTER_PARAM_NAME].replace("*", "%").replace("?", "_")))
+    if image_filters.get(ACQUIRED_AFTER_FILTER_PARAM_NAME):
+        conditions.append("i.acquisitionDate >= :after")
+        params.add("after", rtime(parse_date(image_filters[ACQUIRED_AFTER_FILTER_PARAM_NAME])))
+    if image_filters.get(ACQUIRED_BEFORE_FILTER_PARAM_NAME):
+        # include the whole day
+        conditions.append("i.acquisitionDate < :before")
+        params.add("before", rtime(parse_date(image_filters[ACQUIRED_BEFORE_FILTER_PARAM_NAME]) + 24 * 3600 * 1000))
+    if image_filters.get(MAX_SIZE_FILTER_PARAM_NAME):
+        conditions.append("(select sum(fe.originalFile.size) from FilesetEntry fe where fe.fileset.id = i.fileset.id)"
+                          " <= :max_size")
+        params.add("max_size", rlong(image_filters[MAX_SIZE_FILTER_PARAM_NAME] * 1024 * 1024))
+    if image_filters.get(MAX_CHANNELS_FILTER_PARAM_NAME):
+        conditions.append("i.id in (select px.image.id from Pixels px where px.sizeC <= :max_channels)")
+        params.add("max_channels", rlong(image_filters[MAX_CHANNELS_FILTER_PARAM_NAME]))
+    return conditions
+
+
+def list_filtered_images(conn, condition, params):
+    """
+    Load, in a single query, the images matching the given condition (on the image `i`) and the filters
+    return the list of images, ordered by ID
+    """
+    conditions = add_filter_conditions([condition], params)
+    query = "select i from Image i join fetch i.details.owner join fetch i.details.group " \
+            "where " + " and ".join(conditions) + " order by i.id"
+    return [ImageWrapper(conn, image) for image in conn.getQueryService().findAllByQuery(query, params,
+                                                                                         conn.SERVICE_OPTS)]
+
+
+def count_filtered_out_images(conn, object_type, object_id_list):
+    """
+    Count the images within the given objects that do not match the filters, for the summary message
+    return the number of images, None if no filter is set
+    """
+    if not any(image_filters.values()):
+        return None
+
+    ids = [int(object_id) for object_id in object_id_list if str(object_id).isdigit()]
+    names = [str(object_id) for object_id in object_id_list if not str(object_id).isdigit()]
+    params = omero.sys.ParametersI()
+    # HQL does not accept empty lists
+    params.add("ids", rlist([rlong(object_id) for object_id in ids] or [rlong(-1)]))
+    params.add("names", rlist([rstring(name) for name in names] or [rstring("")]))
+
+    # images within the selected objects
+    condition = {
+        'Image': "i.id in (:ids)",
+        'Dataset': "i.id in (select dl.child.id from DatasetImageLink dl where dl.parent.id in (:ids))",
+        'Project': "i.id in (select dl.child.id from DatasetImageLink dl, ProjectDatasetLink pl "
+                   "where dl.parent.id = pl.child.id and pl.parent.id in (:ids))",
+        'Plate': "i.id in (select ws.image.id from WellSample ws where ws.well.plate.id in (:ids))",
+        'Screen': "i.id in (select ws.image.id from WellSample ws, ScreenPlateLink sl "
+                  "where ws.well.plate.id = sl.child.id and sl.parent.id in (:ids))",
+        'Experimenter': "(i.details.owner.id in (:ids) or i.details.owner.omeName in (:names))",
+        'ExperimenterGroup': "(i.details.group.id in (:ids) or i.details.group.name in (:names))",
+    }[object_type]
+    query = "select count(i.id) from Image i where "
+    query_service = conn.getQueryService()
+    n_selected = query_service.projection(query + condition, params, {"omero.group": "-1"})[0][0].val
+    conditions = add_filter_conditions([condition], params)
+    n_matching = query_service.projection(query + " and ".join(conditions), params, {"omero.group": "-1"})[0][0].val
+    return n_selected - n_matching
+
+
+def download_owners_images_for_hrm(conn, object_type, object_id_list, root, download_existing_images,
+                                   workers, max_downloads_per_user):
+    """
+    Download all images of the given experimenter(s) or group(s) in the HRM folder of each image owner,
+    using one session per owner and group (whose group context is set once, so that the downloads of several groups
+    can run concurrently) and spreading the downloads across owners.
+    return the summary message
+    """
+    with metrics.stage("list_query"):
+        owner_filesets, tot_image = list_owner_filesets(conn, object_type, object_id_list)
+
+    # sessions of other users can only be opened by admins
+    user_name = conn.getUser().getOmeName()
+    other_owners = [owner for owner in owner_filesets if owner != user_name]
+    if len(other_owners) > 0 and not conn.getUser().isAdmin():
+        message = "Only OMERO admins can send the images of other users to HRM ({} image(s) of {} other " \
+                  "user(s) selected)".format(tot_image, len(other_owners))
+        logger.error("%s", message)
+        return message
+
+    group_connections = {}
+    user_tasks = {}
+    # the downloads run for hours on the sudo sessions, which must not idle meanwhile
+    session_keeper = SessionKeeper(group_connections)
+    session_keeper.start()
+    try:
+        for owner, filesets in owner_filesets.items():
+            owner_root = os.path.join(root, owner)
+            if not os.path.isdir(owner_root):
+                logger.warning("%s doesn't have an active account on HRM. Skipping %s fileset(s)",
+                               owner, len(filesets))
+                continue
+            tasks = [task for task in filesets.values()
+                     if get_group_connection(conn, owner, task[1], task[2], group_connections) is not None]
+            if len(tasks) == 0:
+                continue
+            with metrics.stage("reclaim_staging"):
+                reclaim_stale_staging_folders(owner_root)
+            # keep the images of a group together
+            user_tasks[owner] = sorted(tasks, key=lambda task: task[1])
+            prefetch_image_metadata(conn, [task[0] for task in tasks])
+
+        def run_task(owner, task):
+            image_id, group_id, _, project_name, dataset_name = task
+            # the group context of this connection is never changed
+            group_conn = group_connections[(owner, group_id)]
+            image = group_conn.getObject("Image", image_id)
+            with metrics.stage("build_path"):
+                path = build_path(os.path.join(root, owner), project_name, dataset_name)
+            if image is None or path is None:
+                return 0
+            return 1 if download_image(group_conn, image, path, download_existing_images) else 0
+
+        n_fileset = sum(schedule_round_robin(user_tasks, workers, max_downloads_per_user, run_task, concurrency))
+    finally:
+        session_keeper.stop()
+        close_user_connections(conn, group_connections)
+
+    tot_fileset = sum(len(filesets) for filesets in owner_filesets.values())
+    message = "Downloaded {}/{} fileset(s) ({} image(s)) for {}/{} user(s)".format(n_fileset, tot_fileset, tot_image,
+                                                                                  len(user_tasks), len(owner_filesets))
+    if n_filtered_out_images is not None:
+        message += ", {} image(s) skipped by filters".format(n_filtered_out_images)
+    if len(existing_fileset_ids) > 0:
+        message += ", {} fileset(s) already on HRM kept".format(len(existing_fileset_ids))
+    logger.info("%s", message)
+    return message
+
+
 def download_images_for_hrm(conn, script_params):
     """
     Get the given container(s) or given experimenter(s) and scan all their children to add
@@ -210,21 +837,59 @@ def download_images_for_hrm(conn, script_params):
     root = "/mnt/hrmshare"  # script_params["HRM_path"]
     # boolean to overwrite
     download_existing_images = script_params[OVERWRITE_PARAM_NAME]
+    # number of parallel downloads, overall and per user
+    workers = script_params[WORKERS_PARAM_NAME]
+    max_downloads_per_user = script_params[MAX_DOWNLOADS_PER_USER_PARAM_NAME]
+    # number of downloads at once, adapted between the minimum and the number of parallel downloads if requested
+    min_workers = script_params.get(MIN_WORKERS_PARAM_NAME, 1) if script_params.get(ADAPTIVE_WORKERS_PARAM_NAME) \
+        else workers
+    concurrency.configure(min_workers, workers)
+    # bandwidth and file operations limits on the HRM-Share folder
+    throttle.configure(bytes_per_s=(script_params.get(MAX_BANDWIDTH_PARAM_NAME) or 0) * 1024 ** 2,
+                       ops_per_s=script_params.get(MAX_FILE_OPS_PARAM_NAME) or 0,
+                       user_bytes_per_s=(script_params.get(MAX_USER_BANDWIDTH_PARAM_NAME) or 0) * 1024 ** 2,
+                       user_ops_per_s=script_params.get(MAX_USER_FILE_OPS_PARAM_NAME) or 0)
+    # optional filters on the images to send
+    filters = {key: script_params.get(key) for key in [TAGS_FILTER_PARAM_NAME, NAME_FILTER_PARAM_NAME,
+                                                       ACQUIRED_AFTER_FILTER_PARAM_NAME,
+                                                       ACQUIRED_BEFORE_FILTER_PARAM_NAME,
+                                                       MAX_SIZE_FILTER_PARAM_NAME, MAX_CHANNELS_FILTER_PARAM_NAME]}
 
     n_image = 0
     n_dataset = 0
     n_project = 0
+    n_plate = 0
+    n_screen = 0
     tot_image = 0
     tot_dataset = 0
     tot_project = 0
+    tot_plate = 0
+    tot_screen = 0
+
+    # select the images matching the filters
+    global image_filters, n_filtered_out_images, export_metadata_sidecar
+    export_metadata_sidecar = script_params.get(METADATA_PARAM_NAME, False)
+    image_filters = filters
+    try:
+        with metrics.stage("filter_query"):
+            n_filtered_out_images = count_filtered_out_images(conn, object_type, object_id_list)
+    except ValueError as err:
+        message = f"Invalid acquisition date, expecting YYYY-MM-DD : {err}"
+        logger.info("%s", message)
+        return message
 
     # check if the root directory exists ==> necessary because sv-nas1 server is mounted on OMERO server
-    if os.path.isdir(root):
+    if os.path.isdir(root) and object_type in ['Experimenter', 'ExperimenterGroup']:
+        message = download_owners_images_for_hrm(conn, object_type, object_id_list, root, download_existing_images,
+                                                 workers, max_downloads_per_user)
+    elif os.path.isdir(root):
         user_name = conn.getUser().getOmeName()
         owner_root = os.path.join(root, user_name)
 
         # check if the user has an HRM account (a folder with his/her name should already exist)
         if os.path.isdir(owner_root) or conn.getUser().isAdmin():
+            with metrics.stage("reclaim_staging"):
+                reclaim_stale_staging_folders(owner_root)
             for object_id in object_id_list:
 
                 # search in all the user's group
@@ -269,8 +934,20 @@ def download_images_for_hrm(conn, script_params):
                         tot_project += 1
                         tot_dataset += tot_dataset_tmp
                         tot_image += tot_image_tmp
+
+                    if object_type in ['Plate', 'Screen']:
+                        n_image_tmp, n_plate_tmp, tot_image_tmp, tot_plate_tmp = process_hcs(
+                            conn, object_type, omero_object, owner_root, download_existing_images)
+
+                        n_image += n_image_tmp
+                        n_plate += n_plate_tmp
+                        tot_image += tot_image_tmp
+                        tot_plate += tot_plate_tmp
+                        if object_type == 'Screen':
+                            n_screen += (1 if n_plate_tmp == tot_plate_tmp else 0)
+                            tot_screen += 1
                 else:
-                    print(object_type, object_id, "does not exist or you do not have access to it")
+                    logger.info("%s %s does not exist or you do not have access to it", object_type, object_id)
 
             # build summary message    
             if not user_name == "":
@@ -278,26 +955,42 @@ def download_images_for_hrm(conn, script_params):
                                                                                                          n_dataset, tot_dataset,
                                                                                                          n_project, tot_project,
                                                                                                          user_name)
+                if tot_plate > 0:
+                    message += ", {}/{} plate(s), {}/{} screen(s)".format(n_plate, tot_plate, n_screen, tot_screen)
+                if n_filtered_out_images is not None:
+                    message += ", {} image(s) skipped by filters".format(n_filtered_out_images)
+                if len(existing_fileset_ids) > 0:
+                    message += ", {} fileset(s) already on HRM kept".format(len(existing_fileset_ids))
             else:
                 message = "Cannot download objects"
-            print(message)
+            logger.info("%s", message)
         else:
-            print("You don't have an active account on HRM. Please go on https://hrm-biop.epfl.ch/ and sign in to HRM")
-            print("If you do not have any HRM account, please go on https://hrm-biop.epfl.ch/ and ask for an HRM account")
+            logger.info("You don't have an active account on HRM. Please go on https://hrm-biop.epfl.ch/ and sign in to HRM")
+            logger.info("If you do not have any HRM account, please go on https://hrm-biop.epfl.ch/ and ask for an HRM account")
             message = f"Your HRM account ({user_name}) is not active. Please go on https://hrm-biop.epfl.ch/"
     else:
         message = "The root HRM folder doesn't exists. Please correct it."
-        print(message)
+        logger.info("%s", message)
 
+    if throttle.is_limited():
+        message += " -- " + throttle.report()
+        logger.info("%s", throttle.report())
+    if concurrency.is_adaptive():
+        message += " -- " + concurrency.report()
+        logger.info("%s", concurrency.report())
     return message
 
 
+
 def run_script():
-    data_types = [rstring('Image'), rstring('Dataset'), rstring('Project')]
+    data_types = [rstring('Image'), rstring('Dataset'), rstring('Project'),
+                  rstring('Screen'), rstring('Plate'), rstring('Experimenter'), rstring('ExperimenterGroup')]
     client = scripts.client(
         'Send images to HRM deconvolution server',
         """
     This script sends all images from the selected source(s) to your HRM folder (\\sv-nas1.rcp.epfl.ch\ptbiop-raw\HRM-Share).
+    Admins can select Experimenter or ExperimenterGroup (IDs or names) to send all images of these users
+    to the HRM folder of each image owner.
         """,
         scripts.String(
             DATA_TYPE_PARAM_NAME, optional=False, grouping="1",
@@ -312,6 +1005,83 @@ def run_script():
             OVERWRITE_PARAM_NAME, optional=False, grouping="3",
             description="Overwrite existing images on HRM", default=False),
 
+        scripts.Bool(
+            OFF_PEAK_PARAM_NAME, optional=True, grouping="3.2",
+            description="Queue the request and run it during the next off-peak window, instead of now",
+            default=False),
+
+        scripts.Int(
+            WORKERS_PARAM_NAME, optional=False, grouping="4",
+            description="Number of filesets downloaded in parallel", default=1, min=1),
+
+        scripts.Bool(
+            ADAPTIVE_WORKERS_PARAM_NAME, optional=True, grouping="4.1",
+            description="Adapt the number of parallel downloads to the server load, up to Parallel downloads",
+            default=False),
+
+        scripts.Int(
+            MIN_WORKERS_PARAM_NAME, optional=True, grouping="4.2",
+            description="Minimum number of parallel downloads when they are adapted", default=1, min=1),
+
+        scripts.Int(
+            MAX_DOWNLOADS_PER_USER_PARAM_NAME, optional=False, grouping="5",
+            description="Maximum number of filesets of the same user downloaded in parallel", default=1, min=1),
+
+        scripts.Int(
+            MAX_BANDWIDTH_PARAM_NAME, optional=True, grouping="5.1",
+            description="Maximum download bandwidth on the HRM-Share folder (MB/s), all users together", min=1),
+
+        scripts.Int(
+            MAX_USER_BANDWIDTH_PARAM_NAME, optional=True, grouping="5.2",
+            description="Maximum download bandwidth on the HRM-Share folder (MB/s) of each user", min=1),
+
+        scripts.Int(
+            MAX_FILE_OPS_PARAM_NAME, optional=True, grouping="5.3",
+            description="Maximum number of file operations per second on the HRM-Share folder, all users together",
+            min=1),
+
+        scripts.Int(
+            MAX_USER_FILE_OPS_PARAM_NAME, optional=True, grouping="5.4",
+            description="Maximum number of file operations per second on the HRM-Share folder of each user", min=1),
+
+        scripts.Bool(
+            METADATA_PARAM_NAME, optional=True, grouping="3.1",
+            description="Write the image metadata (pixel sizes, wavelengths, objective) as a JSON file "
+                        "next to each fileset", default=True),
+
+        scripts.List(
+            TAGS_FILTER_PARAM_NAME, optional=True, grouping="6.1",
+            description="Only send images with at least one of these tags").ofType(rstring('')),
+
+        scripts.String(
+            NAME_FILTER_PARAM_NAME, optional=True, grouping="6.2",
+            description="Only send images whose name matches this pattern (* and ? wildcards)"),
+
+        scripts.String(
+            ACQUIRED_AFTER_FILTER_PARAM_NAME, optional=True, grouping="6.3",
+            description="Only send images acquired on or after this date (YYYY-MM-DD)"),
+
+        scripts.String(
+            ACQUIRED_BEFORE_FILTER_PARAM_NAME, optional=True, grouping="6.4",
+            description="Only send images acquired on or before this date (YYYY-MM-DD)"),
+
+        scripts.Int(
+            MAX_SIZE_FILTER_PARAM_NAME, optional=True, grouping="6.5",
+            description="Only send images whose fileset is smaller than this size (MB)", min=1),
+
+        scripts.Int(
+            MAX_CHANNELS_FILTER_PARAM_NAME, optional=True, grouping="6.6",
+            description="Only send images with at most this number of channels", min=1),
+
+        scripts.String(
+            METRICS_TEXTFILE_PARAM_NAME, optional=True, grouping="7",
+            description="Directory where the timings are written as a Prometheus textfile"),
+
+        scripts.String(
+            LOG_LEVEL_PARAM_NAME, optional=False, grouping="8",
+            description="Verbosity of the script output (TRACE being the most verbose)",
+            values=[rstring(level) for level in LOG_LEVELS], default="INFO"),
+
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch"
@@ -324,15 +1094,27 @@ def run_script():
             if client.getInput(key):
                 script_params[key] = client.getInput(key, unwrap=True)
 
+        set_log_level(script_params.get(LOG_LEVEL_PARAM_NAME, "INFO"))
+
         # wrap client to use the Blitz Gateway
         conn = BlitzGateway(client_obj=client)
-        print("script params")
+        logger.info("script params")
         for k, v in script_params.items():
-            print(k, v)
+            logger.info("%s %s", k, v)
+        # off-peak requests are only queued : nothing is downloaded now
+        if script_params.get(OFF_PEAK_PARAM_NAME):
+            client.setOutput("Message", rstring(enqueue_request(conn, "send", script_params)))
+            return
         message = download_images_for_hrm(conn, script_params)
-        client.setOutput("Message", rstring(message))
+        # the off-peak requests of the user finished since their last run
+        message += report_queued_results(conn.getUser().getOmeName())
+        metrics_file_ann = export_metrics(conn, "send", script_params.get(METRICS_TEXTFILE_PARAM_NAME))
+        client.setOutput("Message", rstring(message + "\n" + metrics.to_table()))
+        if metrics_file_ann is not None:
+            client.setOutput("File_Annotation", robject(metrics_file_ann._obj))
 
     finally:
+        log_handler.close()
         client.closeSession()
 
 
@@ -0,0 +1,620 @@
+"""
+ MIF/benchmarks/fake_omero.py
+ In-memory stand-in of an OMERO server (BlitzGateway, CLI import, RawFileStore and OMERO.tables) counting
+ round trips
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import copy
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+class RoundTrips:
+    """
+    Count the calls made to the fake server, by name, and simulate the network latency of each of them
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, name):
+        with self.lock:
+            self.counts[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+class FakeServer:
+    """
+    Objects of the fake OMERO server {(type, id): FakeObject}, shared by all the fake connections
+    """
+
+    def __init__(self, latency=0.0, group_id=3):
+        self.round_trips = RoundTrips(latency)
+        self.objects = {}
+        self.group_id = group_id
+        # OMERO_TYPE of the annotations, set to the real model classes by install()
+        self.omero_types = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        # HDF5 files and columns of the OMERO.tables {original file ID: (path, headers)}
+        self.tables = {}
+        self.tables_folder = None
+
+    def add(self, obj_type, name, parent=None, owner="user", **attributes):
+        with self.lock:
+            obj_id = self.next_id
+            self.next_id += 1
+        obj = FakeObject(self, obj_type, obj_id, name, parent, owner, **attributes)
+        self.objects[(obj_type, obj_id)] = obj
+        if parent is not None:
+            parent.children.append(obj)
+        return obj
+
+    def get(self, obj_type, obj_id):
+        try:
+            return self.objects.get((obj_type, int(obj_id)))
+        except (TypeError, ValueError):
+            return None
+
+    def list(self, obj_type):
+        return [obj for (o_type, _), obj in list(self.objects.items()) if o_type == obj_type]
+
+    def delete(self, obj_type, obj_id):
+        obj = self.objects.pop((obj_type, int(obj_id)), None)
+        for other in list(self.objects.values()):
+            if obj in other.annotations:
+                other.annotations.remove(obj)
+
+
+class FakeFileset:
+    """
+    Fileset of a fake image, made of (file name, size in bytes) entries
+    """
+
+    def __init__(self, fileset_id, files):
+        self.fileset_id = fileset_id
+        self.files = files
+
+    def getId(self):
+        return self.fileset_id
+
+    def getTemplatePrefix(self):
+        return ""
+
+    def listFiles(self):
+        return [FakeOriginalFile(index, name, size) for index, (name, size) in enumerate(self.files)]
+
+    def __bool__(self):
+        return len(self.files) > 0
+
+
+class FakeOriginalFile:
+    """
+    File of a fake fileset, at the root of the fileset folder
+    """
+
+    def __init__(self, file_id, name, size):
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+
+    def getId(self):
+        return self.file_id
+
+    def getName(self):
+        return self.name
+
+    def getPath(self):
+        return ""
+
+    def getSize(self):
+        return self.size
+
+
+class FakeObject:
+    """
+    Object of the fake server, exposing the BlitzObjectWrapper methods used by the scripts.
+    Methods that query the server on a real BlitzObjectWrapper count a round trip.
+    """
+
+    def __init__(self, server, obj_type, obj_id, name, parent=None, owner="user", text_value=None, fileset=None,
+                 value=None, ns=None, file=None):
+        self.server = server
+        self.obj_type = obj_type
+        self.obj_id = obj_id
+        self.name = name
+        self.parent = parent
+        self.owner = owner
+        self.text_value = text_value
+        self.fileset = fileset
+        self.value = value
+        self.ns = ns
+        self.file = file
+        self.children = []
+        self.annotations = []
+
+    @property
+    def OMERO_TYPE(self):
+        return self.server.omero_types.get(self.obj_type)
+
+    @property
+    def OMERO_CLASS(self):
+        return self.obj_type
+
+    def getId(self):
+        return self.obj_id
+
+    def getName(self):
+        return self.name
+
+    def getTextValue(self):
+        return self.text_value
+
+    def getOwnerOmeName(self):
+        return self.owner
+
+    def getFile(self):
+        return self.file
+
+    def getDetails(self):
+        return FakeDetails(self.server.group_id)
+
+    def getParent(self):
+        self.server.round_trips("getParent")
+        return self.parent
+
+    def listParents(self):
+        self.server.round_trips("listParents")
+        return [] if self.parent is None else [self.parent]
+
+    def getFileset(self):
+        self.server.round_trips("getFileset")
+        return self.fileset
+
+    def listChildren(self):
+        self.server.round_trips("listChildren")
+        return iter(list(self.children))
+
+    def countChildren(self):
+        self.server.round_trips("countChildren")
+        return len(self.children)
+
+    def listAnnotations(self, ns=None):
+        self.server.round_trips("listAnnotations")
+        return iter([ann for ann in self.annotations if ns is None or ann.ns == ns])
+
+    def linkAnnotation(self, annotation):
+        self.server.round_trips("linkAnnotation")
+        self.annotations.append(getattr(annotation, "_obj", annotation))
+        return annotation
+
+
+class FakeDetails:
+    """
+    Details of a fake object : only its group, whose ID is the one of the server
+    """
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+
+    def getGroup(self):
+        return self
+
+    def getId(self):
+        return self.group_id
+
+
+class FakeWrapper:
+    """
+    Stand-in of the MapAnnotationWrapper, TagAnnotationWrapper and DatasetWrapper created by the scripts
+    """
+    OBJECT_TYPE = None
+
+    def __init__(self, conn, obj=None):
+        self._conn = conn
+        self._obj = None
+        self.name = None
+        self.value = None
+        self.ns = None
+        self.description = None
+
+    def setName(self, name):
+        self.name = name
+
+    def setValue(self, value):
+        self.value = value if isinstance(value, str) else list(value)
+
+    def setNs(self, ns):
+        self.ns = ns
+
+    def setDescription(self, description):
+        self.description = description
+
+    def save(self):
+        self._conn.server.round_trips("save")
+        text_value = self.value if isinstance(self.value, str) else None
+        self._obj = self._conn.server.add(self.OBJECT_TYPE, self.name, owner=self._conn.user,
+                                          text_value=text_value, value=self.value, ns=self.ns)
+
+    def getId(self):
+        return self._obj.getId()
+
+    def getTextValue(self):
+        return self._obj.getTextValue()
+
+
+class FakeMapAnnotationWrapper(FakeWrapper):
+    OBJECT_TYPE = "MapAnnotation"
+
+
+class FakeTagAnnotationWrapper(FakeWrapper):
+    OBJECT_TYPE = "TagAnnotation"
+
+
+class FakeDatasetWrapper(FakeWrapper):
+    OBJECT_TYPE = "Dataset"
+
+
+class ServiceOpts(dict):
+    """
+    Minimal omero.gateway.ServiceOptsDict
+    """
+
+    def setOmeroGroup(self, group_id):
+        self["omero.group"] = str(group_id)
+
+    def getOmeroGroup(self):
+        return self.get("omero.group")
+
+
+class FakeQueryService:
+    """
+    HQL queries are counted but not evaluated : they return no rows
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.queries = []
+
+    def projection(self, query, params=None, ctx=None):
+        self.server.round_trips("projection")
+        self.queries.append(query)
+        return []
+
+    def findAllByQuery(self, query, params=None, ctx=None):
+        self.server.round_trips("findAllByQuery")
+        self.queries.append(query)
+        return []
+
+
+class FakeUpdateService:
+
+    def __init__(self, server):
+        self.server = server
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self.server.round_trips("saveAndReturnObject")
+        return obj
+
+    def saveArray(self, objects, ctx=None):
+        self.server.round_trips("saveArray")
+
+    def saveObject(self, obj, ctx=None):
+        """
+        Only annotation links are saved : the annotation is created and linked to its parent
+        """
+        self.server.round_trips("saveObject")
+        parent = obj.getParent()
+        parent_obj = self.server.get(type(parent).__name__[:-1], parent.getId().getValue())
+        child = obj.getChild()
+        original_file = child.getFile()
+        annotation = self.server.add(type(child).__name__[:-1], None, ns=child.getNs().getValue(),
+                                     file=self.server.get("OriginalFile", original_file.getId().getValue()))
+        parent_obj.annotations.append(annotation)
+
+
+class FakeTable:
+    """
+    OMERO.table stored in a local HDF5 file with PyTables, like on OMERO.server, so that the queries
+    (getWhereList) are evaluated as by the server
+    """
+
+    def __init__(self, server, file_id):
+        import tables
+        self.server = server
+        self.file_id = file_id
+        path, self.headers = server.tables[file_id]
+        self.h5 = tables.open_file(path, "a")
+
+    def initialize(self, columns):
+        import tables
+        self.server.round_trips("table.initialize")
+        description = {}
+        for position, column in enumerate(columns):
+            if type(column).__name__ == "StringColumn":
+                description[column.name] = tables.StringCol(column.size, pos=position)
+            elif type(column).__name__ == "DoubleColumn":
+                description[column.name] = tables.Float64Col(pos=position)
+            else:
+                description[column.name] = tables.Int64Col(pos=position)
+        self.h5.create_table("/", "rows", description)
+        for column in columns:
+            header = copy.copy(column)
+            header.values = None
+            self.headers.append(header)
+
+    def getHeaders(self):
+        self.server.round_trips("table.getHeaders")
+        return [copy.copy(header) for header in self.headers]
+
+    def getNumberOfRows(self):
+        self.server.round_trips("table.getNumberOfRows")
+        return self.h5.root.rows.nrows
+
+    def addData(self, columns):
+        self.server.round_trips("table.addData")
+        values = [[value.encode("utf-8") if isinstance(value, str) else value for value in column.values]
+                  for column in columns]
+        self.h5.root.rows.append(list(zip(*values)))
+        self.h5.root.rows.flush()
+
+    def read(self, column_indexes, start, stop):
+        self.server.round_trips("table.read")
+        data = FakeData()
+        rows = self.h5.root.rows.read(start, stop)
+        for index in column_indexes:
+            column = copy.copy(self.headers[index])
+            column.values = [value.decode("utf-8") if isinstance(value, bytes) else value.item()
+                             for value in rows[column.name]]
+            data.columns.append(column)
+        return data
+
+    def getWhereList(self, condition, variables=None, start=0, stop=None, step=1):
+        self.server.round_trips("table.getWhereList")
+        return [int(row) for row in self.h5.root.rows.get_where_list(condition, condvars=variables,
+                                                                     start=start, stop=stop, step=step)]
+
+    def getOriginalFile(self):
+        from omero.model import OriginalFileI
+        return OriginalFileI(self.file_id, False)
+
+    def close(self):
+        self.h5.close()
+
+
+class FakeData:
+    """
+    Minimal omero.grid.Data
+    """
+
+    def __init__(self):
+        self.columns = []
+
+
+class FakeSharedResources:
+
+    def __init__(self, server):
+        self.server = server
+
+    def repositories(self):
+        return self
+
+    @property
+    def descriptions(self):
+        from omero.model import OriginalFileI
+        return [OriginalFileI(0, False)]
+
+    def newTable(self, repository_id, name, ctx=None):
+        self.server.round_trips("newTable")
+        with self.server.lock:
+            if self.server.tables_folder is None:
+                self.server.tables_folder = tempfile.mkdtemp(prefix="hrm-omero-tables__")
+        file_id = self.server.add("OriginalFile", name).getId()
+        self.server.tables[file_id] = (os.path.join(self.server.tables_folder, f"{file_id}_{name}"), [])
+        return FakeTable(self.server, file_id)
+
+    def openTable(self, original_file, ctx=None):
+        self.server.round_trips("openTable")
+        return FakeTable(self.server, original_file.getId().getValue())
+
+
+class FakeUser:
+
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def getOmeName(self):
+        return self.name
+
+    def getId(self):
+        return abs(hash(self.name)) % 1000 + 1
+
+
+class FakeBlitzGateway:
+    """
+    Connection to the fake server, as user
+    """
+
+    def __init__(self, server, user="user", admin=False):
+        self.server = server
+        self.user = user
+        self.admin = admin
+        # client of the session
+        self.c = server
+        self.SERVICE_OPTS = ServiceOpts()
+        self.query_service = FakeQueryService(server)
+        self.update_service = FakeUpdateService(server)
+
+    def getObject(self, obj_type, obj_id=None, opts=None):
+        self.server.round_trips("getObject")
+        return self.server.get(obj_type, obj_id)
+
+    def getObjects(self, obj_type, ids=None, opts=None):
+        self.server.round_trips("getObjects")
+        objects = self.server.list(obj_type)
+        if ids is not None:
+            ids = {int(obj_id) for obj_id in ids}
+            objects = [obj for obj in objects if obj.getId() in ids]
+        return iter(objects)
+
+    def getQueryService(self):
+        return self.query_service
+
+    def getUpdateService(self):
+        return self.update_service
+
+    def getSharedResources(self):
+        return FakeSharedResources(self.server)
+
+    def createRawFileStore(self):
+        return FakeRawFileStore(self.server)
+
+    def deleteObjects(self, obj_type, obj_ids, wait=False):
+        self.server.round_trips("deleteObjects")
+        for obj_id in obj_ids:
+            self.server.delete(obj_type, obj_id)
+
+    def getUser(self):
+        return FakeUser(self.user)
+
+    def getGroupFromContext(self):
+        return FakeUser(str(self.server.group_id))
+
+    def isAdmin(self):
+        return self.admin
+
+    def suConn(self, username, group=None, ttl=60000):
+        self.server.round_trips("suConn")
+        user_conn = FakeBlitzGateway(self.server, username)
+        # lifetime (ms) of the sudo session, which the scripts must set for runs longer than the 60 s default
+        user_conn.ttl = ttl
+        return user_conn
+
+    def createFileAnnfromLocalFile(self, path, mimetype=None, ns=None, desc=None):
+        self.server.round_trips("createFileAnnfromLocalFile")
+        return self.server.add("FileAnnotation", os.path.basename(path), owner=self.user, ns=ns)
+
+    def keepAlive(self):
+        return True
+
+    def isConnected(self):
+        return True
+
+    def connect(self):
+        return True
+
+    def close(self, hard=True):
+        pass
+
+    def _getSessionId(self):
+        return f"fake-session-{self.user}"
+
+
+class FakeCLI:
+    """
+    Stand-in of omero.cli.CLI for the 'import' command : the image is created in the target dataset
+    and its ID is written as YAML to the --file output, like the real importer
+    """
+
+    def __init__(self, server, import_latency=0.0):
+        self.server = server
+        self.import_latency = import_latency
+
+    def register(self, *args, **kwargs):
+        pass
+
+    def loadplugins(self):
+        pass
+
+    def invoke(self, args, strict=False):
+        self.server.round_trips("import")
+        if self.import_latency:
+            time.sleep(self.import_latency)
+        options = dict(zip(args[1:-1], args[2:]))
+        image_file = args[-1]
+        dataset = self.server.get("Dataset", options["-d"])
+        name = options.get("--name", os.path.basename(image_file))
+        image = self.server.add("Image", name, parent=dataset, owner=dataset.owner if dataset else "user",
+                                fileset=FakeFileset(self.server.next_id, [(os.path.basename(image_file), 0)]))
+        with open(options["--file"], "w", encoding="utf-8") as stream:
+            stream.write(f"- Image:\n  - {image.getId()}\n")
+
+    def get_client(self):
+        return self
+
+    def closeSession(self):
+        pass
+
+
+class FakeRawFileStore:
+    """
+    Stand-in of the RawFileStore reading the files of a fileset, filled with zeros
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def setFileId(self, file_id, ctx=None):
+        self.server.round_trips("download")
+
+    def read(self, offset, n_bytes):
+        return b"\0" * n_bytes
+
+    def close(self):
+        pass
+
+
+def install(module, server, import_latency=0.0):
+    """
+    Replace the OMERO entry points of a loaded script module by fakes bound to the given server
+    """
+    fakes = {
+        "BlitzGateway": lambda *args, **kwargs: FakeBlitzGateway(server),
+        "build_import_cli": lambda: FakeCLI(server, import_latency),
+        "MapAnnotationWrapper": FakeMapAnnotationWrapper,
+        "TagAnnotationWrapper": FakeTagAnnotationWrapper,
+        "DatasetWrapper": FakeDatasetWrapper,
+    }
+    # the helpers shared by the scripts open connections as well
+    for target in (module, sys.modules.get("omero_hrm_common")):
+        for name, fake in fakes.items():
+            if target is not None and hasattr(target, name):
+                setattr(target, name, fake)
+    # objects cached from a previous server must not be reused
+    if hasattr(module, "ObjectCache"):
+        module.object_cache = module.ObjectCache()
+    gateway = getattr(getattr(module, "omero", None), "gateway", None)
+    if gateway is not None:
+        server.omero_types["TagAnnotation"] = getattr(gateway, "TagAnnotationI", None)
+        server.omero_types["MapAnnotation"] = getattr(gateway, "MapAnnotationI", None)
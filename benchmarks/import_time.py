@@ -0,0 +1,104 @@
+"""
+ MIF/benchmarks/import_time.py
+ Measure the launch latency of the scripts : the time taken by a fresh interpreter to load each script module,
+ and the slowest imports reported by `python -X importtime`.
+
+ usage : python benchmarks/import_time.py [--repeat 5] [--top 10] [--budget MS] [--output results.json]
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ["Retrieve_images_from_HRM.py", "Send_images_to_HRM.py", "Clean_HRM_share.py"]
+
+# load the script as a module, without running it (the helpers shared by the scripts are next to them)
+LOAD_SCRIPT = "import importlib.util, os, sys; " \
+              "sys.path.insert(0, os.path.dirname(sys.argv[1])); " \
+              "spec = importlib.util.spec_from_file_location('script', sys.argv[1]); " \
+              "spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+
+
+def time_launch(script_path):
+    """
+    return the wall time (s) of a fresh interpreter loading the script
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", LOAD_SCRIPT, script_path], check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(script_path, top):
+    """
+    return the top (cumulative time in ms, module) imports of the script, as reported by -X importtime
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", LOAD_SCRIPT, script_path],
+                             check=True, capture_output=True, text=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # only the top-level imports, as nested ones are included in their cumulative time
+        if fields[2].startswith("   "):
+            continue
+        imports.append((int(fields[1]) / 1000, fields[2].strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch latency of the HRM-OMERO scripts")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of launches per script")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports listed per script")
+    parser.add_argument("--budget", type=float, help="Maximum median launch time (ms) of each script")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    over_budget = []
+    for script in SCRIPTS:
+        script_path = os.path.join(REPOSITORY_FOLDER, script)
+        launches = [time_launch(script_path) * 1000 for _ in range(args.repeat)]
+        median = statistics.median(launches)
+        imports = slowest_imports(script_path, args.top)
+        results[script] = {"median_ms": median, "launches_ms": launches,
+                           "slowest_imports": [{"module": module, "cumulative_ms": ms} for ms, module in imports]}
+
+        print(f"{script} : {median:.0f} ms (median of {args.repeat} launches)")
+        for ms, module in imports:
+            print(f"    {ms:8.1f} ms  {module}")
+        if args.budget is not None and median > args.budget:
+            over_budget.append(script)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    for script in over_budget:
+        print("OVER BUDGET", f"{script} : {results[script]['median_ms']:.0f} ms > {args.budget:.0f} ms")
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+ MIF/benchmarks/run_benchmarks.py
+ Measure how the send and retrieve scripts scale on synthetic hierarchies, with the in-memory OMERO stand-in.
+ Report the round trips and the wall time per scenario, and compare them with a baseline to catch regressions.
+
+ usage : python benchmarks/run_benchmarks.py [--latency MS] [--scenarios small medium] [--output results.json]
+                                             [--baseline baseline.json] [--tolerance 0.25]
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+import fake_omero
+import synthetic
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OWNER = "user"
+
+# N projects x M datasets x K images, T tags
+SCENARIOS = {
+    "small": dict(n_projects=2, n_datasets=5, n_images=10, n_tags=10),
+    "medium": dict(n_projects=5, n_datasets=10, n_images=50, n_tags=50),
+    "large": dict(n_projects=10, n_datasets=20, n_images=100, n_tags=200),
+}
+
+
+def load_script(file_name, module_name):
+    """
+    Load one of the OMERO scripts as a module (the scripts only run when executed as __main__)
+    """
+    # the scripts import the helpers they share from the repository folder
+    if REPOSITORY_FOLDER not in sys.path:
+        sys.path.insert(0, REPOSITORY_FOLDER)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPOSITORY_FOLDER, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.set_log_level("WARNING")
+    return module
+
+
+def bench_list_images_to_upload(retrieve, server, conn, projects, folder):
+    synthetic.build_hrm_share(folder, projects, OWNER, n_orphaned=5)
+    server.round_trips.reset()
+    retrieve.list_images_to_upload(conn, OWNER, folder)
+
+
+def bench_add_tags(retrieve, server, conn, projects, folder):
+    deconvolved_images = synthetic.add_deconvolved_images(server, projects)
+    server.round_trips.reset()
+    for image in deconvolved_images:
+        dataset = image.parent
+        retrieve.add_tags(conn, retrieve.OmeroId(f"G:{server.group_id}:Image:{image.getId()}"),
+                          retrieve.OmeroId(f"G:{server.group_id}:Dataset:{dataset.getId()}"))
+
+
+def bench_check_existence_and_add_tag_objs(retrieve, server, conn, projects, folder):
+    images = server.list("Image")
+    server.round_trips.reset()
+    for image in images:
+        retrieve.check_existence_and_add_tag_objs(conn, ["deconvolved", "hrm"], image, list(image.annotations))
+
+
+def bench_save_parameters_table(retrieve, server, conn, projects, folder):
+    # OMERO.tables stand-in : local HDF5 files written with PyTables
+    server.tables_folder = folder
+    summary = {
+        "Image Parameters": {"Microscope type [ch:0]": "widefield", "X pixel size (μm)": "0.123456"},
+        "Restoration Parameters": {"Deconvolution algorithm": "cmle", "Number of iterations": "42"},
+    }
+    dataset_rows = []
+    for project in projects:
+        for dataset in project.children:
+            rows = []
+            for image in dataset.children:
+                row, descriptions = retrieve.flatten_summary(summary)
+                row["Image"] = image.getId()
+                row["Image_name"] = image.getName()
+                rows.append(row)
+            dataset_rows.append((dataset, rows, descriptions))
+    server.round_trips.reset()
+    for dataset, rows, descriptions in dataset_rows:
+        retrieve.save_parameters_table(conn, dataset.getId(), rows, descriptions)
+        # one server-side query instead of loading the annotations of each image
+        file_ann = next(dataset.listAnnotations(ns=retrieve.PARAMETERS_TABLE_NS))
+        table = conn.getSharedResources().openTable(retrieve.model.OriginalFileI(file_ann.getFile().getId(), False))
+        table.getWhereList("Number_of_iterations > 40")
+        table.close()
+
+
+def bench_process_project(send, server, conn, projects, folder):
+    send.downloaded_fileset.clear()
+    server.round_trips.reset()
+    for project in projects:
+        send.process_project(conn, project, folder, False)
+
+
+def bench_download_image(send, server, conn, projects, folder):
+    send.downloaded_fileset.clear()
+    images = server.list("Image")
+    server.round_trips.reset()
+    for image in images:
+        send.download_image(conn, image, folder, False)
+
+
+# (benchmark name, script, function)
+BENCHMARKS = [
+    ("list_images_to_upload", "retrieve", bench_list_images_to_upload),
+    ("add_tags", "retrieve", bench_add_tags),
+    ("check_existence_and_add_tag_objs", "retrieve", bench_check_existence_and_add_tag_objs),
+    ("save_parameters_table", "retrieve", bench_save_parameters_table),
+    ("process_project", "send", bench_process_project),
+    ("download_image", "send", bench_download_image),
+]
+
+
+def run_benchmark(module, function, scenario, latency):
+    """
+    Run one benchmark on a fresh server and HRM-Share folder
+    return {round_trips, wall_time, calls}
+    """
+    server = fake_omero.FakeServer()
+    fake_omero.install(module, server)
+    projects = synthetic.build_omero_hierarchy(server, owner=OWNER, **scenario)
+    conn = fake_omero.FakeBlitzGateway(server, OWNER)
+    with tempfile.TemporaryDirectory(prefix="hrm-omero-bench__") as folder:
+        # the latency only applies to the measured calls, not to the set-up
+        server.round_trips.latency = latency
+        start = time.perf_counter()
+        function(module, server, conn, projects, folder)
+        wall_time = time.perf_counter() - start
+    return {
+        "round_trips": server.round_trips.total(),
+        "wall_time": wall_time,
+        "calls": dict(server.round_trips.counts.most_common()),
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare the results with a baseline : more round trips, or a wall time above (1 + tolerance) x baseline
+    return the list of regression messages
+    """
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if result["round_trips"] > reference["round_trips"]:
+            regressions.append(f"{key} : {reference['round_trips']} -> {result['round_trips']} round trips")
+        if result["wall_time"] > reference["wall_time"] * (1 + tolerance):
+            regressions.append(f"{key} : {reference['wall_time']:.3f} s -> {result['wall_time']:.3f} s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the HRM-OMERO scripts")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of a round trip (ms)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=["small", "medium"])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Accepted wall time increase (fraction)")
+    args = parser.parse_args()
+
+    modules = {
+        "retrieve": load_script("Retrieve_images_from_HRM.py", "retrieve_images_from_hrm"),
+        "send": load_script("Send_images_to_HRM.py", "send_images_to_hrm"),
+    }
+
+    results = {}
+    print(f"{'scenario':<10}{'benchmark':<36}{'round trips':>12}{'wall time (s)':>16}")
+    for scenario_name in args.scenarios:
+        for benchmark_name, script, function in BENCHMARKS:
+            try:
+                result = run_benchmark(modules[script], function, SCENARIOS[scenario_name], args.latency / 1000)
+            except ImportError as err:
+                # optional benchmark dependencies, e.g. PyTables for the OMERO.tables stand-in
+                print(f"{scenario_name:<10}{benchmark_name:<36}  skipped : {err}")
+                continue
+            results[f"{scenario_name}/{benchmark_name}"] = result
+            print(f"{scenario_name:<10}{benchmark_name:<36}{result['round_trips']:>12}{result['wall_time']:>16.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
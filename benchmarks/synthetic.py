@@ -0,0 +1,96 @@
+"""
+ MIF/benchmarks/synthetic.py
+ Generate synthetic OMERO hierarchies on the fake server and the matching HRM-Share folders
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import os
+
+from fake_omero import FakeFileset
+
+# HRM job label appended to the deconvolved results (`_<13 hex digits>_hrm`)
+HRM_JOB_LABEL = "_64f1c2a9b3e7d_hrm"
+
+
+def build_omero_hierarchy(server, n_projects, n_datasets, n_images, n_tags, owner="user", files_per_fileset=1,
+                          file_size=1024):
+    """
+    Create n_projects x n_datasets x n_images raw images on the fake server, each one with its own fileset,
+    and n_tags tags linked to the images in turn
+    return the list of projects
+    """
+    tags = [server.add("TagAnnotation", None, owner=owner, text_value=f"tag_{t}") for t in range(n_tags)]
+    projects = []
+    for p in range(n_projects):
+        project = server.add("Project", f"project_{p}", owner=owner)
+        projects.append(project)
+        for d in range(n_datasets):
+            dataset = server.add("Dataset", f"dataset_{d}", parent=project, owner=owner)
+            for i in range(n_images):
+                files = [(f"image_{i}_{f}.tif", file_size) for f in range(files_per_fileset)]
+                image = server.add("Image", f"image_{i}.tif", parent=dataset, owner=owner,
+                                   fileset=FakeFileset(server.next_id, files))
+                if tags:
+                    image.annotations.append(tags[(d * n_images + i) % n_tags])
+    return projects
+
+
+def add_deconvolved_images(server, projects):
+    """
+    Add, next to each raw image, the deconvolved image imported from HRM
+    return the list of deconvolved images
+    """
+    deconvolved_images = []
+    for project in projects:
+        for dataset in list(project.children):
+            for raw_image in list(dataset.children):
+                name = raw_image.getName().replace(".tif", f"{HRM_JOB_LABEL}.ids")
+                deconvolved_images.append(server.add("Image", name, parent=dataset, owner=raw_image.owner))
+    return deconvolved_images
+
+
+def build_hrm_share(root, projects, owner="user", n_orphaned=0, file_size=1024):
+    """
+    Write the HRM-Share folder of the owner with one deconvolved result (.ids, .ics, .parameters.txt, .log.txt)
+    per raw image of the given projects (Deconvolved/omero/<project>/<dataset>/<fileset>/) and n_orphaned
+    results in the None/None folder
+    return the number of .ids results
+    """
+    omero_folder = os.path.join(root, owner, "Deconvolved", "omero")
+    n_results = 0
+    datasets = []
+    for project in projects:
+        project_folder = f"{project.getId()}_{project.getName()}"
+        for dataset in project.children:
+            dataset_folder = os.path.join(omero_folder, project_folder, f"{dataset.getId()}_{dataset.getName()}")
+            datasets.append((dataset_folder, [image.getName() for image in dataset.children
+                                              if image.getName().endswith(".tif")]))
+    datasets.append((os.path.join(omero_folder, "None", "None"),
+                     [f"orphaned_{i}.tif" for i in range(n_orphaned)]))
+
+    for dataset_folder, image_names in datasets:
+        for i, image_name in enumerate(image_names):
+            fileset_folder = os.path.join(dataset_folder, f"Fileset_{i}")
+            os.makedirs(fileset_folder, exist_ok=True)
+            basename = os.path.join(fileset_folder, image_name.replace(".tif", HRM_JOB_LABEL))
+            with open(basename + ".ids", "wb") as f:
+                f.write(b"\0" * file_size)
+            for suffix in (".ics", ".parameters.txt", ".log.txt"):
+                with open(basename + suffix, "w", encoding="utf-8") as f:
+                    f.write("\n")
+            n_results += 1
+    os.makedirs(os.path.join(root, owner, "Raw", "omero"), exist_ok=True)
+    return n_results
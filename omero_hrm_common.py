@@ -0,0 +1,828 @@
+"""
+ MIF/omero_hrm_common.py
+ Helpers shared by the HRM-OMERO scripts : leveled and buffered logging, per-stage metrics, retries with a circuit
+ breaker, throttling of the HRM-Share folder, adaptive parallelism, round-robin scheduling across users and the
+ off-peak queue.
+ This is not an OMERO script : install it on the python path of OMERO.server (e.g. next to the omero package in
+ lib/python, or in the site-packages of its virtual environment), so that the scripts can import it.
+-----------------------------------------------------------------------------
+  Copyright (C) 2023
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+------------------------------------------------------------------------------
+Created by Rémy Dornier
+"""
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date
+
+import Ice
+import omero
+from omero.gateway import BlitzGateway
+
+# extra levels of the hrm-omero messages, below DEBUG and between INFO and WARNING
+TRACE = 5
+SUCCESS = 25
+logging.addLevelName(TRACE, "TRACE")
+logging.addLevelName(SUCCESS, "SUCCESS")
+LOG_LEVELS = ["ERROR", "WARNING", "INFO", "DEBUG", "TRACE"]
+# log lines are written to stdout by chunks ; once the cap is reached, only warnings and errors are kept
+LOG_BUFFER_BYTES = 64 * 1024
+LOG_MAX_BYTES = 8 * 1024 * 1024
+
+# transient errors that are worth retrying, with exponential backoff between attempts
+TRANSIENT_ERRORS = (Ice.ConnectionLostException, Ice.ConnectFailedException, Ice.TimeoutException,
+                    omero.SessionTimeoutException, omero.RemovedSessionException, omero.DatabaseBusyException,
+                    omero.TryAgain, omero.LockTimeout, omero.NoProcessorAvailable)
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+# consecutive failures pausing all the calls, and pause duration in seconds
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_PAUSE = 60
+# adaptive parallelism : latency increase (x the best latency) and throughput drop seen as an overload, and
+# minimum time (s) between two decreases
+CONCURRENCY_LATENCY_FACTOR = 2.0
+CONCURRENCY_THROUGHPUT_TOLERANCE = 0.1
+CONCURRENCY_COOLDOWN = 10
+# metrics attached on OMERO : the last files of each script and user are kept (read by the retrieve preview), older
+# ones are deleted so that the runs do not pile up unlinked file annotations
+METRICS_NS = "hrm.metrics"
+METRICS_KEEP = 10
+# sudo sessions opened for other users : BlitzGateway.suConn gives them a hard lifetime of 60 s by default, so they
+# are opened with a lifetime (ms) longer than any run, closed at the end of the run, and kept from idling meanwhile
+SUDO_SESSION_TTL = 48 * 3600 * 1000
+KEEP_ALIVE_INTERVAL = 60
+# persistent queue of the off-peak requests (pending, running, done and reported requests as JSON files), drained
+# by Run_HRM_queue.py during the off-peak windows
+QUEUE_FOLDER = os.environ.get("OMERO_HRM_QUEUE", "/opt/omero/hrm-queue")
+OFF_PEAK_PARAM_NAME = "Run_off_peak"
+
+
+class BufferedLogHandler(logging.Handler):
+    """Keep the formatted log lines in memory and write them to stdout by chunks.
+    Lines below WARNING are dropped (and counted) once `max_bytes` have been logged.
+    Attributes
+    ----------
+    dropped : int
+        Number of lines dropped since the last write
+    """
+
+    def __init__(self, buffer_bytes=LOG_BUFFER_BYTES, max_bytes=LOG_MAX_BYTES):
+        super().__init__()
+        self.buffer_bytes = buffer_bytes
+        self.max_bytes = max_bytes
+        self.lines = []
+        self.buffered_bytes = 0
+        self.logged_bytes = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        if self.logged_bytes >= self.max_bytes and record.levelno < logging.WARNING:
+            self.dropped += 1
+            return
+        try:
+            line = self.format(record) + "\n"
+        except Exception:  # pylint: disable-msg=broad-except
+            self.handleError(record)
+            return
+        self.lines.append(line)
+        self.buffered_bytes += len(line)
+        self.logged_bytes += len(line)
+        # errors are written at once, to not lose them if the script gets killed
+        if self.buffered_bytes >= self.buffer_bytes or record.levelno >= logging.ERROR:
+            self.write_lines()
+
+    def write_lines(self):
+        if self.lines:
+            sys.stdout.write("".join(self.lines))
+            sys.stdout.flush()
+        self.lines = []
+        self.buffered_bytes = 0
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.write_lines()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.dropped:
+                self.lines.append(f"WARNING {self.dropped} log line(s) dropped after reaching "
+                                  f"{self.max_bytes / 1024 ** 2:.0f} MB of logs\n")
+                self.dropped = 0
+            self.write_lines()
+        finally:
+            self.release()
+        super().close()
+
+
+# the loggers of the scripts (omero-hrm.send, omero-hrm.retrieve, omero-hrm.clean) and of this module propagate to
+# the omero-hrm logger, which holds the level and the handler
+root_logger = logging.getLogger("omero-hrm")
+root_logger.propagate = False
+root_logger.setLevel(logging.INFO)
+# the module is loaded again for each off-peak request : only keep the handler of the current run
+for previous_handler in list(root_logger.handlers):
+    root_logger.removeHandler(previous_handler)
+log_handler = BufferedLogHandler()
+log_handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+root_logger.addHandler(log_handler)
+logger = logging.getLogger("omero-hrm.common")
+
+
+def set_log_level(level):
+    """Set the level (name or number) of all the hrm-omero loggers."""
+    root_logger.setLevel(level)
+
+
+class Metrics:
+    """Per-stage durations, bytes and counts of a run, with duration histograms.
+    Stages are recorded from any thread and exported as JSON, as a Prometheus textfile and as a compact table.
+    Attributes
+    ----------
+    BUCKETS : tuple of float
+        Upper bounds (seconds) of the duration histogram buckets.
+    """
+    BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    @contextmanager
+    def stage(self, name, n_bytes=0):
+        """Record the duration of the enclosed block under the stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, n_bytes)
+
+    def timed(self, name, function):
+        """Wrap `function` so that each call is recorded under the stage `name`."""
+        def timed_function(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def record(self, name, duration, n_bytes=0):
+        """Record one occurrence of the stage `name`."""
+        with self._lock:
+            stage = self._stages.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0,
+                                                   "buckets": [0] * (len(self.BUCKETS) + 1)})
+            stage["count"] += 1
+            stage["seconds"] += duration
+            stage["max_seconds"] = max(stage["max_seconds"], duration)
+            stage["bytes"] += n_bytes
+            stage["buckets"][bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+    def to_dict(self):
+        """Return a copy of all the stages."""
+        with self._lock:
+            return {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self._stages.items()}
+
+    def to_prometheus(self, script_name):
+        """Format the stages in the Prometheus text exposition format."""
+        lines = ["# HELP omero_hrm_stage_duration_seconds Duration of each stage of the OMERO-HRM scripts",
+                 "# TYPE omero_hrm_stage_duration_seconds histogram"]
+        stages = self.to_dict()
+        for name, stage in stages.items():
+            labels = f'script="{script_name}",stage="{name}"'
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), stage["buckets"]):
+                cumulative += count
+                lines.append(f'omero_hrm_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"omero_hrm_stage_duration_seconds_sum{{{labels}}} {stage['seconds']:.6f}")
+            lines.append(f"omero_hrm_stage_duration_seconds_count{{{labels}}} {stage['count']}")
+        lines.extend(["# HELP omero_hrm_stage_bytes_total Bytes processed by each stage of the OMERO-HRM scripts",
+                      "# TYPE omero_hrm_stage_bytes_total counter"])
+        for name, stage in stages.items():
+            lines.append(f'omero_hrm_stage_bytes_total{{script="{script_name}",stage="{name}"}} {stage["bytes"]}')
+        return "\n".join(lines) + "\n"
+
+    def to_table(self):
+        """Format the stages as a compact text table."""
+        lines = [f"{'stage':<20}{'count':>7}{'total s':>10}{'mean s':>9}{'max s':>9}{'MB/s':>9}"]
+        for name, stage in sorted(self.to_dict().items()):
+            throughput = stage["bytes"] / 1024 ** 2 / stage["seconds"] if stage["bytes"] and stage["seconds"] else 0
+            lines.append(f"{name:<20}{stage['count']:>7}{stage['seconds']:>10.2f}"
+                         f"{stage['seconds'] / stage['count']:>9.2f}{stage['max_seconds']:>9.2f}"
+                         f"{throughput:>9.1f}")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+def export_metrics(conn, script_name, textfile_directory=None):
+    """Export the metrics of the run as a JSON FileAnnotation and, optionally, as a Prometheus textfile.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    script_name : str
+        Name of the script, used as a Prometheus label and in file names
+    textfile_directory : str, optional
+        Directory read by the node_exporter textfile collector
+    Returns
+    -------
+    ``omero.gateway.FileAnnotationWrapper``
+        The JSON file annotation, None if nothing was recorded or if it cannot be created.
+    """
+    if len(metrics.to_dict()) == 0:
+        logger.debug("No metrics recorded, nothing to export")
+        return None
+    if textfile_directory:
+        prometheus_path = os.path.join(textfile_directory, f"omero_hrm_{script_name}.prom")
+        try:
+            # write then rename so that the collector never reads a partial file
+            with open(prometheus_path + ".tmp", "w", encoding="utf-8") as prometheus_file:
+                prometheus_file.write(metrics.to_prometheus(script_name))
+            os.replace(prometheus_path + ".tmp", prometheus_path)
+        except OSError as err:
+            logger.error("Fail writing Prometheus metrics to [%s] : %s", prometheus_path, err)
+
+    import tempfile
+    tempdir = tempfile.TemporaryDirectory(prefix="hrm-omero__")
+    json_path = os.path.join(tempdir.name, f"{script_name}_metrics_{date.today()}.json")
+    try:
+        with open(json_path, "w", encoding="utf-8") as json_file:
+            json.dump({"script": script_name, "buckets": Metrics.BUCKETS, "stages": metrics.to_dict()},
+                      json_file, indent=2)
+        file_ann = conn.createFileAnnfromLocalFile(json_path, mimetype="application/json", ns=METRICS_NS)
+    except Exception as err:  # pylint: disable-msg=broad-except
+        logger.error("Fail exporting metrics : %s", err)
+        return None
+    finally:
+        tempdir.cleanup()
+    try:
+        delete_old_metrics(conn, script_name)
+    except Exception as err:  # pylint: disable-msg=broad-except
+        logger.warning("Fail deleting old metrics files : %s", err)
+    return file_ann
+
+
+def delete_old_metrics(conn, script_name):
+    """Delete the metrics files of the script owned by the user, except the last METRICS_KEEP ones.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    script_name : str
+        Name of the script, used in the file names
+    Returns
+    -------
+    int
+        Number of deleted metrics files.
+    """
+    params = omero.sys.ParametersI()
+    params.addString("ns", METRICS_NS)
+    params.addString("name", f"{script_name}_metrics_%")
+    params.addLong("owner", conn.getUserId())
+    rows = conn.getQueryService().projection(
+        "select a.id from FileAnnotation a join a.file f where a.ns = :ns and f.name like :name "
+        "and a.details.owner.id = :owner order by a.id desc", params, conn.SERVICE_OPTS)
+    old_ids = [row[0].val for row in rows[METRICS_KEEP:]]
+    if len(old_ids) > 0:
+        conn.deleteObjects("FileAnnotation", old_ids, wait=True)
+        logger.debug("Deleted %s old metrics file(s) of %s", len(old_ids), script_name)
+    return len(old_ids)
+
+
+class CircuitBreaker:
+    """Pause the calls to OMERO while the server is overloaded or unreachable.
+    After `failure_threshold` consecutive transient failures, the breaker opens and every caller waits
+    `pause` seconds before trying again. A successful call closes it.
+    Attributes
+    ----------
+    failure_threshold : int
+        Number of consecutive failures opening the breaker.
+    pause : float
+        Time in seconds during which calls are paused once the breaker is open.
+    """
+
+    def __init__(self, failure_threshold, pause):
+        self.failure_threshold = failure_threshold
+        self.pause = pause
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0
+
+    def wait(self):
+        """Block until the breaker is closed (or half-open)."""
+        with self._lock:
+            delay = self._open_until - time.time()
+        if delay > 0:
+            logger.warning("OMERO server overloaded or unreachable ; pausing for %.0f s", delay)
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.time() + self.pause
+                self._failures = 0
+
+
+circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_PAUSE)
+
+
+class TokenBucket:
+    """Allow `rate` units per second on average, with bursts of up to one second worth of units.
+    Taking more than the available tokens puts the bucket in debt, repaid by waiting.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        """Take `amount` tokens and return the time to wait (s) before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class Throttle:
+    """Limit the bytes and the file operations per second on the HRM-Share folder, overall and per user
+    (0 means no limit), and measure the effective rates.
+    The limits are set for each run by `configure`.
+    """
+
+    def __init__(self, bytes_per_s=0, ops_per_s=0, user_bytes_per_s=0, user_ops_per_s=0):
+        self._lock = threading.Lock()
+        self.configure(bytes_per_s, ops_per_s, user_bytes_per_s, user_ops_per_s)
+
+    def configure(self, bytes_per_s=0, ops_per_s=0, user_bytes_per_s=0, user_ops_per_s=0):
+        """Set the limits and reset the measured rates."""
+        with self._lock:
+            self.bytes_per_s = bytes_per_s
+            self.ops_per_s = ops_per_s
+            self.user_bytes_per_s = user_bytes_per_s
+            self.user_ops_per_s = user_ops_per_s
+            self._buckets = {None: (TokenBucket(bytes_per_s) if bytes_per_s else None,
+                                    TokenBucket(ops_per_s) if ops_per_s else None)}
+            self._start = time.monotonic()
+            self.n_bytes = 0
+            self.n_ops = 0
+            self.waited = 0
+
+    def is_limited(self):
+        return any([self.bytes_per_s, self.ops_per_s, self.user_bytes_per_s, self.user_ops_per_s])
+
+    def _user_buckets(self, owner):
+        with self._lock:
+            if owner not in self._buckets:
+                self._buckets[owner] = (TokenBucket(self.user_bytes_per_s) if self.user_bytes_per_s else None,
+                                        TokenBucket(self.user_ops_per_s) if self.user_ops_per_s else None)
+            return self._buckets[owner]
+
+    def consume(self, owner, n_bytes=0, n_ops=0):
+        """Account for `n_bytes` and `n_ops` file operations of the owner, waiting as long as the strictest limit
+        requires."""
+        delay = 0
+        buckets = [self._buckets[None]] + ([self._user_buckets(owner)] if owner is not None else [])
+        for bytes_bucket, ops_bucket in buckets:
+            if bytes_bucket is not None and n_bytes:
+                delay = max(delay, bytes_bucket.take(n_bytes))
+            if ops_bucket is not None and n_ops:
+                delay = max(delay, ops_bucket.take(n_ops))
+        with self._lock:
+            self.n_bytes += n_bytes
+            self.n_ops += n_ops
+            self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def report(self):
+        """Format the limits and the effective rates."""
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        limits = [label.format(limit) for limit, label in [(self.bytes_per_s / 1024 ** 2, "{:g} MB/s overall"),
+                                                            (self.user_bytes_per_s / 1024 ** 2, "{:g} MB/s per user"),
+                                                            (self.ops_per_s, "{:g} file op/s overall"),
+                                                            (self.user_ops_per_s, "{:g} file op/s per user")] if limit]
+        return "throttled to {} : {:.1f} MB/s and {:.1f} file op/s effective, {:.1f} s spent waiting".format(
+            ", ".join(limits), self.n_bytes / 1024 ** 2 / elapsed, self.n_ops / elapsed, self.waited)
+
+
+throttle = Throttle()
+
+
+class ConcurrencyController:
+    """Number of tasks (imports, downloads) running at once, adapted between `min_workers` and `max_workers`
+    (additive increase, multiplicative decrease) : one more task after each window of `limit` completed tasks
+    whose throughput did not drop, twice less after a server error or when their latency degrades.
+    Every change is logged. The bounds are set for each run by `configure`.
+    Attributes
+    ----------
+    limit : int
+        Current number of tasks allowed at once, starting at `min_workers`
+    """
+
+    def __init__(self, min_workers, max_workers):
+        self._lock = threading.Lock()
+        self.configure(min_workers, max_workers)
+
+    def configure(self, min_workers, max_workers):
+        """Set the bounds and start again from `min_workers`."""
+        with self._lock:
+            self.min_workers = max(1, min_workers)
+            self.max_workers = max(self.min_workers, max_workers)
+            self.limit = self.min_workers
+            self.lowest = self.limit
+            self.highest = self.limit
+            self.n_changes = 0
+            self._durations = []
+            self._window_start = time.monotonic()
+            self._best_latency = None
+            self._last_throughput = 0
+            self._last_decrease = 0
+
+    def is_adaptive(self):
+        return self.min_workers < self.max_workers
+
+    def _change(self, limit, reason):
+        # called with the lock held ; a new measurement window starts at each change
+        self._durations = []
+        self._window_start = time.monotonic()
+        if limit == self.limit:
+            return
+        logger.info("Parallelism %s -> %s : %s", self.limit, limit, reason)
+        self.limit = limit
+        self.lowest = min(self.lowest, limit)
+        self.highest = max(self.highest, limit)
+        self.n_changes += 1
+
+    def _decrease(self, reason):
+        self._last_decrease = time.monotonic()
+        self._last_throughput = 0
+        self._change(max(self.min_workers, self.limit // 2), reason)
+
+    def record_success(self, started, duration):
+        """Record a task started at `started` (monotonic time) and taking `duration` seconds, and adapt the limit
+        once per window."""
+        with self._lock:
+            # tasks started before the last change do not measure the current limit
+            if started < self._window_start:
+                return
+            self._durations.append(duration)
+            if len(self._durations) < self.limit:
+                return
+            # with limit tasks running at once, the throughput is limit / latency (Little's law)
+            latency = sum(self._durations) / len(self._durations)
+            throughput = self.limit / max(latency, 1e-6)
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+            if latency > CONCURRENCY_LATENCY_FACTOR * self._best_latency:
+                self._decrease(f"latency {latency:.1f} s above {CONCURRENCY_LATENCY_FACTOR:g} x "
+                               f"{self._best_latency:.1f} s")
+            elif throughput < self._last_throughput * (1 - CONCURRENCY_THROUGHPUT_TOLERANCE):
+                # the last task added did not help
+                self._change(max(self.min_workers, self.limit - 1),
+                             f"throughput dropped to {throughput:.2f} items/s")
+                self._last_throughput = 0
+            else:
+                self._change(min(self.max_workers, self.limit + 1),
+                             f"{throughput:.2f} items/s, latency {latency:.1f} s")
+                self._last_throughput = throughput
+
+    def record_error(self, reason):
+        """Halve the limit after a server error, at most once per `CONCURRENCY_COOLDOWN` seconds."""
+        with self._lock:
+            if time.monotonic() - self._last_decrease >= CONCURRENCY_COOLDOWN:
+                self._decrease(f"server error ({reason})")
+
+    def report(self):
+        """Format the range of the limit during the run."""
+        return f"parallelism adapted {self.n_changes} time(s) between {self.lowest} and {self.highest} " \
+               f"(bounds {self.min_workers}-{self.max_workers})"
+
+
+concurrency = ConcurrencyController(1, 1)
+
+
+def is_session_alive(conn):
+    """Check that the OMERO session is still alive.
+    The scripts run on the session of the script client, or on sudo sessions opened from it : there are no credentials
+    to log in again, so a lost session cannot be re-established.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    Returns
+    -------
+    bool
+        True if the session is alive, False otherwise.
+    """
+    try:
+        return conn.keepAlive()
+    except Exception:  # pylint: disable-msg=broad-except
+        return False
+
+
+def call_with_retry(conn, function, *args, **kwargs):
+    """Call a function talking to OMERO and retry it on transient failures (connection dropped, server busy) with
+    exponential backoff. A lost session is not retried : the error is raised at once.
+    Only use it for reads and idempotent writes : a write whose response was lost may have been committed by the
+    server, and calling it again would apply it twice.
+    All calls share a circuit breaker that pauses the work while the server is overloaded.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection used by `function`.
+    function : function
+        The function to call with `args` and `kwargs`.
+    Returns
+    -------
+    The result of `function`.
+    Raises
+    ------
+    The last transient error once `MAX_RETRIES` retries failed or once the session is lost, any other error
+    immediately.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        circuit_breaker.wait()
+        try:
+            result = function(*args, **kwargs)
+            circuit_breaker.record_success()
+            return result
+        except TRANSIENT_ERRORS as err:
+            circuit_breaker.record_failure()
+            concurrency.record_error(type(err).__name__)
+            if attempt == MAX_RETRIES:
+                raise
+            if not is_session_alive(conn):
+                logger.error("%s failed (%s) : OMERO session lost, it cannot be re-established",
+                             function.__name__, type(err).__name__)
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+            logger.warning("%s failed (%s) ; retry %s/%s in %.1f s",
+                           function.__name__, type(err).__name__, attempt + 1, MAX_RETRIES, delay)
+            time.sleep(delay)
+
+
+def get_user_connection(conn, owner, user_connections, ttl=SUDO_SESSION_TTL):
+    """Get a connection owned by the given user, opening a sudo session if necessary (admins only).
+    Sessions are cached in `user_connections` and reused for all the images of that user.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection of the script (admin connection in case of other users).
+    owner : str
+        Name of the user
+    user_connections : dict
+        Cache of opened connections {owner:connection}
+    ttl : int, optional
+        Lifetime of the sudo session in ms, which must cover the whole run
+    Returns
+    -------
+    ``omero.gateway.BlitzGateway`` object
+        Connection owned by `owner`, None if it cannot be opened.
+    """
+    if owner not in user_connections:
+        if owner == conn.getUser().getOmeName():
+            user_connections[owner] = conn
+        else:
+            user_conn = conn.suConn(owner, ttl=ttl)
+            if user_conn is None:
+                logger.error("Cannot open a session for user %s", owner)
+            user_connections[owner] = user_conn
+    return user_connections[owner]
+
+
+def get_group_connection(conn, owner, group_id, group_name, group_connections, ttl=SUDO_SESSION_TTL):
+    """Get a connection of the given user working in the given group, so that its group context is set once
+    and the groups can be processed concurrently.
+    Connections are cached in `group_connections`.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection of the script (admin connection in case of other users).
+    owner : str
+        Name of the user
+    group_id : int
+        ID of the group
+    group_name : str
+        Name of the group
+    group_connections : dict
+        Cache of opened connections {(owner, group_id):connection}
+    ttl : int, optional
+        Lifetime of the sudo session in ms, which must cover the whole run
+    Returns
+    -------
+    ``omero.gateway.BlitzGateway`` object
+        Connection of `owner` in the group, None if it cannot be opened.
+    """
+    if (owner, group_id) not in group_connections:
+        if owner == conn.getUser().getOmeName():
+            # another gateway on the script session, with its own group context
+            group_conn = BlitzGateway(client_obj=conn.c)
+        else:
+            group_conn = conn.suConn(owner, group_name, ttl=ttl)
+            if group_conn is None:
+                logger.error("Cannot open a session for user %s in group %s", owner, group_name)
+        if group_conn is not None:
+            group_conn.SERVICE_OPTS.setOmeroGroup(group_id)
+        group_connections[(owner, group_id)] = group_conn
+    return group_connections[(owner, group_id)]
+
+
+class SessionKeeper:
+    """Keep the sessions of cached connections from idling while the work runs, e.g. while a CLI import uses the
+    session key of a sudo session and the gateway itself makes no call.
+    Parameters
+    ----------
+    connection_caches : dict
+        Caches of opened connections, as filled by `get_user_connection` and `get_group_connection`
+    """
+
+    def __init__(self, *connection_caches, interval=KEEP_ALIVE_INTERVAL):
+        self.connection_caches = connection_caches
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Ping the sessions every `interval` seconds, in a daemon thread."""
+        self._thread = threading.Thread(target=self._run, name="session-keeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop pinging the sessions, before they are closed."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            # the caches grow while the work runs
+            for connections in self.connection_caches:
+                for user_conn in list(connections.values()):
+                    if user_conn is not None and not is_session_alive(user_conn):
+                        logger.warning("An OMERO session kept alive for the run was lost")
+
+
+def close_user_connections(conn, user_connections):
+    """Close all the sudo sessions opened by `get_user_connection` (or per group), keeping the script session."""
+    for user_conn in user_connections.values():
+        # gateways sharing the script session must not close it
+        if user_conn is not None and user_conn is not conn and user_conn.c is not conn.c:
+            user_conn.close()
+
+
+def schedule_round_robin(user_tasks, workers, max_tasks_per_user, run_task, controller=None):
+    """Run the tasks of several users concurrently.
+    Users are picked in round-robin order to fill free workers, and a user never has more than
+    `max_tasks_per_user` tasks running at once, so that a user with many tasks cannot starve the others.
+    Parameters
+    ----------
+    user_tasks : dict
+        dictionary {owner:list of tasks}
+    workers : int
+        Maximum number of tasks running at once
+    max_tasks_per_user : int
+        Maximum number of tasks of the same user running at once
+    run_task : function
+        Function called as `run_task(owner, task)`
+    controller : ConcurrencyController, optional
+        Adapts the number of tasks running at once, up to `workers`, from their durations
+    Returns
+    -------
+    list
+        Results of `run_task` (in completion order). Failing tasks are reported and skipped.
+    """
+    workers = max(1, workers)
+    max_tasks_per_user = max(1, max_tasks_per_user)
+    queues = {owner: deque(tasks) for owner, tasks in user_tasks.items() if len(tasks) > 0}
+    owners = deque(queues.keys())
+    in_flight = {owner: 0 for owner in owners}
+    futures = {}
+    results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(owners) > 0 or len(futures) > 0:
+            # fill free workers, one task per user in turn
+            n_capped = 0
+            limit = workers if controller is None else min(workers, controller.limit)
+            while len(owners) > 0 and len(futures) < limit and n_capped < len(owners):
+                owner = owners[0]
+                owners.rotate(-1)
+                if in_flight[owner] >= max_tasks_per_user:
+                    n_capped += 1
+                    continue
+                n_capped = 0
+                task = queues[owner].popleft()
+                if len(queues[owner]) == 0:
+                    owners.remove(owner)
+                futures[executor.submit(run_task, owner, task)] = (owner, time.monotonic())
+                in_flight[owner] += 1
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                owner, started = futures.pop(future)
+                in_flight[owner] -= 1
+                try:
+                    results.append(future.result())
+                    if controller is not None:
+                        controller.record_success(started, time.monotonic() - started)
+                except Exception as err:  # pylint: disable-msg=broad-except
+                    logger.error("Task of user %s failed : %s", owner, err)
+
+    return results
+
+
+def enqueue_request(conn, script_name, script_params):
+    """Record the request in the persistent off-peak queue and return immediately.
+    The queue is drained by `Run_HRM_queue.py` during the off-peak windows.
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    script_name : str
+        Name of the script running the request (`send` or `retrieve`)
+    script_params : dict
+        User defined parameters
+    Returns
+    -------
+    message : str
+        Queued request and results of the previous off-peak requests of the user.
+    """
+    owner = conn.getUser().getOmeName()
+    request_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{script_name}_{owner}_{os.getpid()}"
+    request = {"id": request_id, "user": owner, "script": script_name, "queued": time.time(),
+               "params": {key: value for key, value in script_params.items() if key != OFF_PEAK_PARAM_NAME}}
+    pending_folder = os.path.join(QUEUE_FOLDER, "pending")
+    os.makedirs(pending_folder, exist_ok=True)
+    request_path = os.path.join(pending_folder, request_id + ".json")
+    # write then rename so that the scheduler never reads a partial request
+    with open(request_path + ".tmp", "w", encoding="utf-8") as request_file:
+        json.dump(request, request_file, indent=2)
+    os.replace(request_path + ".tmp", request_path)
+    n_pending = len([name for name in os.listdir(pending_folder) if name.endswith(".json")])
+    message = f"Request {request_id} queued for the next off-peak window ({n_pending} request(s) pending)"
+    logger.info("%s", message)
+    return message + report_queued_results(owner)
+
+
+def report_queued_results(owner):
+    """Collect the results of the finished off-peak requests of the user, not reported yet, and mark them as
+    reported.
+    Parameters
+    ----------
+    owner : str
+        Name of the user
+    Returns
+    -------
+    str
+        The results, one line per request, empty if there is none.
+    """
+    done_folder = os.path.join(QUEUE_FOLDER, "done")
+    if not os.path.isdir(done_folder):
+        return ""
+    reported_folder = os.path.join(QUEUE_FOLDER, "reported")
+    os.makedirs(reported_folder, exist_ok=True)
+    results = []
+    for name in sorted(os.listdir(done_folder)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(done_folder, name), "r", encoding="utf-8") as request_file:
+            request = json.load(request_file)
+        if request.get("user") != owner:
+            continue
+        finished = time.strftime("%Y-%m-%d %H:%M", time.localtime(request["finished"]))
+        results.append(f"{request['id']} ({request['status']}, {finished}) : {request['message']}")
+        os.replace(os.path.join(done_folder, name), os.path.join(reported_folder, name))
+    if len(results) == 0:
+        return ""
+    return "\n\nPrevious off-peak requests :\n" + "\n".join(results)